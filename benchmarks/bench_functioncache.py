@@ -0,0 +1,422 @@
+"""
+benchmarks of functioncache, written as JSON so releases can be compared:
+
+    python benchmarks/bench_functioncache.py -o results.json
+    python benchmarks/bench_functioncache.py --quick --only keys backends
+
+groups:
+
+    keys        building keys (_args_key) for arguments of various types and
+                sizes, with digest_arguments and pickle_arguments
+    backends    latency of hits and misses of decorated functions on every
+                backend (memcache and redis go through in-process fakes)
+    threads     calls per second of a hit-heavy workload from N threads
+    processes   the same from N processes sharing a FileBackend directory
+    disk        bytes on disk per backend as entries are added
+
+Every result has a name, its parameters and seconds per operation (min,
+median, mean, stdev over the rounds) or, for throughput and disk, the
+measured value.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functioncache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_timer = time.perf_counter
+
+
+class FakeMemcacheClient(object):
+
+    """
+    an in-process memcache.Client, pickling values like the real one.
+    Clients given the same data dict act as connections to one server.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key):
+        data = self.data.get(key)
+        return None if data is None else pickle.loads(data)
+
+    def set(self, key, value, time=0):
+        self.data[key] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return True
+
+    def delete(self, key):
+        return self.data.pop(key, None) is not None
+
+    def get_multi(self, keys):
+        return dict((key, self.get(key)) for key in keys if key in self.data)
+
+    def set_multi(self, mapping, time=0):
+        for key, value in mapping.items():
+            self.set(key, value)
+        return []
+
+
+class FakeRedis(object):
+
+    """ an in-process redis.Redis, enough of it for RedisBackend """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def exists(self, name):
+        return int(name in self.data)
+
+    def set(self, name, value, px=None, nx=False):
+        if nx and name in self.data:
+            return None
+        self.data[name] = value
+        return True
+
+    def delete(self, name):
+        return int(self.data.pop(name, None) is not None)
+
+
+def _summary(samples):
+    return {
+        'rounds': len(samples),
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def _measure(operation, number, repeat):
+    """ seconds per call of operation, for each of repeat rounds """
+    samples = []
+    for _ in range(repeat):
+        start = _timer()
+        for _ in range(number):
+            operation()
+        samples.append((_timer() - start) / number)
+    return _summary(samples)
+
+
+def _arguments(quick):
+    sizes = (10, 1000) if quick else (10, 1000, 100000)
+    cases = [('no arguments', (), {}),
+             ('three ints', (1, 2, 3), {}),
+             ('ints and kwargs', (1, 2), {'alpha': 0.5, 'beta': None})]
+    for size in sizes:
+        cases.append(('str %d' % size, ('x' * size,), {}))
+        cases.append(('bytes %d' % size, (b'x' * size,), {}))
+        cases.append(('list of %d ints' % size, (list(range(size)),), {}))
+        cases.append(('dict of %d' % size,
+                      (dict(('k%d' % i, i) for i in range(size)),), {}))
+        if numpy is not None:
+            cases.append(('ndarray %d' % size, (numpy.arange(size),), {}))
+    return cases
+
+
+def bench_keys(args):
+    def keyed(*args, **kwargs):
+        pass
+    keyed._ignore_instance = False
+    keyed._function_key = functioncache.function_name
+
+    results = []
+    for builder in (functioncache.digest_arguments,
+                    functioncache.pickle_arguments):
+        keyed._key_builder = builder
+        for name, call_args, call_kwargs in _arguments(args.quick):
+            stats = _measure(
+                lambda: functioncache._args_key(keyed, call_args, call_kwargs),
+                args.number, args.repeat)
+            results.append({
+                'name': 'key/%s/%s' % (builder.__name__, name),
+                'params': {'builder': builder.__name__, 'arguments': name},
+                'seconds': stats,
+            })
+    return results
+
+
+def _fake_memcache_servers():
+    """ a client_factory of FakeMemcacheClients """
+    servers = {}
+    return lambda server: FakeMemcacheClient(servers.setdefault(server, {}))
+
+
+def _backends(root):
+    """ (name, backend factory) of every backend worth measuring """
+    def file_backend(**kwargs):
+        return lambda: functioncache.FileBackend(**kwargs)
+
+    return [
+        ('DictBackend', functioncache.DictBackend),
+        ('ShelveBackend', functioncache.ShelveBackend),
+        ('FileBackend', file_backend()),
+        ('FileBackend zero_copy', file_backend(zero_copy=True)),
+        ('SqliteBackend', functioncache.SqliteBackend),
+        ('LogBackend', functioncache.LogBackend),
+        ('TieredBackend(FileBackend)',
+         lambda: functioncache.TieredBackend(functioncache.FileBackend())),
+        ('MemcacheBackend', lambda: functioncache.MemcacheBackend(
+            client_factory=_fake_memcache_servers())),
+        ('RedisBackend', lambda: functioncache.RedisBackend(FakeRedis())),
+    ]
+
+
+def _decorated(backend, name, **kwargs):
+    def compute(x, payload):
+        return payload
+    # each backend gets its own function name, so their keys don't mix
+    compute.__name__ = compute.__qualname__ = 'compute_' + ''.join(
+        c for c in name if c.isalnum())
+    return functioncache.functioncache(
+        functioncache.HOUR, backend=backend, fail_silently=False,
+        sweep_every=None, **kwargs)(compute)
+
+
+def bench_backends(args):
+    payloads = [('small', 42), ('1 KB', b'x' * 1000)]
+    if not args.quick:
+        payloads.append(('1 MB', b'x' * 1000000))
+        if numpy is not None:
+            payloads.append(('ndarray 8 MB', numpy.zeros(1000000)))
+
+    results = []
+    for name, make in _backends(args.root):
+        # one backend per group: file backends lock or share their files
+        function = _decorated(make(), name)
+        counter = [0]
+        for payload_name, payload in payloads:
+
+            def miss():
+                counter[0] += 1
+                function(counter[0], payload)
+
+            def hit():
+                function(0, payload)
+
+            hit()
+            for kind, operation in (('miss', miss), ('hit', hit)):
+                stats = _measure(operation, args.number, args.repeat)
+                results.append({
+                    'name': 'backend/%s/%s/%s' % (name, kind, payload_name),
+                    'params': {'backend': name, 'operation': kind,
+                               'payload': payload_name},
+                    'seconds': stats,
+                })
+            function.cache_flush()
+        function.cache_close()
+    return results
+
+
+def bench_threads(args):
+    results = []
+    for name, make in _backends(args.root):
+        if name in ('ShelveBackend',):
+            # dbm isn't safe to share between threads
+            continue
+        function = _decorated(make(), name + 'threads')
+        for i in range(args.keys):
+            function(i, i)
+        for threads in args.workers:
+            calls = args.number * 10
+
+            def work(seed):
+                for j in range(calls):
+                    function((seed + j) % args.keys, 0)
+
+            pool = [threading.Thread(target=work, args=(i,))
+                    for i in range(threads)]
+            start = _timer()
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            elapsed = _timer() - start
+            results.append({
+                'name': 'threads/%s/%d' % (name, threads),
+                'params': {'backend': name, 'threads': threads},
+                'calls_per_second': threads * calls / elapsed,
+            })
+        function.cache_close()
+    return results
+
+
+def _square(x):
+    return x * x
+
+
+def _process_init(root):
+    global _shared_square
+    # the cache directory is fixed when decorating, so decorate here
+    functioncache._CACHE_ROOT = root
+    _shared_square = functioncache.functioncache(
+        functioncache.HOUR, backend=functioncache.FileBackend,
+        sweep_every=None)(_square)
+
+
+def _process_work(job):
+    seed, calls, keys = job
+    for j in range(calls):
+        _shared_square((seed + j) % keys)
+    return calls
+
+
+def bench_processes(args):
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for processes in args.workers:
+        calls = args.number * 10
+        pool = context.Pool(processes, _process_init, (args.root,))
+        try:
+            # start the workers and fill the cache before timing
+            pool.map(_process_work, [(0, args.keys, args.keys)] * processes)
+            start = _timer()
+            done = sum(pool.map(_process_work, [
+                (i, calls, args.keys) for i in range(processes)]))
+            elapsed = _timer() - start
+        finally:
+            pool.close()
+            pool.join()
+        results.append({
+            'name': 'processes/FileBackend/%d' % processes,
+            'params': {'backend': 'FileBackend', 'processes': processes},
+            'calls_per_second': done / elapsed,
+        })
+    return results
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def bench_disk(args):
+    results = []
+    checkpoints = (10, 100) if args.quick else (10, 100, 1000, 10000)
+    stores = [
+        ('ShelveBackend', functioncache.ShelveBackend, 'disk.cache'),
+        ('FileBackend', functioncache.FileBackend, 'disk.cached'),
+        ('SqliteBackend', functioncache.SqliteBackend, 'disk.cache.sqlite'),
+        ('LogBackend', functioncache.LogBackend, 'disk.cache.log'),
+    ]
+    for name, make, filename in stores:
+        path = os.path.join(args.root, 'disk', filename)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        backend = make()
+        backend.setup_path(path)
+        written = 0
+        for checkpoint in checkpoints:
+            functioncache._backend_set_many(backend, dict(
+                ('disk-%040x' % i, functioncache._retval(time.time(), 'x' * 100))
+                for i in range(written, checkpoint)), None)
+            written = checkpoint
+            if hasattr(backend, 'flush'):
+                backend.flush()
+            on_disk = sum(_size(os.path.join(os.path.dirname(path), other))
+                          for other in os.listdir(os.path.dirname(path))
+                          if other.startswith(filename))
+            results.append({
+                'name': 'disk/%s/%d' % (name, checkpoint),
+                'params': {'backend': name, 'entries': checkpoint,
+                           'value_bytes': 100},
+                'bytes': on_disk,
+                'bytes_per_entry': float(on_disk) / checkpoint,
+            })
+        if hasattr(backend, 'close'):
+            backend.close()
+    return results
+
+
+GROUPS = [
+    ('keys', bench_keys),
+    ('backends', bench_backends),
+    ('threads', bench_threads),
+    ('processes', bench_processes),
+    ('disk', bench_disk),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-o', '--output', help='write the JSON here')
+    parser.add_argument('--only', nargs='+', choices=[g[0] for g in GROUPS],
+                        help='run only these groups')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer sizes and rounds, for smoke tests')
+    parser.add_argument('--number', type=int,
+                        help='calls per round (default 1000, 100 if --quick)')
+    parser.add_argument('--repeat', type=int,
+                        help='rounds (default 5, 2 if --quick)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help='thread / process counts (default: 1 2 4 8)')
+    parser.add_argument('--keys', type=int, default=100,
+                        help='distinct keys of the concurrency benchmarks')
+    args = parser.parse_args(argv)
+    if args.number is None:
+        args.number = 100 if args.quick else 1000
+    if args.repeat is None:
+        args.repeat = 2 if args.quick else 5
+
+    args.root = tempfile.mkdtemp(prefix='functioncache-bench-')
+    previous_root = functioncache._CACHE_ROOT
+    functioncache._CACHE_ROOT = args.root
+    results = []
+    try:
+        for name, bench in GROUPS:
+            if args.only and name not in args.only:
+                continue
+            print('running %s...' % name, file=sys.stderr)
+            results.extend(bench(args))
+    finally:
+        functioncache._CACHE_ROOT = previous_root
+        functioncache.close_all()
+        shutil.rmtree(args.root, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.time(),
+        'quick': args.quick,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
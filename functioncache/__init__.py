@@ -38,13 +38,12 @@ In that case, you should use the ignore_instance=True keyword:
 NOTE: All arguments of the decorated function and the return value need to be
     picklable for this to work.
 
-NOTE: The cache isn't automatically cleaned, it is only overwritten. If your
-    function can receive many different arguments that rarely repeat, your
-    cache may forever grow. One day I might add a feature that once in every
-    100 calls scans the db for outdated stuff and erases.
+NOTE: Once in every 1000 writes (sweep_every), a background thread erases
+    the function's entries older than seconds_of_validity.  Pass max_entries
+    and/or max_bytes to also bound its size, evicting LRU or LFU entries.
+    Caches can be cleaned from cron too: python -m functioncache gc --help
 
-Tested on python 2.7 and 3.1
-(ignore_instance tested on python 2.7 and it rocks)
+Requires python 3.8 or later.
 
 License: BSD, do what you wish with this. Could be awesome to hear if you found
 it useful and/or you have suggestions. ubershmekel at gmail
@@ -65,21 +64,78 @@ A trick to invalidate a single value:
 
 from decorator import decorate
 import collections as _collections
+import concurrent.futures as _futures
+import copy as _copy
+import atexit as _atexit
+import bisect as _bisect
+import calendar as _calendar
 import datetime as _datetime
+import functools as _functools
 import inspect as _inspect
+import marshal as _marshal
+import math as _math
 import os as _os
+import mmap as _mmap
+import re as _re
 try:
     import cPickle as _pickle
 except ImportError:
     import pickle as _pickle
 import shelve as _shelve
+import signal as _signal
+import sqlite3 as _sqlite3
+import struct as _struct
 import sys as _sys
+import tempfile as _tempfile
+import threading as _threading
 import time as _time
 import traceback as _traceback
 import errno as _errno
+try:
+    import fcntl as _fcntl
+except ImportError:
+    # windows
+    _fcntl = None
+import hashlib
+import importlib as _importlib
+import io as _io
 import types as _types
+import uuid as _uuid
+import warnings as _warnings
+import weakref as _weakref
+import zlib as _zlib
 
 _retval = _collections.namedtuple('_retval', 'timesig data')
+
+
+class _Negative(_collections.namedtuple('_Negative', 'value raised')):
+
+    """
+    the data of a cached exception (raised is True) or of a result the
+    negative predicate picked out, see negative_ttl
+    """
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        if not self.raised:
+            return _Negative, tuple(self)
+        # pickled without calling the exception's constructor, which may not
+        # take its args back
+        value = self.value
+        return _negative_exception, (
+            type(value), value.args, getattr(value, '__dict__', {}))
+
+
+def _negative_exception(cls, args, state):
+    """ unpickle the _Negative of an exception pickled by _Negative """
+    value = cls.__new__(cls, *args)
+    value.args = args
+    if state:
+        value.__dict__.update(state)
+    return _Negative(value, True)
+
+
 _SRC_DIR = _os.path.dirname(_os.path.abspath(__file__))
 _CACHE_ROOT = _os.path.expanduser("~/.functioncache")
 
@@ -92,7 +148,25 @@ MONTH = 30 * DAY
 YEAR = 365 * DAY
 FOREVER = None
 
+# cache namespace -> its backend, once opened.  See _namespace
 OPEN_DBS = dict()
+# cache namespace -> its backend, opened or not, the settings it was made
+# with and the functions using it
+_BACKENDS = dict()
+_BACKEND_SETTINGS = dict()
+_NAMESPACE_FUNCTIONS = dict()
+_OPEN_LOCK = _threading.RLock()
+
+# returned by lookups when a key isn't in a backend
+_MISSING = object()
+
+# in-progress computations for single_flight functions, see _single_flight
+_FLIGHTS = dict()
+_FLIGHTS_LOCK = _threading.Lock()
+
+# keys being recomputed in the background, see _refresh
+_REFRESHING = set()
+_LEASE_POLL_SECONDS = 0.05
 
 
 def _mkdir_p(path):
@@ -142,301 +216,4025 @@ class PicklingError(TypeError):
     pass
 
 
+_timer = getattr(_time, 'perf_counter', _time.time)
+
+# callables called with (event, function name, value) for every recorded
+# event, see add_stats_hook
+_STATS_HOOKS = []
+# cache namespace (None for functions given their own _db) -> CacheStats
+# of the functions using that backend
+_STATS_REGISTRY = dict()
+
+
+class CacheStats(object):
+
+    """
+    what a decorated function's cache did: counts of hits (of which stale
+    ones were served while being refreshed, and negative ones were cached
+    exceptions or negative results), misses, expired hits, background
+    refreshes and errors, approximate bytes stored, and latency histograms of
+    building keys and of reading from and writing to the backend.
+    """
+
+    COUNTERS = ('hits', 'stale', 'negative', 'misses', 'expired', 'refreshes',
+                'errors', 'bytes_stored')
+    HISTOGRAMS = ('key_seconds', 'read_seconds', 'write_seconds')
+    # upper bounds of the histogram buckets, in seconds
+    BUCKETS = (1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0, float('inf'))
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = _threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict((counter, 0) for counter in self.COUNTERS)
+            self.histograms = dict(
+                (histogram, [0] * len(self.BUCKETS) + [0.0])
+                for histogram in self.HISTOGRAMS)
+
+    def record(self, event, value=1):
+        with self._lock:
+            if event in self.counters:
+                self.counters[event] += value
+            else:
+                histogram = self.histograms[event]
+                for i, bound in enumerate(self.BUCKETS):
+                    if value <= bound:
+                        histogram[i] += 1
+                        break
+                histogram[-1] += value
+        for hook in _STATS_HOOKS:
+            hook(event, self.name, value)
+
+    def as_dict(self):
+        with self._lock:
+            stats = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                stats[name] = {
+                    'count': sum(histogram[:-1]),
+                    'sum': histogram[-1],
+                    'buckets': list(zip(self.BUCKETS, histogram[:-1])),
+                }
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+
+def add_stats_hook(hook):
+    """
+    call hook(event, function_name, value) for every event recorded by any
+    cached function, e.g. to export to Prometheus or StatsD.  Events are the
+    CacheStats counters (value is the increment) and histograms (value is
+    the duration in seconds).
+    """
+    _STATS_HOOKS.append(hook)
+
+
+def remove_stats_hook(hook):
+    _STATS_HOOKS.remove(hook)
+
+
+def cache_stats():
+    """
+    the stats of every cached function, grouped by the cache namespace they
+    use: {namespace: {function name: stats}}
+    """
+    return dict(
+        (cache_name, dict((stats.name, stats.as_dict()) for stats in group))
+        for cache_name, group in _STATS_REGISTRY.items())
+
+
+def _approx_size(value):
+    nbytes = getattr(value, 'nbytes', None)
+    if isinstance(nbytes, int):
+        # NumPy arrays, memoryviews
+        return nbytes
+    return _sys.getsizeof(value)
+
+
+def _cache_error(function):
+    """ log the exception being handled and count it for function """
+    _log_error(_traceback.format_exc())
+    function._stats.record('errors')
+
+
 def function_name(fn):
     return fn.__name__
 
 
-def _args_key(function, args, kwargs, function_key=function_name):
+def _encode_code(code, parts):
+    """ append an encoding of a code object and the ones nested in it """
+    parts.append(code.co_code)
+    _encode_argument(code.co_names, parts)
+    _encode_argument(code.co_varnames, parts)
+    for const in code.co_consts:
+        if isinstance(const, _types.CodeType):
+            _encode_code(const, parts)
+        else:
+            _encode_argument(const, parts)
+
+
+def _global_names(code):
+    """ the global (and attribute) names used by code and nested code """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, _types.CodeType):
+            names.update(_global_names(const))
+    return names
+
+
+def _callees(fn):
+    """
+    fn and the functions of its module it refers to by name, transitively,
+    sorted by name
+    """
+    found = {fn.__qualname__: fn}
+    todo = [fn]
+    while todo:
+        code = todo.pop().__code__
+        for name in _global_names(code):
+            callee = fn.__globals__.get(name)
+            if callable(callee):
+                callee = _inspect.unwrap(callee)
+            if isinstance(callee, _types.FunctionType) and \
+                    callee.__module__ == fn.__module__ and \
+                    callee.__qualname__ not in found:
+                found[callee.__qualname__] = callee
+                todo.append(callee)
+    return [found[name] for name in sorted(found)]
+
+
+def code_fingerprint(fn, follow_calls=False):
+    """
+    a digest of fn's bytecode and constants, nested functions included.
+    With follow_calls, the functions of fn's module it calls (or otherwise
+    refers to by name) are digested too, and the ones they call, etc.
+    """
+    parts = []
+    for function in _callees(fn) if follow_calls else [fn]:
+        _encode_argument(function.__qualname__, parts)
+        _encode_code(function.__code__, parts)
+    return hashlib.sha1(b''.join(parts)).hexdigest()
+
+
+def _fingerprint_key(fn, follow_calls):
+    # keys stay safe as file names, see _SAFE_KEY
+    return '%s.%s' % (_re.sub(r'[^A-Za-z0-9_.]', '_', fn.__qualname__),
+                      code_fingerprint(fn, follow_calls)[:16])
+
+
+def function_fingerprint(fn):
+    """
+    a function_key which changes whenever fn's code does, so results of
+    older versions of fn aren't served.  It is computed once, when fn is
+    decorated.
+    """
+    try:
+        return fn._fingerprint_key
+    except AttributeError:
+        fn._fingerprint_key = _fingerprint_key(fn, False)
+        return fn._fingerprint_key
+
+
+def function_fingerprint_deep(fn):
+    """
+    function_fingerprint, also covering the functions of fn's module fn
+    calls, transitively.  It is computed once, on the first call, since
+    those may be defined after fn.
+    """
+    try:
+        return fn._deep_fingerprint_key
+    except AttributeError:
+        fn._deep_fingerprint_key = _fingerprint_key(fn, True)
+        return fn._deep_fingerprint_key
+
+
+_FINGERPRINT_KEYS = (function_fingerprint, function_fingerprint_deep)
+
+
+def pickle_arguments(args, kwargs):
+    """
+    the original key builder: the arguments pickled to an ascii string.
+    Keys are large and slow to build for big arguments, but stay readable
+    by versions of functioncache which only knew this format.
+    """
     arguments = (args, kwargs)
-    # Check if you have a valid, cached answer, and return it.
     # Sadly this is python version dependant
     try:
         if _sys.version_info[0] == 2:
-            arguments_pickle = _pickle.dumps(arguments)
+            return _pickle.dumps(arguments)
         else:
             # NOTE: protocol=0 so it's ascii, this is crucial for py3k
             #       because shelve only works with proper strings.
             #       Otherwise, we'd get an exception because
             #       function.__name__ is str but dumps returns bytes.
-            arguments_pickle = _pickle.dumps(
-                arguments, protocol=0).decode('ascii')
+            return _pickle.dumps(arguments, protocol=0).decode('ascii')
     except TypeError as e:
         raise PicklingError(str(e))
 
-    key = function_key(function) + arguments_pickle
-    return key
+
+def _encode_pickled(obj, parts):
+    try:
+        pickled = _pickle.dumps(obj, 2)
+    except (TypeError, AttributeError, _pickle.PicklingError) as e:
+        raise PicklingError(str(e))
+    parts.append(b'p%d:' % len(pickled))
+    parts.append(pickled)
 
 
-class ShelveBackend(object):
+def _encode_items(tag, items, parts):
+    # encode every item on its own and sort the encodings so the result
+    # doesn't depend on iteration order, even for unorderable items
+    encoded = []
+    for item in items:
+        item_parts = []
+        _encode_argument(item, item_parts)
+        encoded.append(b''.join(item_parts))
+    encoded.sort()
+    parts.append(b'%s%d(' % (tag, len(encoded)))
+    parts.extend(encoded)
+    parts.append(b')')
+
 
+def _encode_ndarray(obj, parts):
+    if obj.dtype.hasobject:
+        # the buffer only holds pointers to the objects
+        _encode_pickled(obj, parts)
+        return
+    header = '%s%r' % (obj.dtype.str, obj.shape)
+    parts.append(b'a%d:' % len(header))
+    parts.append(header.encode('ascii'))
+    if not obj.flags.c_contiguous:
+        obj = obj.copy()
+    try:
+        data = memoryview(obj).cast('B')
+    except (TypeError, ValueError):
+        # datetime64/timedelta64 arrays don't export a buffer and empty ones
+        # can't be cast, copy their bytes instead
+        data = obj.tobytes()
+    parts.append(b'%d:' % len(data))
+    parts.append(data)
+
+
+_ATOM_TYPES = frozenset([int, float, bool, type(None)])
+
+
+def _encode_argument(obj, parts):
     """
-    store cache data in a file based on the filename of the file which
-    contains the function being cached.  One cache file can store multiple
-    functions' data.
+    append an unambiguous binary encoding of obj to parts.  Every value is
+    tagged with its type and length, so e.g. 1, 1.0, '1' and (1,) differ.
+    Exact types are checked so subclasses (namedtuples, enums...) fall
+    through to pickle, which records their class.
     """
+    t = type(obj)
+    if t is str:
+        data = obj.encode('utf-8', 'surrogatepass')
+        parts.append(b's%d:' % len(data))
+        parts.append(data)
+    elif t is int:
+        parts.append(b'i%d;' % obj)
+    elif obj is None:
+        parts.append(b'N')
+    elif t is bool:
+        parts.append(b'T' if obj else b'F')
+    elif t is float:
+        parts.append(b'f%r;' % obj)
+    elif t is bytes:
+        parts.append(b'b%d:' % len(obj))
+        parts.append(obj)
+    elif t is tuple or t is list:
+        tag = b't' if t is tuple else b'l'
+        if _ATOM_TYPES.issuperset(map(type, obj)):
+            # the repr of flat sequences of these types is unambiguous and
+            # much quicker than encoding item by item
+            data = repr(obj).encode('utf-8', 'surrogatepass')
+            parts.append(b'%sr%d:' % (tag, len(data)))
+            parts.append(data)
+            return
+        parts.append(b'%s%d(' % (tag, len(obj)))
+        for item in obj:
+            _encode_argument(item, parts)
+        parts.append(b')')
+    elif t is dict:
+        _encode_items(b'd', obj.items(), parts)
+    elif t is set or t is frozenset:
+        _encode_items(b'S' if t is set else b'Z', obj, parts)
+    elif t.__name__ == 'ndarray' and t.__module__ == 'numpy':
+        _encode_ndarray(obj, parts)
+    else:
+        _encode_pickled(obj, parts)
 
-    def setup(self, function):
-        self.shelve = _shelve.open(_get_cache_name(function))
 
-    def __contains__(self, key):
-        return key in self.shelve
+def digest_arguments(args, kwargs):
+    """
+    the default key builder: a fixed size digest of a structural encoding of
+    the arguments.  Common types (ints, strs, bytes, tuples, lists, dicts,
+    sets and NumPy arrays) are encoded directly, anything else is pickled.
+    """
+    parts = []
+    _encode_argument(args, parts)
+    if kwargs:
+        _encode_items(b'd', kwargs.items(), parts)
+    return '-' + hashlib.sha1(b''.join(parts)).hexdigest()
 
-    def __getitem__(self, key):
-        return self.shelve[key]
 
-    def __setitem__(self, key, value):
-        # NOTE: no need to _db.sync() because there was no mutation
-        # NOTE: it's importatnt to do _db.sync() because otherwise the cache
-        # doesn't survive Ctrl-Break!
-        self.shelve[key] = value
-        self.shelve.sync()
+def _args_key(function, args, kwargs, function_key=function_name,
+              key_builder=digest_arguments):
+    key = function_key(function) + key_builder(args, kwargs)
+    return key
 
-import hashlib
 
+# keys which can be used as they are for filenames and memcache keys
+_SAFE_KEY = _re.compile(r'^[A-Za-z0-9_.-]{1,200}$')
 
-class FileBackend(object):
 
+def _short_key(key):
+    # keys other than digest keys need hashed to remove the invalid
+    # characters from the pickled data and avoid problems with key length
+    if _SAFE_KEY.match(key) is None:
+        return hashlib.sha512(key.encode()).hexdigest()
+    return key
+
+
+def _hashed_prefix(prefix):
     """
-    provide a backend to functioncache which stores each function argument
-    combination in a different file.  This works around the problem caused
-    by multiple python processes/threads trying to use the same file for
-    caching.  This will still fail if the same function with the same arguments
-    try to write simultaneously.  The ShelveBackend will fail often
-    if any function in the same python file tries to write simultaneously.
+    whether the keys starting with prefix are hashed by _short_key, so
+    backends naming entries after their keys can't tell them apart
     """
+    return prefix is not None and _SAFE_KEY.match(prefix) is None
 
-    def setup(self, function):
-        self.dir_name = _get_cache_name(function) + 'd'
-        _mkdir_p(self.dir_name)
 
-    def __contains__(self, key):
-        return _os.path.isfile(self._get_filename(key))
+# serialized values start with the magic, the codec id and the compression
+# id.  Pickles never start with 0xfc, so values stored before serializers
+# existed are still read as plain pickles.
+_SERIAL_MAGIC = b'\xfcFC'
+_SERIAL_HEADER = _struct.Struct('<3sBB')
 
-    def __getitem__(self, key):
-        return _pickle.load(open(self._get_filename(key), 'rb'))
+PICKLE = 'pickle'
+MARSHAL = 'marshal'
+ZLIB = 'zlib'
+LZ4 = 'lz4'
+ZSTD = 'zstd'
 
-    def __setitem__(self, key, value):
-        # first-write wins semantics.  if someone else already cached this
-        # value while we were off computing it, don't bother writing.  If we do
-        # write, and the other process is still writing, we may corrupt the
-        # file
-        import portalocker
 
-        try:
-            file = open(self._get_filename(key), 'wb')
-            portalocker.Lock(file)
-            try:
-                _pickle.dump(value, file, _pickle.HIGHEST_PROTOCOL)
-            except TypeError as e:
-                raise PicklingError(str(e))
-        except portalocker.LockException as e:
-            # someone else had the lock, thats ok, we don't have to
-            # write the value if someone else already is
-            pass
-        except Exception as e:
-            # delete the file in the event of an exception during saving
-            # to protect from corrupted files causing problems later
-            try:
-                _os.remove(self._get_filename(key))
-            except OSError:
-                pass
+def _marshal_dumps(value):
+    try:
+        return _marshal.dumps(value)
+    except ValueError as e:
+        raise PicklingError(str(e))
 
-            raise
 
-    def _get_filename(self, key):
-        # hash the key and use as a filename
-        return self.dir_name + '/' + hashlib.sha512(key.encode()).hexdigest()
+def _pickle_dumps(value):
+    try:
+        return _pickle.dumps(value, min(5, _pickle.HIGHEST_PROTOCOL))
+    except (AttributeError, TypeError, _pickle.PicklingError) as e:
+        raise PicklingError(str(e))
 
 
-class DictBackend(dict):
+def _zstd_compress(data, level):
+    import zstandard
+    return zstandard.ZstdCompressor(
+        level=3 if level is None else level).compress(data)
 
-    """ cached values won't persist outside of this thread """
 
-    def setup(self, function):
-        pass
+def _zstd_decompress(data):
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
 
 
-class MemcacheBackend(object):
+def _lz4_compress(data, level):
+    import lz4.frame
+    return lz4.frame.compress(data, compression_level=level or 0)
 
-    """ simple wrapper around memcache """
 
-    def setup(self, function):
-        pass
+def _lz4_decompress(data):
+    import lz4.frame
+    return lz4.frame.decompress(data)
 
-    def __init__(self, mc=None):
-        if mc:
-            self.mc = mc
-        else:
-            import memcache
-            self.mc = memcache.Client(['127.0.0.1:11211'], debug=0)
 
-    def __contains__(self, key):
-        return self[key] != None
+# name: (id, dumps, loads)
+_CODECS = {
+    PICKLE: (1, _pickle_dumps, _pickle.loads),
+    MARSHAL: (2, _marshal_dumps, _marshal.loads),
+}
 
-    def __getitem__(self, key):
-        return self.mc.get(self._hash_key(key))
+# name: (id, compress(data, level), decompress)
+_COMPRESSIONS = {
+    ZLIB: (1, lambda data, level: _zlib.compress(
+        data, -1 if level is None else level), _zlib.decompress),
+    LZ4: (2, _lz4_compress, _lz4_decompress),
+    ZSTD: (3, _zstd_compress, _zstd_decompress),
+}
 
-    def __setitem__(self, key, value):
-        if not self.mc.set(self._hash_key(key), value):
-            raise Exception("memcache set failed")
+_CODEC_IDS = dict((codec[0], codec) for codec in _CODECS.values())
+_COMPRESSION_IDS = dict((compression[0], compression)
+                        for compression in _COMPRESSIONS.values())
 
-    def _hash_key(self, key):
-        # the key needs hashed to remove the invalid characters from the
-        # pickled data and avoid problems with key length
-        return hashlib.sha512(key).hexdigest()
 
+class Serializer(object):
 
-class S3Backend(object):
+    """
+    turns cached values into bytes and back.
 
-    """ wrapper around s3 - requires you to pass in an s3pool """
+    codec is PICKLE (protocol 5 where available) or MARSHAL, which is faster
+    and smaller but only handles plain data: numbers, strings, bytes, and
+    tuples, lists, sets and dicts of them.  Values larger than threshold bytes
+    are compressed with compression (ZLIB, or LZ4 / ZSTD if the lz4 /
+    zstandard packages are installed) at the given level.
 
-    def setup(self, function):
-        self.data_set = _get_cache_name(function)
+    The codec and compression are recorded in a header, so any Serializer can
+    load what another one stored, as well as entries stored before
+    serializers existed.  Any object with dumps and loads methods can be
+    passed to functioncache(serializer=...) instead.
+    """
 
-    def __init__(self, s3pool):
-        self.s3pool = s3pool
+    def __init__(self, codec=PICKLE, compression=None, threshold=1024,
+                 level=None):
+        if codec not in _CODECS:
+            raise ValueError('unknown codec %r' % (codec,))
+        if compression is not None and compression not in _COMPRESSIONS:
+            raise ValueError('unknown compression %r' % (compression,))
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
+        self.level = level
 
-    def __contains__(self, key):
-        return bool(self.s3pool.list(self.data_set, key))
+    def _spec(self):
+        return (self.codec, self.compression, self.threshold, self.level)
 
-    def __getitem__(self, key):
-        return self.s3pool.get_contents_as_string(self.data_set, key)
+    def __eq__(self, other):
+        return isinstance(other, Serializer) and \
+            self._spec() == other._spec()
 
-    def __setitem__(self, key, value):
-        return self.s3pool.set_contents_from_string(self.data_set, key, value)
+    def __ne__(self, other):
+        return not self == other
 
+    def __hash__(self):
+        return hash(self._spec())
 
-class SkipCache(Exception):
+    def __repr__(self):
+        return 'Serializer(%r, %r, %r, %r)' % self._spec()
+
+    def dumps(self, value):
+        codec_id, dumps, _ = _CODECS[self.codec]
+        data = dumps(value)
+        compression_id = 0
+        if self.compression is not None and len(data) > self.threshold:
+            compression_id, compress, _ = _COMPRESSIONS[self.compression]
+            data = compress(data, self.level)
+        return _SERIAL_HEADER.pack(_SERIAL_MAGIC, codec_id,
+                                   compression_id) + data
+
+    def loads(self, data):
+        return _loads(data)
+
+
+def _loads(data):
+    """ load bytes stored by any Serializer, or a plain pickle """
+    if data[:len(_SERIAL_MAGIC)] != _SERIAL_MAGIC:
+        return _pickle.loads(data)
+    _, codec_id, compression_id = _SERIAL_HEADER.unpack_from(data)
+    data = data[_SERIAL_HEADER.size:]
+    if compression_id:
+        data = _COMPRESSION_IDS[compression_id][2](data)
+    return _CODEC_IDS[codec_id][2](data)
+
+
+def _dump_entry(serializer, value):
+    """ the bytes of a _retval, for backends storing whole entries """
+    return serializer.dumps((value.timesig, value.data))
+
+
+def _load_entry(serializer, data):
+    loads = _loads if serializer is None else serializer.loads
+    return _retval(*loads(data))
+
+
+_entry_info = _collections.namedtuple(
+    '_entry_info', 'handle written accessed hits size')
+
+LRU = 'lru'
+LFU = 'lfu'
 
+
+# buffered ShelveBackends, flushed when the process is told to terminate
+_BUFFERED_SHELVES = _weakref.WeakSet()
+_FLUSH_SIGNALS = ('SIGTERM', 'SIGBREAK', 'SIGHUP')
+_flush_handlers_installed = False
+
+
+def _flush_and_resignal(signum, frame, previous):
+    for backend in list(_BUFFERED_SHELVES):
+        # if the interrupted code holds the lock it's mid write, leave it
+        if backend._lock.acquire(False):
+            try:
+                backend._flush_locked()
+            except Exception:
+                pass
+            finally:
+                backend._lock.release()
+    if callable(previous):
+        previous(signum, frame)
+    elif previous != _signal.SIG_IGN:
+        _signal.signal(signum, _signal.SIG_DFL)
+        _os.kill(_os.getpid(), signum)
+
+
+def _install_flush_handlers():
     """
-    Sometimes something goes wrong (e.g. communication with a server times out), and your function wants to return a
-    "fail gracefully" fallback value, but you don't want it cached. The SkipCache exception lets you do just that.
-    instead of doing:
-      return some_fallback_value
-    you do:
-      raise SkipCache,"Server timeout",some_fallback_value
-    The caller of your function will get the value, but it won't get cached.
-    The error text ("Server timeout") will appear in functioncache's log.
+    flush buffered writes before signals which end the process without
+    running atexit (SIGINT raises KeyboardInterrupt, so atexit covers it).
     """
+    global _flush_handlers_installed
+    if _flush_handlers_installed:
+        return
+    if _threading.current_thread() is not _threading.main_thread():
+        # signal handlers can only be installed from the main thread
+        return
+    for name in _FLUSH_SIGNALS:
+        signum = getattr(_signal, name, None)
+        if signum is None:
+            continue
+        previous = _signal.getsignal(signum)
+        if previous is None:
+            # installed from outside python, leave it alone
+            continue
+        _signal.signal(signum, lambda signum, frame, previous=previous:
+                       _flush_and_resignal(signum, frame, previous))
+    _flush_handlers_installed = True
 
-    def __init__(self, message, retval=None):
-        Exception.__init__(self, message)
-        self.retval = retval
 
+class ShelveBackend(object):
 
-def function_with_cache(function, *args, **kwargs):
-    try:
-        key = _args_key(
-            function, args[1:] if function._ignore_instance else args, kwargs,
-            function_key=function._function_key
-        )
-
-        if key in function._db:
-            rv = function._db[key]
-            if function._seconds_of_validity is None or _time.time(
-            ) - rv.timesig < function._seconds_of_validity:
-                return rv.data
-    except:
-        # in any case of failure, don't let functioncache break the
-        # program
-        error_str = _traceback.format_exc()
-        _log_error(error_str)
-        if not function._fail_silently:
-            raise
+    """
+    store cache data in a file based on the filename of the file which
+    contains the function being cached.  One cache file can store multiple
+    functions' data.
 
-    try:
-        retval = function(*args, **kwargs)
-    # Log the error, return the value, don't cache it.
-    except SkipCache as e:
-        error_str = _traceback.format_exc()
-        _log_error(error_str)
-        return e.retval
+    Writes are buffered and written to the file together, every flush_every
+    writes or flush_interval seconds, whichever comes first.  The buffer is
+    also flushed at exit and on SIGTERM/SIGBREAK/SIGHUP, so the cache still
+    survives Ctrl-Break.  flush_every=1 syncs the file after every write.
+    """
 
-    # store in cache
-    try:
-        function._db[key] = _retval(_time.time(), retval)
-    except:
-        # in any case of failure, don't let functioncache break the
-        # program
-        error_str = _traceback.format_exc()
-        _log_error(error_str)
-        if not function._fail_silently:
-            raise
+    # set when an eviction policy needs to know which entries are used
+    track_access = False
+    # None lets shelve pickle the entries
+    serializer = None
 
-    return retval
+    def __init__(self, flush_every=100, flush_interval=1.0):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        if flush_every > 1:
+            # now, when decorating, which is likely on the main thread.  The
+            # backend is set up on first use, maybe by a worker thread,
+            # where signal handlers can't be installed
+            _install_flush_handlers()
 
+    def setup(self, function):
+        self.setup_path(_get_cache_name(function))
 
-def is_class(x):
-    """ handle difference between py2 and py3 """
-    if isinstance(x, type):
-        return True
+    def setup_path(self, path):
+        self.shelve = _shelve.open(path)
+        # the sweeper and the flush timer run in their own threads and dbm
+        # isn't thread safe
+        self._lock = _threading.Lock()
+        self._pending = dict()
+        self._timer = None
+        self._accessed = dict()
+        self._hits = dict()
+        if self.flush_every > 1:
+            _BUFFERED_SHELVES.add(self)
+            _atexit.register(self.flush)
+            _install_flush_handlers()
 
-    if hasattr(_types, 'ClassType'):
-        return isinstance(x, _types.ClassType)
-    else:
-        return False
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._pending or key in self.shelve
 
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
 
-def functioncache(
-        seconds_of_validity=None,
-        fail_silently=True,
-        backend=ShelveBackend(),
-        ignore_instance=False,
-        function_key=function_name):
-    '''
-    functioncache is called and the decorator should be returned.
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self.shelve.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        value = self._decode(value)
+        if self.track_access:
+            self._accessed[key] = _time.time()
+            self._hits[key] = self._hits.get(key, 0) + 1
+        return value
 
-    function_key allows you to introduce cache invalidation on implementation changes
-    '''
-    # if a class is passed in, create an instance of that class as the backend
-    if is_class(backend):
-        backend = backend()
+    def get_many(self, keys):
+        found = dict()
+        with self._lock:
+            for key in keys:
+                value = self._pending.get(key, _MISSING)
+                if value is _MISSING:
+                    value = self.shelve.get(key, _MISSING)
+                if value is not _MISSING:
+                    found[key] = self._decode(value)
+        if self.track_access:
+            now = _time.time()
+            for key in found:
+                self._accessed[key] = now
+                self._hits[key] = self._hits.get(key, 0) + 1
+        return found
 
-    def functioncache_decorator(function):
-        # make sure cache is loaded
-        if not hasattr(function, '_db'):
-            cache_name = (_get_cache_name(function), type(backend))
-            if cache_name in OPEN_DBS:
-                function._db = OPEN_DBS[cache_name]
-            else:
-                backend.setup(function)
-                function._db = backend
-                OPEN_DBS[cache_name] = function._db
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
 
-            function_with_cache._db = function._db
+    def set_many(self, values, ttl=None):
+        if self.serializer is not None:
+            values = dict((key, _dump_entry(self.serializer, value))
+                          for key, value in values.items())
+        # NOTE: it's importatnt to sync the shelve (see flush) because
+        # otherwise the cache doesn't survive Ctrl-Break!
+        with self._lock:
+            self._pending.update(values)
+            if len(self._pending) >= self.flush_every:
+                self._flush_locked()
+            elif self._timer is None and self.flush_interval is not None:
+                self._timer = _threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
 
-        function._seconds_of_validity = seconds_of_validity
-        function._fail_silently = fail_silently
-        function._ignore_instance = ignore_instance
-        function._function_key = function_key
+    def _decode(self, value):
+        # entries written with a serializer are stored as bytes
+        if isinstance(value, bytes):
+            return _load_entry(self.serializer, value)
+        return value
 
-        return decorate(function, function_with_cache)
+    def __delitem__(self, key):
+        with self._lock:
+            pending = self._pending.pop(key, _MISSING)
+            try:
+                del self.shelve[key]
+            except KeyError:
+                if pending is _MISSING:
+                    raise
+            self.shelve.sync()
 
-    if isinstance(seconds_of_validity, _types.FunctionType):
-        # support for when people use '@functioncache.functioncache' instead of
-        # '@functioncache.functioncache()'
-        func = seconds_of_validity
-        return functioncache_decorator(func)
+    def flush(self):
+        """ write the buffered entries to the file """
+        with self._lock:
+            self._flush_locked()
 
-    return functioncache_decorator
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            for key, value in self._pending.items():
+                self.shelve[key] = value
+            self.shelve.sync()
+            self._pending.clear()
 
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            self.shelve.close()
+        _BUFFERED_SHELVES.discard(self)
 
-def dictcache(seconds_of_validity=None, fail_silently=False):
-    return functioncache(seconds_of_validity, fail_silently, DictBackend())
+    def _keys(self, prefix=None):
+        with self._lock:
+            self._flush_locked()
+            return [key for key in self.shelve.keys()
+                    if prefix is None or key.startswith(prefix)]
 
+    def _entries(self, prefix=None, sizes=False):
+        """
+        yield an _entry_info for every entry whose key starts with prefix.
+        Access times and hit counts are only known for entries read by this
+        process, other entries count as last accessed when written.
+        """
+        keys = self._keys(prefix)
+        for key in keys:
+            with self._lock:
+                value = self.shelve.get(key)
+            if value is None:
+                continue
+            size = 0
+            if sizes:
+                size = len(value) if isinstance(value, bytes) else len(
+                    _pickle.dumps(value, _pickle.HIGHEST_PROTOCOL))
+            value = self._decode(value)
+            yield _entry_info(key, value.timesig,
+                              self._accessed.get(key, value.timesig),
+                              self._hits.get(key, 0), size)
 
-def filecache(seconds_of_validity=None, fail_silently=False):
-    return functioncache(seconds_of_validity, fail_silently, FileBackend())
+    def _remove(self, handle):
+        self._accessed.pop(handle, None)
+        self._hits.pop(handle, None)
+        try:
+            del self[handle]
+        except KeyError:
+            pass
 
 
-def shelvecache(seconds_of_validity=None, fail_silently=False):
-    return functioncache(seconds_of_validity, fail_silently, ShelveBackend())
+# layout of FileBackend's zero_copy files: the magic, the length of the
+# pickle and the number of buffers, (offset, length) of every buffer, the
+# pickle, then the buffers, each starting at a multiple of _MMAP_ALIGN
+_MMAP_MAGIC = b'FCMMAP1\n'
+_MMAP_ALIGN = 64
 
 
-def memcachecache(seconds_of_validity=None, fail_silently=False, mc=None):
-    return functioncache(
-        seconds_of_validity, fail_silently, MemcacheBackend(mc)
-    )
+def _mapped_chunks(value):
+    """ the chunks of a zero_copy file holding value """
+    try:
+        if type(value.data) in (bytes, bytearray):
+            # bytes are pickled in-band unless wrapped
+            value = _retval(value.timesig, _pickle.PickleBuffer(value.data))
+        buffers = []
+        payload = _pickle.dumps(value, 5, buffer_callback=buffers.append)
+    except TypeError as e:
+        raise PicklingError(str(e))
+
+    views = [buffer.raw() for buffer in buffers]
+    header_size = len(_MMAP_MAGIC) + 16 * (1 + len(views))
+    table = []
+    offset = header_size + len(payload)
+    for view in views:
+        offset += -offset % _MMAP_ALIGN
+        table.append(_struct.pack('<QQ', offset, view.nbytes))
+        offset += view.nbytes
+
+    chunks = [_MMAP_MAGIC, _struct.pack('<QQ', len(payload), len(views))]
+    chunks.extend(table)
+    chunks.append(payload)
+    position = header_size + len(payload)
+    for view in views:
+        chunks.append(b'\0' * (-position % _MMAP_ALIGN))
+        position += -position % _MMAP_ALIGN
+        chunks.append(view)
+        position += view.nbytes
+    return chunks
+
+
+def _load_mapped(value_file):
+    """ load a zero_copy file, its buffers are views of a read-only mmap """
+    mapped = _mmap.mmap(value_file.fileno(), 0, access=_mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    position = len(_MMAP_MAGIC)
+    payload_size, count = _struct.unpack_from('<QQ', mapped, position)
+    buffers = []
+    for i in range(count):
+        offset, size = _struct.unpack_from(
+            '<QQ', mapped, position + 16 * (i + 1))
+        buffers.append(view[offset:offset + size])
+    position += 16 * (count + 1)
+    return _pickle.loads(view[position:position + payload_size],
+                         buffers=buffers)
+
+
+def _load_file(value_file):
+    """ load a file holding a pickle or a serialized entry """
+    if value_file.read(len(_SERIAL_MAGIC)) == _SERIAL_MAGIC:
+        value_file.seek(0)
+        return _load_entry(None, value_file.read())
+    value_file.seek(0)
+    return _pickle.load(value_file)
+
+
+class FileBackend(object):
+
+    """
+    provide a backend to functioncache which stores each function argument
+    combination in a different file.  This works around the problem caused
+    by multiple python processes/threads trying to use the same file for
+    caching.  The ShelveBackend will fail often if any function in the same
+    python file tries to write simultaneously.
+
+    Files are spread over shard_depth levels of subdirectories named by two
+    hex digits (256 per level), so no directory gets too big to list.  They
+    are written under a temporary name and renamed into place, so readers
+    never see half written files; when two processes write the same entry,
+    the last one wins.  Entries in the flat layout of older versions are
+    still read, migrate() (or python -m functioncache migrate) moves them
+    into their shards.
+
+    A file's mtime is the time it was written.  When track_access is set, its
+    atime is bumped on every read so eviction can find least recently used
+    entries, even from another process (see python -m functioncache gc).
+
+    With zero_copy=True, the NumPy arrays and bytes in results are written as
+    raw buffers (pickle protocol 5 out-of-band buffers) after the pickle.
+    Hits memory-map the file and return read-only arrays (bytes results come
+    back as read-only memoryviews) backed by the mapping, so nothing is
+    copied and processes reading the same entry share the page cache.
+    """
+
+    track_access = False
+    # None pickles the entries with the highest protocol
+    serializer = None
+
+    def __init__(self, zero_copy=False, shard_depth=2):
+        if zero_copy and _pickle.HIGHEST_PROTOCOL < 5:
+            raise ValueError('zero_copy needs pickle protocol 5')
+        self.zero_copy = zero_copy
+        self.shard_depth = shard_depth
+
+    def setup(self, function):
+        self.setup_path(_get_cache_name(function) + 'd')
+
+    def setup_path(self, path):
+        self.dir_name = path
+        self._hits = dict()
+        _mkdir_p(self.dir_name)
+        # whether to look for entries written before sharding
+        self._flat = bool(self.shard_depth) and any(
+            True for _ in self._flat_entries())
+
+    def _flat_entries(self):
+        """ the entries in the top directory, i.e. written before sharding """
+        for entry in _os.scandir(self.dir_name):
+            name = entry.name
+            if name.startswith('.') or name.endswith('.lease'):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                yield entry
+
+    def __contains__(self, key):
+        return _os.path.isfile(self._get_filename(key)) or (
+            self._flat and _os.path.isfile(self._flat_filename(key)))
+
+    def __getitem__(self, key):
+        filename = self._get_filename(key)
+        if self._flat and not _os.path.exists(filename):
+            filename = self._flat_filename(key)
+        with open(filename, 'rb') as value_file:
+            if value_file.read(len(_MMAP_MAGIC)) == _MMAP_MAGIC:
+                value = _load_mapped(value_file)
+            elif self.serializer is None:
+                value_file.seek(0)
+                value = _load_file(value_file)
+            else:
+                value_file.seek(0)
+                value = _load_entry(self.serializer, value_file.read())
+        if self.track_access:
+            now = _time.time()
+            _os.utime(filename, (now, _os.stat(filename).st_mtime))
+            self._hits[filename] = self._hits.get(filename, 0) + 1
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (IOError, OSError):
+            return default
+
+    def get_many(self, keys):
+        found = dict()
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def __setitem__(self, key, value):
+        if self.zero_copy:
+            chunks = _mapped_chunks(value)
+        elif self.serializer is not None:
+            chunks = [_dump_entry(self.serializer, value)]
+        else:
+            try:
+                chunks = [_pickle.dumps(value, _pickle.HIGHEST_PROTOCOL)]
+            except (TypeError, AttributeError, _pickle.PicklingError) as e:
+                raise PicklingError(str(e))
+
+        # readers must never see a partly written file, and other processes
+        # may have the current one mapped (zero_copy), truncating it would
+        # crash them.  Write a new file and move it into place instead.
+        filename = self._get_filename(key)
+        fd, temp_name = _tempfile.mkstemp(dir=self.dir_name, prefix='.tmp-')
+        try:
+            with _os.fdopen(fd, 'wb') as value_file:
+                for chunk in chunks:
+                    value_file.write(chunk)
+            try:
+                _os.replace(temp_name, filename)
+            except FileNotFoundError:
+                # the first entry of its shard
+                _os.makedirs(_os.path.dirname(filename), exist_ok=True)
+                _os.replace(temp_name, filename)
+        except Exception:
+            try:
+                _os.remove(temp_name)
+            except OSError:
+                pass
+            raise
+
+    def __delitem__(self, key):
+        removed = False
+        for filename in (self._get_filename(key), self._flat_filename(key)):
+            try:
+                _os.remove(filename)
+                removed = True
+            except OSError:
+                pass
+        if not removed:
+            raise KeyError(key)
+
+    def migrate(self):
+        """
+        move the entries of the flat layout into their shards, returns how
+        many were moved
+        """
+        moved = 0
+        for entry in list(self._flat_entries()):
+            filename = self._get_filename(entry.name)
+            if filename == entry.path:
+                continue
+            _os.makedirs(_os.path.dirname(filename), exist_ok=True)
+            try:
+                if _os.path.exists(filename):
+                    # rewritten since sharding, the old file is outdated
+                    _os.remove(entry.path)
+                else:
+                    _os.replace(entry.path, filename)
+                    moved += 1
+            except OSError:
+                # removed by someone else in the meantime
+                pass
+        self._flat = False
+        return moved
+
+    def _scan(self, dir_name):
+        """ the DirEntry of every entry under dir_name """
+        for entry in _os.scandir(dir_name):
+            name = entry.name
+            if name.startswith('.') or name.endswith('.lease'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                for sharded in self._scan(entry.path):
+                    yield sharded
+            else:
+                yield entry
+
+    def _entries(self, prefix=None, sizes=False):
+        """ yield an _entry_info for every entry whose key starts with prefix """
+        if _hashed_prefix(prefix):
+            return
+        for entry in self._scan(self.dir_name):
+            if prefix is not None and not entry.name.startswith(prefix):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            yield _entry_info(entry.path, stat.st_mtime, stat.st_atime,
+                              self._hits.get(entry.path, 0), stat.st_size)
+
+    def _remove(self, handle):
+        self._hits.pop(handle, None)
+        try:
+            _os.remove(handle)
+        except OSError:
+            pass
+
+    def acquire_lease(self, key, seconds):
+        """
+        try to become the one process computing `key`.  Returns a token to
+        pass to release_lease, or None if another process holds the lease.
+        A lease older than `seconds` is assumed abandoned and is broken.
+        """
+        lease_name = self._get_filename(key) + '.lease'
+        token = '%d-%s' % (_os.getpid(), _uuid.uuid4().hex)
+        _os.makedirs(_os.path.dirname(lease_name), exist_ok=True)
+        try:
+            fd = _os.open(lease_name, _os.O_CREAT | _os.O_EXCL | _os.O_WRONLY)
+        except OSError as exc:
+            if exc.errno != _errno.EEXIST:
+                raise
+            try:
+                if _time.time() - _os.path.getmtime(lease_name) >= seconds:
+                    _os.remove(lease_name)
+            except OSError:
+                # the holder released it in the meantime
+                pass
+            return None
+
+        try:
+            _os.write(fd, token.encode('ascii'))
+        finally:
+            _os.close(fd)
+        return token
+
+    def release_lease(self, key, token):
+        lease_name = self._get_filename(key) + '.lease'
+        try:
+            with open(lease_name) as lease_file:
+                if lease_file.read() != token:
+                    # our lease expired and someone else took over
+                    return
+            _os.remove(lease_name)
+        except (IOError, OSError):
+            pass
+
+    def _get_filename(self, key):
+        # digest keys are already short and safe, anything else gets hashed
+        name = _short_key(key)
+        if not self.shard_depth:
+            return self.dir_name + '/' + name
+        shard = hashlib.md5(name.encode()).hexdigest()
+        return '/'.join([self.dir_name] + [
+            shard[i:i + 2] for i in range(0, 2 * self.shard_depth, 2)] + [name])
+
+    def _flat_filename(self, key):
+        return self.dir_name + '/' + _short_key(key)
+
+
+class _Entry(object):
+
+    """ a cached value in a DictBackend, a smaller _retval """
+
+    __slots__ = ('timesig', 'data')
+
+    def __init__(self, timesig, data):
+        self.timesig = timesig
+        self.data = data
+
+    def __iter__(self):
+        return iter((self.timesig, self.data))
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '_Entry(timesig=%r, data=%r)' % (self.timesig, self.data)
+
+
+class DictBackend(_collections.OrderedDict):
+
+    """
+    cached values won't persist outside of this process.
+
+    Functions using a DictBackend are keyed by their arguments themselves,
+    like functools.lru_cache, instead of by a digest of them; only
+    unhashable arguments are serialized.  maxsize bounds the number of
+    entries, evicting the least recently used ones.
+    """
+
+    def __init__(self, maxsize=None):
+        _collections.OrderedDict.__init__(self)
+        self.maxsize = maxsize
+        self._fresh()
+
+    def _fresh(self):
+        self.clear()
+        self._lock = _threading.Lock()
+
+    def setup(self, function):
+        pass
+
+    def get(self, key, default=None):
+        entry = _collections.OrderedDict.get(self, key, default)
+        if self.maxsize is not None and entry is not default:
+            with self._lock:
+                try:
+                    self.move_to_end(key)
+                except KeyError:
+                    # evicted in the meantime
+                    pass
+        return entry
+
+    def __setitem__(self, key, value):
+        if type(value) is _retval:
+            value = _Entry(value.timesig, value.data)
+        with self._lock:
+            _collections.OrderedDict.__setitem__(self, key, value)
+            if self.maxsize is not None:
+                self.move_to_end(key)
+                while len(self) > self.maxsize:
+                    self.popitem(last=False)
+
+    def _keys(self, prefix=None):
+        # keys made of the arguments themselves (see _dict_cached) start
+        # with the function_key
+        return [key for key in list(self) if prefix is None or (
+            key if isinstance(key, str) else key[0]).startswith(prefix)]
+
+
+class _TierStats(object):
+
+    """ hit/miss counts and time spent reading for one tier """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'mean_seconds': self.seconds / lookups if lookups else 0.0,
+        }
+
+
+class TieredBackend(object):
+
+    """
+    keep the most recently used entries of another backend in memory, so hot
+    keys aren't read from disk (or the network) and unpickled on every hit:
+
+        @functioncache(HOUR, backend=TieredBackend(FileBackend()))
+
+    max_entries and max_bytes bound the memory tier.  Sizes are estimated
+    with sizeof, which is the nbytes or sys.getsizeof of the cached value by
+    default.
+    Entries older than ttl are dropped from memory; ttl defaults to the
+    seconds_of_validity of the function the backend is set up for.
+    """
+
+    def __init__(self, backend, max_entries=1024, max_bytes=None, ttl=None,
+                 sizeof=None):
+        if is_class(backend):
+            backend = backend()
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: _approx_size(value.data))
+        self._fresh()
+
+    def _fresh(self):
+        """ (re)create the state a copy mustn't share, see _copy_backend """
+        self._memory = _collections.OrderedDict()
+        self._bytes = 0
+        self._lock = _threading.Lock()
+        self._memory_stats = _TierStats()
+        self._backend_stats = _TierStats()
+
+    def setup(self, function):
+        self.backend.setup(function)
+        if self.ttl is None:
+            self.ttl = _retention(function) if hasattr(
+                function, '_seconds_of_validity') else None
+
+    def get(self, key, default=None):
+        start = _time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self.ttl is not None and \
+                    _time.time() - entry[0].timesig >= self.ttl:
+                self._discard(key)
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._memory_stats.hits += 1
+                self._memory_stats.seconds += _time.time() - start
+                return entry[0]
+            self._memory_stats.misses += 1
+            self._memory_stats.seconds += _time.time() - start
+
+        start = _time.time()
+        value = _db_get(self.backend, key)
+        self._backend_stats.seconds += _time.time() - start
+        if value is _MISSING:
+            self._backend_stats.misses += 1
+            return default
+        self._backend_stats.hits += 1
+        self._remember(key, value)
+        return value
+
+    def get_many(self, keys):
+        found = dict()
+        missing = []
+        for key in keys:
+            with self._lock:
+                cached = key in self._memory
+            # get() keeps the stats and drops expired entries
+            value = self.get(key, _MISSING) if cached else _MISSING
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            start = _time.time()
+            from_backend = _db_get_many(self.backend, missing)
+            self._backend_stats.seconds += _time.time() - start
+            self._backend_stats.hits += len(from_backend)
+            self._backend_stats.misses += len(missing) - len(from_backend)
+            for key, value in from_backend.items():
+                self._remember(key, value)
+            found.update(from_backend)
+        return found
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        _backend_set(self.backend, key, value, ttl)
+        self._remember(key, value)
+
+    def set_many(self, values, ttl=None):
+        _backend_set_many(self.backend, values, ttl)
+        for key, value in values.items():
+            self._remember(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._discard(key)
+        del self.backend[key]
+
+    @property
+    def track_access(self):
+        return getattr(self.backend, 'track_access', False)
+
+    @track_access.setter
+    def track_access(self, value):
+        self.backend.track_access = value
+
+    def _entries(self, prefix=None, sizes=False):
+        # entries removed from the backend may linger in memory until they
+        # expire or are pushed out, that's harmless
+        return self.backend._entries(prefix, sizes)
+
+    def _remove(self, handle):
+        self.backend._remove(handle)
+
+    def stats(self):
+        """ hit ratio and mean lookup latency of the memory and backend tiers """
+        return {
+            'memory': dict(self._memory_stats.as_dict(),
+                           entries=len(self._memory), bytes=self._bytes),
+            'backend': self._backend_stats.as_dict(),
+        }
+
+    def _remember(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._memory[key] = (value, size)
+            self._bytes += size
+            while self._memory and (
+                    (self.max_entries is not None and
+                     len(self._memory) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self._bytes > self.max_bytes)):
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def _discard(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+# what DedupBackend stores under a key whose value went to a blob
+_BlobRef = _collections.namedtuple('_BlobRef', 'digest size')
+
+_BLOB_PREFIX = 'blob-'
+# a reference to a blob is an entry of its own, named after the blob's
+# digest and the sha1 of the key, holding the key
+_REFS_PREFIX = 'refs-'
+
+
+class DedupBackend(object):
+
+    """
+    store each distinct return value of at least min_size pickled bytes
+    once, however many keys it is cached under:
+
+        @functioncache(DAY, backend=DedupBackend(FileBackend()))
+
+    A key maps to the sha1 of its pickled value, the value itself is kept
+    in a blob entry of the wrapped backend, and each key referencing it
+    gets a small entry of its own, so adding a reference is one write
+    whatever the number of keys.  Blobs no key points to anymore
+    (overwritten, deleted, or removed behind the backend's back by sweep,
+    evict or the gc command) are deleted by collect(), which runs after
+    each maintenance pass.  A key whose blob is gone reads as a miss.
+    """
+
+    def __init__(self, backend, min_size=1024):
+        if is_class(backend):
+            backend = backend()
+        self.backend = backend
+        self.min_size = min_size
+        self._fresh()
+
+    def _fresh(self):
+        self._lock = _threading.RLock()
+
+    def setup(self, function):
+        self.backend.setup(function)
+
+    def get(self, key, default=None):
+        value = _db_get(self.backend, key)
+        if value is _MISSING:
+            return default
+        if not isinstance(value.data, _BlobRef):
+            return value
+        blob = _db_get(self.backend, _BLOB_PREFIX + value.data.digest)
+        if blob is _MISSING:
+            return default
+        return _retval(value.timesig, _pickle.loads(blob.data))
+
+    def get_many(self, keys):
+        found = _db_get_many(self.backend, keys)
+        blob_keys = set(_BLOB_PREFIX + value.data.digest
+                        for value in found.values()
+                        if isinstance(value.data, _BlobRef))
+        blobs = _db_get_many(self.backend, list(blob_keys)) if blob_keys \
+            else dict()
+        for key, value in list(found.items()):
+            if isinstance(value.data, _BlobRef):
+                blob = blobs.get(_BLOB_PREFIX + value.data.digest)
+                if blob is None:
+                    del found[key]
+                else:
+                    found[key] = _retval(value.timesig,
+                                         _pickle.loads(blob.data))
+        return found
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        data = _pickle_dumps(value.data)
+        collectable = self._collectable()
+        if len(data) < self.min_size:
+            with self._lock:
+                old = self._pointer(key) if collectable else None
+                _backend_set(self.backend, key, value, ttl)
+                if old is not None:
+                    self._unref(old.digest, key)
+            return
+
+        digest = hashlib.sha1(data).hexdigest()
+        blob_key = _BLOB_PREFIX + digest
+        pointer = _retval(value.timesig, _BlobRef(digest, len(data)))
+        if not collectable:
+            # there are no references to count, the blob expires like the
+            # keys pointing to it, so every new one extends its life
+            _backend_set_many(self.backend, {
+                blob_key: _retval(value.timesig, data), key: pointer}, ttl)
+            return
+        with self._lock:
+            old = self._pointer(key)
+            if blob_key not in self.backend:
+                _backend_set(self.backend, blob_key,
+                             _retval(value.timesig, data), None)
+            # the reference lives as long as the key
+            _backend_set_many(self.backend, {
+                self._ref_name(digest, key): _retval(value.timesig, key),
+                key: pointer}, ttl)
+            if old is not None and old.digest != digest:
+                self._unref(old.digest, key)
+
+    def set_many(self, values, ttl=None):
+        for key, value in values.items():
+            self.set(key, value, ttl)
+
+    def __delitem__(self, key):
+        with self._lock:
+            old = self._pointer(key) if self._collectable() else None
+            del self.backend[key]
+            if old is not None:
+                self._unref(old.digest, key)
+
+    @property
+    def track_access(self):
+        return getattr(self.backend, 'track_access', False)
+
+    @track_access.setter
+    def track_access(self, value):
+        self.backend.track_access = value
+
+    def _entries(self, prefix=None, sizes=False):
+        # blobs belong to the keys pointing to them, they are never swept
+        # or evicted by themselves
+        for entry in self.backend._entries(prefix, sizes):
+            name = _os.path.basename(entry.handle)
+            if not name.startswith((_BLOB_PREFIX, _REFS_PREFIX)):
+                yield entry
+
+    def _remove(self, handle):
+        self.backend._remove(handle)
+
+    def collect(self):
+        """
+        delete the blobs no key points to anymore and the references of
+        keys which are gone.  Returns how many blobs were deleted.
+        Backends which can't list their entries expire blobs by themselves.
+        """
+        if not self._collectable():
+            return 0
+        blobs = set()
+        refs = _collections.defaultdict(list)
+        for entry in list(self.backend._entries()):
+            name = _os.path.basename(entry.handle)
+            if name.startswith(_BLOB_PREFIX):
+                blobs.add(name[len(_BLOB_PREFIX):])
+            elif name.startswith(_REFS_PREFIX):
+                digest = name[len(_REFS_PREFIX):].partition('-')[0]
+                refs[digest].append(name)
+        freed = 0
+        for digest in blobs | set(refs):
+            with self._lock:
+                live = False
+                for name in refs.get(digest, ()):
+                    keys = self._referencing(name)
+                    if any(getattr(self._pointer(key), 'digest', None) ==
+                           digest for key in keys):
+                        live = True
+                    else:
+                        self._delete(name)
+                if not live and digest in blobs:
+                    self._delete(_BLOB_PREFIX + digest)
+                    freed += 1
+        return freed
+
+    def _collectable(self):
+        return hasattr(self.backend, '_entries')
+
+    def _pointer(self, key):
+        """ the _BlobRef stored under key, if any """
+        value = _db_get(self.backend, key)
+        if value is not _MISSING and isinstance(value.data, _BlobRef):
+            return value.data
+        return None
+
+    @staticmethod
+    def _ref_name(digest, key):
+        return '%s%s-%s' % (_REFS_PREFIX, digest,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _referencing(self, name):
+        """ the keys a reference entry stands for """
+        value = _db_get(self.backend, name)
+        if value is _MISSING:
+            return ()
+        # the set of every key referencing a blob, as versions before
+        # references had entries of their own stored them
+        return value.data if isinstance(value.data, frozenset) else \
+            (value.data,)
+
+    def _unref(self, digest, key):
+        # the blob is deleted by collect once no key points to it
+        self._delete(self._ref_name(digest, key))
+
+    def _delete(self, name):
+        if not hasattr(self.backend, '__delitem__'):
+            return
+        try:
+            del self.backend[name]
+        except KeyError:
+            pass
+
+
+class _ClientPool(object):
+
+    """
+    up to size clients made by create, handed to one thread at a time.
+    Threads wait when all of them are in use.
+    """
+
+    def __init__(self, create, size):
+        self.create = create
+        self.size = size
+        self.created = 0
+        self.idle = []
+        self.condition = _threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle:
+                if self.created < self.size:
+                    self.created += 1
+                    break
+                self.condition.wait()
+            else:
+                return self.idle.pop()
+        try:
+            return self.create()
+        except BaseException:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, client):
+        with self.condition:
+            self.idle.append(client)
+            self.condition.notify()
+
+
+class _HashRing(object):
+
+    """
+    consistent hashing: every node owns replicas points on a ring of md5
+    hashes and a key belongs to the next point after its own hash, so
+    adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = []
+        for node in nodes:
+            for i in range(replicas):
+                points.append((self._hash('%s-%d' % (node, i)), node))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.nodes = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode()).hexdigest()[:8], 16)
+
+    def node(self, key):
+        i = _bisect.bisect(self.hashes, self._hash(key))
+        return self.nodes[i % len(self.nodes)]
+
+
+# memcache reads expiry times longer than 30 days as unix timestamps
+_MEMCACHE_MAX_RELATIVE_TTL = 30 * DAY
+
+
+class MemcacheBackend(object):
+
+    """
+    store cache data in memcached.
+
+    Keys are spread over servers by consistent hashing.  Each server has a
+    pool of up to pool_size clients, made by client_factory(server) (a
+    python-memcached Client by default), so threads never share a client.
+    Alternatively pass a ready client as mc; it is then used by one thread
+    at a time.
+
+    Lookups are a single GET, and cache_map / fn.submit use one get_multi /
+    set_multi per server.  Entries expire in memcached itself when the
+    function's seconds_of_validity has passed.
+    """
+
+    # None leaves pickling the entries to the memcache client
+    serializer = None
+
+    def setup(self, function):
+        pass
+
+    def __init__(self, mc=None, servers=('127.0.0.1:11211',), pool_size=8,
+                 client_factory=None):
+        if mc is not None:
+            servers = (None,)
+            create = lambda server: mc
+            pool_size = 1
+        else:
+            create = client_factory or self._memcache_client
+        self.servers = list(servers)
+        self._pools = dict(
+            (server, _ClientPool(_functools.partial(create, server),
+                                 pool_size))
+            for server in self.servers)
+        self._ring = _HashRing(self.servers) if len(self.servers) > 1 \
+            else None
+
+    @staticmethod
+    def _memcache_client(server):
+        import memcache
+        return memcache.Client([server], debug=0)
+
+    def _server(self, hashed_key):
+        if self._ring is None:
+            return self.servers[0]
+        return self._ring.node(hashed_key)
+
+    def _by_server(self, hashed_keys):
+        """ {server: [hashed keys]} """
+        grouped = dict()
+        for hashed_key in hashed_keys:
+            grouped.setdefault(self._server(hashed_key), []).append(
+                hashed_key)
+        return grouped
+
+    def _call(self, server, method, *args):
+        pool = self._pools[server]
+        client = pool.acquire()
+        try:
+            return getattr(client, method)(*args)
+        finally:
+            pool.release(client)
+
+    @staticmethod
+    def _expiry(ttl):
+        """ memcache's expiry time for entries valid for ttl seconds """
+        if ttl is None:
+            return 0
+        if ttl > _MEMCACHE_MAX_RELATIVE_TTL:
+            return int(_time.time() + ttl)
+        # 0 would mean forever
+        return max(1, int(_math.ceil(ttl)))
+
+    def get(self, key, default=None):
+        hashed_key = self._hash_key(key)
+        value = self._call(self._server(hashed_key), 'get', hashed_key)
+        # entries are never None, memcache's None means a miss
+        if value is None:
+            return default
+        return self._decode(value)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        hashed_key = self._hash_key(key)
+        if not self._call(self._server(hashed_key), 'set', hashed_key,
+                          self._encode(value), self._expiry(ttl)):
+            raise Exception("memcache set failed")
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        hashed_key = self._hash_key(key)
+        if not self._call(self._server(hashed_key), 'delete', hashed_key):
+            raise KeyError(key)
+
+    def get_many(self, keys):
+        hashed = dict((self._hash_key(key), key) for key in keys)
+        found = dict()
+        for server, hashed_keys in self._by_server(hashed).items():
+            values = self._call(server, 'get_multi', hashed_keys)
+            for hashed_key, value in values.items():
+                if value is not None:
+                    found[hashed[hashed_key]] = self._decode(value)
+        return found
+
+    def set_many(self, values, ttl=None):
+        encoded = dict((self._hash_key(key), self._encode(value))
+                       for key, value in values.items())
+        failed = []
+        for server, hashed_keys in self._by_server(encoded).items():
+            failed.extend(self._call(
+                server, 'set_multi',
+                dict((hashed_key, encoded[hashed_key])
+                     for hashed_key in hashed_keys),
+                self._expiry(ttl)) or ())
+        if failed:
+            raise Exception("memcache set failed")
+
+    def _encode(self, value):
+        if self.serializer is None:
+            return value
+        return _dump_entry(self.serializer, value)
+
+    def _decode(self, value):
+        if isinstance(value, bytes):
+            return _load_entry(self.serializer, value)
+        return value
+
+    def _hash_key(self, key):
+        return _short_key(key)
+
+
+class RedisBackend(object):
+
+    """
+    store cache data in redis, e.g. one shared by a fleet of workers.
+
+    client is a redis.Redis (or anything with its interface); by default one
+    is made for url with a connection pool of up to max_connections, which
+    redis-py shares safely between threads.  Keys are prefixed with prefix.
+
+    Entries are written with SET PX so redis expires them after the
+    function's seconds_of_validity.  cache_map / fn.submit read with MGET and
+    write through a pipeline, one round trip each.  acquire_lease takes a
+    SET NX lock, so with single_flight one worker across all nodes computes
+    a missing key while the others wait for it.
+    """
+
+    serializer = Serializer()
+
+    # keys per MGET, to keep the commands a reasonable size
+    _CHUNK = 1000
+
+    def setup(self, function):
+        pass
+
+    def __init__(self, client=None, url='redis://127.0.0.1:6379/0',
+                 max_connections=None, prefix='functioncache:'):
+        if client is None:
+            import redis
+            client = redis.Redis(connection_pool=redis.ConnectionPool.from_url(
+                url, max_connections=max_connections))
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, key):
+        return self.prefix + _short_key(key)
+
+    @staticmethod
+    def _px(ttl):
+        """ redis' expiry in milliseconds for entries valid for ttl seconds """
+        if ttl is None:
+            return None
+        return max(1, int(_math.ceil(ttl * 1000)))
+
+    def get(self, key, default=None):
+        data = self.client.get(self._name(key))
+        if data is None:
+            return default
+        return _load_entry(self.serializer, data)
+
+    def __contains__(self, key):
+        return bool(self.client.exists(self._name(key)))
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._name(key), _dump_entry(self.serializer, value),
+                        px=self._px(ttl))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if not self.client.delete(self._name(key)):
+            raise KeyError(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        pipeline = self.client.pipeline(transaction=False)
+        for i in range(0, len(keys), self._CHUNK):
+            pipeline.mget([self._name(key)
+                           for key in keys[i:i + self._CHUNK]])
+        found = dict()
+        for i, values in zip(range(0, len(keys), self._CHUNK),
+                             pipeline.execute()):
+            for key, data in zip(keys[i:i + self._CHUNK], values):
+                if data is not None:
+                    found[key] = _load_entry(self.serializer, data)
+        return found
+
+    def set_many(self, values, ttl=None):
+        encoded = dict((self._name(key), _dump_entry(self.serializer, value))
+                       for key, value in values.items())
+        if not encoded:
+            return
+        if ttl is None:
+            self.client.mset(encoded)
+            return
+        # MSET can't expire keys, pipeline SETs instead
+        pipeline = self.client.pipeline(transaction=False)
+        px = self._px(ttl)
+        for name, data in encoded.items():
+            pipeline.set(name, data, px=px)
+        pipeline.execute()
+
+    def _keys(self, prefix=None):
+        if _hashed_prefix(prefix):
+            return
+        for name in self.client.scan_iter(
+                match=self.prefix + (prefix or '') + '*', count=self._CHUNK):
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            if not name.endswith(':lease'):
+                yield name[len(self.prefix):]
+
+    def acquire_lease(self, key, seconds):
+        """
+        try to become the one worker computing `key`.  Returns a token to
+        pass to release_lease, or None if another worker holds the lease.
+        Redis drops the lease after `seconds` in case its holder died.
+        """
+        token = '%d-%s' % (_os.getpid(), _uuid.uuid4().hex)
+        if self.client.set(self._name(key) + ':lease', token, nx=True,
+                           px=self._px(seconds)):
+            return token
+        return None
+
+    # deletes the lease only if we still hold it: it may have expired and
+    # been taken over by another worker
+    _RELEASE_SCRIPT = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def release_lease(self, key, token):
+        # one atomic round trip, a GET then a DEL could delete the lease
+        # another worker took in between
+        self.client.eval(self._RELEASE_SCRIPT, 1,
+                         self._name(key) + ':lease', token)
+
+
+class S3Backend(object):
+
+    """
+    store cache data in an S3 bucket, or any S3 compatible store (MinIO,
+    moto, ...) at endpoint_url:
+
+        @functioncache(WEEK, backend=S3Backend('my-cache-bucket'))
+
+    client is a boto3 S3 client; by default one is made when the backend is
+    opened, keeping up to max_connections connections to S3.  Objects are
+    named prefix + module name + '/' + key.
+
+    A lookup is a single GET, a missing object is a miss.  Each object
+    carries its write time and expiry in its metadata, so `key in backend`
+    is a HEAD that downloads nothing.  Values over multipart_threshold bytes
+    are uploaded in parts of part_size bytes and read back with ranged
+    GETs, max_concurrency at a time.
+
+    S3Backend(s3pool) still makes the old s3pool wrapper, with a
+    DeprecationWarning.
+    """
+
+    serializer = Serializer()
+
+    def __new__(cls, *args, **kwargs):
+        # S3Backend(s3pool) is the old constructor, kept for one release
+        if cls is S3Backend and ('s3pool' in kwargs or (
+                args and not isinstance(args[0], str))):
+            return _S3PoolBackend(*args, **kwargs)
+        return super(S3Backend, cls).__new__(cls)
+
+    def __init__(self, bucket, client=None, prefix='functioncache/',
+                 endpoint_url=None, max_connections=10,
+                 multipart_threshold=8 * 1024 * 1024,
+                 part_size=8 * 1024 * 1024, max_concurrency=10):
+        self.bucket = bucket
+        self.client = client
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.max_connections = max_connections
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self._fresh()
+
+    def _fresh(self):
+        # the pools are shut down when the backend is closed
+        self._executors = dict()
+        self._lock = _threading.Lock()
+
+    def setup(self, function):
+        self.namespace = '%s%s/' % (self.prefix, function.__module__)
+        if self.client is None:
+            import boto3
+            import botocore.config
+            self.client = boto3.client(
+                's3', endpoint_url=self.endpoint_url,
+                config=botocore.config.Config(
+                    max_pool_connections=self.max_connections))
+
+    def _name(self, key):
+        return self.namespace + _short_key(key)
+
+    def _pool(self, name):
+        """
+        the threads for keys (of get_many / set_many) or for the parts of
+        one value.  Keys wait for their parts, they can't share threads.
+        """
+        with self._lock:
+            if name not in self._executors:
+                self._executors[name] = _futures.ThreadPoolExecutor(
+                    self.max_concurrency)
+            return self._executors[name]
+
+    @staticmethod
+    def _metadata(value, ttl):
+        metadata = {'timesig': repr(value.timesig)}
+        if ttl is not None:
+            metadata['expires'] = repr(_time.time() + ttl)
+        return metadata
+
+    @staticmethod
+    def _expired(metadata):
+        expires = metadata.get('expires')
+        return expires is not None and float(expires) <= _time.time()
+
+    def get(self, key, default=None):
+        name = self._name(key)
+        try:
+            # the first part is all of the value, unless it is a large one
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=name,
+                Range='bytes=0-%d' % (self.part_size - 1))
+        except self.client.exceptions.NoSuchKey:
+            return default
+        if self._expired(response.get('Metadata', {})):
+            response['Body'].close()
+            return default
+        data = response['Body'].read()
+        size = int(response['ContentRange'].rpartition('/')[2])
+        if size > len(data):
+            data = self._get_rest(name, data, size)
+        return _load_entry(self.serializer, data)
+
+    def _get_rest(self, name, first, size):
+        """ the rest of a large object, fetched part by part in parallel """
+        def get_range(start):
+            end = min(start + self.part_size, size) - 1
+            return self.client.get_object(
+                Bucket=self.bucket, Key=name,
+                Range='bytes=%d-%d' % (start, end))['Body'].read()
+        parts = self._pool('parts').map(
+            get_range, range(len(first), size, self.part_size))
+        return b''.join([first] + list(parts))
+
+    def __contains__(self, key):
+        try:
+            response = self.client.head_object(
+                Bucket=self.bucket, Key=self._name(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return not self._expired(response.get('Metadata', {}))
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        data = _dump_entry(self.serializer, value)
+        metadata = self._metadata(value, ttl)
+        if len(data) > self.multipart_threshold:
+            from boto3.s3.transfer import TransferConfig
+            # boto3's transfer manager uploads the parts in parallel
+            self.client.upload_fileobj(
+                _io.BytesIO(data), self.bucket, self._name(key),
+                ExtraArgs={'Metadata': metadata},
+                Config=TransferConfig(
+                    multipart_threshold=self.multipart_threshold,
+                    multipart_chunksize=self.part_size,
+                    max_concurrency=self.max_concurrency))
+        else:
+            self.client.put_object(Bucket=self.bucket, Key=self._name(key),
+                                   Body=data, Metadata=metadata)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        # S3 doesn't say whether there was anything to delete
+        self.client.delete_object(Bucket=self.bucket, Key=self._name(key))
+
+    def get_many(self, keys):
+        keys = list(keys)
+        values = self._pool('keys').map(
+            lambda key: self.get(key, _MISSING), keys)
+        return dict((key, value) for key, value in zip(keys, values)
+                    if value is not _MISSING)
+
+    def set_many(self, values, ttl=None):
+        # list() waits for the writes and raises their errors
+        list(self._pool('keys').map(
+            lambda item: self.set(item[0], item[1], ttl), values.items()))
+
+    def _entries(self, prefix=None, sizes=False):
+        """
+        yield an _entry_info for every object whose key starts with prefix.
+        S3 doesn't track reads, objects count as accessed when written.
+        """
+        if _hashed_prefix(prefix):
+            return
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=self.namespace + (prefix or '')):
+            for item in page.get('Contents', ()):
+                written = _calendar.timegm(item['LastModified'].utctimetuple())
+                yield _entry_info(item['Key'], written, written, 0,
+                                  item['Size'])
+
+    def _remove(self, handle):
+        self.client.delete_object(Bucket=self.bucket, Key=handle)
+
+    def close(self):
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors = dict()
+        for executor in executors:
+            executor.shutdown()
+
+
+class _S3PoolBackend(object):
+
+    """ the old S3Backend(s3pool), a wrapper around an s3pool """
+
+    def __init__(self, s3pool):
+        _warnings.warn(
+            'S3Backend(s3pool) is deprecated and will be removed in the next '
+            'release, use S3Backend(bucket, client=..., prefix=...) instead',
+            DeprecationWarning, stacklevel=3)
+        self.s3pool = s3pool
+
+    def setup(self, function):
+        self.data_set = _get_cache_name(function)
+
+    def __contains__(self, key):
+        return bool(self.s3pool.list(self.data_set, key))
+
+    def __getitem__(self, key):
+        return self.s3pool.get_contents_as_string(self.data_set, key)
+
+    def __setitem__(self, key, value):
+        return self.s3pool.set_contents_from_string(self.data_set, key, value)
+
+
+class SqliteBackend(object):
+
+    """
+    store cache data in an sqlite database next to the ShelveBackend's file.
+    The database is in WAL mode, so many processes (e.g. gunicorn workers)
+    can read while one writes, and concurrent writers wait for each other
+    instead of corrupting the file.
+
+    Each write (a set, or all the entries of a set_many) is a transaction
+    of its own, begun with BEGIN IMMEDIATE and committed right away, so the
+    write lock is only held while it runs.  In WAL mode with synchronous
+    NORMAL a commit doesn't wait for the disk.
+    """
+
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS functioncache ('
+        ' digest TEXT PRIMARY KEY,'
+        ' function TEXT NOT NULL,'
+        ' timesig REAL NOT NULL,'
+        ' expires REAL,'
+        ' value BLOB NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS functioncache_expires'
+        ' ON functioncache (expires)',
+        'CREATE INDEX IF NOT EXISTS functioncache_function'
+        ' ON functioncache (function, timesig)',
+    )
+
+    # None pickles the values with the highest protocol
+    serializer = None
+
+    def __init__(self, timeout=30.0):
+        self.timeout = timeout
+
+    def setup(self, function):
+        self.setup_path(_get_cache_name(function) + '.sqlite')
+
+    def setup_path(self, path):
+        self.path = path
+        self._lock = _threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        # connections mustn't be shared with forked children, they get
+        # their own
+        if self._pid != _os.getpid():
+            # transactions are begun explicitly, see _write
+            self._connection = _sqlite3.connect(
+                self.path, timeout=self.timeout, check_same_thread=False,
+                isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in self._SCHEMA:
+                self._connection.execute(statement)
+            self._pid = _os.getpid()
+        return self._connection
+
+    def _write(self, query, params=(), many=False):
+        """
+        run a statement (for each of params if many) in a transaction of
+        its own, returns its cursor
+        """
+        with self._lock:
+            db = self._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = (db.executemany if many else db.execute)(
+                    query, params)
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        return cursor
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._db().execute(
+                'SELECT timesig, value FROM functioncache WHERE digest = ?',
+                (_short_key(key),)).fetchone()
+        if row is None:
+            return default
+        return _retval(row[0], _loads(row[1]) if self.serializer is None
+                       else self.serializer.loads(row[1]))
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self._db().execute(
+                'SELECT 1 FROM functioncache WHERE digest = ?',
+                (_short_key(key),)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def get_many(self, keys):
+        digests = dict((_short_key(key), key) for key in keys)
+        loads = _loads if self.serializer is None else self.serializer.loads
+        found = dict()
+        digest_list = list(digests)
+        with self._lock:
+            # stay below sqlite's limit on the number of parameters
+            for i in range(0, len(digest_list), 500):
+                chunk = digest_list[i:i + 500]
+                rows = self._db().execute(
+                    'SELECT digest, timesig, value FROM functioncache'
+                    ' WHERE digest IN (%s)' % ','.join('?' * len(chunk)),
+                    chunk).fetchall()
+                for digest, timesig, blob in rows:
+                    found[digests[digest]] = _retval(timesig, loads(blob))
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, values, ttl=None):
+        rows = []
+        for key, value in values.items():
+            try:
+                blob = _pickle.dumps(value.data, _pickle.HIGHEST_PROTOCOL) \
+                    if self.serializer is None \
+                    else self.serializer.dumps(value.data)
+            except TypeError as e:
+                raise PicklingError(str(e))
+            expires = None if ttl is None else value.timesig + ttl
+            rows.append((_short_key(key), _key_function(key), value.timesig,
+                         expires, _sqlite3.Binary(blob)))
+        self._write('INSERT OR REPLACE INTO functioncache'
+                    ' (digest, function, timesig, expires, value)'
+                    ' VALUES (?, ?, ?, ?, ?)', rows, many=True)
+
+    def __delitem__(self, key):
+        cursor = self._write('DELETE FROM functioncache WHERE digest = ?',
+                             (_short_key(key),))
+        if not cursor.rowcount:
+            raise KeyError(key)
+
+    def close(self):
+        with self._lock:
+            if self._pid == _os.getpid():
+                self._connection.close()
+            self._pid = None
+
+    def expire(self):
+        """ delete every entry past its expiry, returns how many there were """
+        return self._write('DELETE FROM functioncache WHERE expires < ?',
+                           (_time.time(),)).rowcount
+
+    def _sweep(self, max_age, prefix=None):
+        query = 'DELETE FROM functioncache WHERE timesig < ?'
+        params = (_time.time() - max_age,)
+        if prefix is not None:
+            query += ' AND function = ?'
+            params += (_key_function(prefix),)
+        return self._write(query, params).rowcount
+
+    def _entries(self, prefix=None, sizes=False):
+        query = 'SELECT digest, timesig, length(value) FROM functioncache'
+        params = ()
+        if prefix is not None:
+            query += ' WHERE function = ?'
+            params = (_key_function(prefix),)
+        with self._lock:
+            rows = self._db().execute(query, params).fetchall()
+        # sqlite doesn't know about reads, entries count as accessed when
+        # they were written
+        for digest, timesig, size in rows:
+            yield _entry_info(digest, timesig, timesig, 0, size)
+
+    def _remove(self, handle):
+        self._write('DELETE FROM functioncache WHERE digest = ?', (handle,))
+
+
+# LogBackend's records: crc32 of the rest of the record, timesig, expiry
+# (0 for never), lengths of the key and the value, then the key and the
+# value.  Deleted keys get a record whose value length is _LOG_TOMBSTONE.
+_LOG_HEADER = _struct.Struct('<IddII')
+# hint records: timesig, expiry, offset of the value, key and value lengths,
+# then the key
+_LOG_HINT = _struct.Struct('<ddQII')
+_LOG_TOMBSTONE = 0xFFFFFFFF
+
+# where the latest value of a key is
+_LogPointer = _collections.namedtuple(
+    '_LogPointer', 'segment offset length timesig expires')
+
+
+class LogLockedError(IOError):
+
+    """ a LogBackend directory is in use by another LogBackend """
+
+
+class LogBackend(object):
+
+    """
+    store cache data Bitcask style, for millions of small entries.  Records
+    are appended to segment files in a directory next to the ShelveBackend's
+    file and an in-memory index maps every key to its latest value, so a
+    read is one pread and writes are sequential.
+
+    Once the active segment reaches segment_bytes it is closed with a hint
+    file listing its keys and offsets, from which the index is rebuilt at
+    startup without reading values.  When over compact_ratio of the closed
+    segments' bytes are overwritten or deleted records, a background thread
+    rewrites them without those and without expired records.  sync=True
+    fsyncs every write.  Only one LogBackend at a time may use a directory:
+    it is locked until closed, and opening it again raises LogLockedError.
+    """
+
+    # None pickles the values with the highest protocol
+    serializer = None
+
+    def __init__(self, segment_bytes=64 * 1024 * 1024, compact_ratio=0.5,
+                 sync=False):
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        self.sync = sync
+
+    def setup(self, function):
+        self.setup_path(_get_cache_name(function) + '.log')
+
+    def setup_path(self, path):
+        self.path = path
+        _mkdir_p(path)
+        self._lock_directory()
+        self._lock = _threading.RLock()
+        self._compact_lock = _threading.Lock()
+        self._compaction = None
+        self._index = dict()
+        self._readers = dict()
+        self._sizes = dict()
+        self._dead = dict()
+        for name in _os.listdir(path):
+            # left by a crash while writing a hint or compacting
+            if name.startswith('.tmp-'):
+                _os.remove(_os.path.join(path, name))
+        segments = self._segment_ids()
+        for segment in segments:
+            self._load(segment)
+        self._open_active(segments[-1] + 1 if segments else 0)
+
+    def _lock_directory(self):
+        """
+        take the directory's lock, held until close.  Two writers would
+        append to the same segment and overwrite each other's hints, and
+        one would delete the other's compaction files.
+        """
+        self._lock_file = _os.open(_os.path.join(self.path, 'LOCK'),
+                                   _os.O_WRONLY | _os.O_CREAT, 0o644)
+        if _fcntl is None:
+            return
+        try:
+            _fcntl.flock(self._lock_file, _fcntl.LOCK_EX | _fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            _os.close(self._lock_file)
+            if e.errno in (_errno.EAGAIN, _errno.EACCES, _errno.EWOULDBLOCK):
+                raise LogLockedError('%s is in use by another LogBackend'
+                                     % self.path)
+            raise
+
+    def _name(self, segment, suffix='.data'):
+        return _os.path.join(self.path, '%08d%s' % (segment, suffix))
+
+    def _segment_ids(self):
+        return sorted(int(name[:-len('.data')])
+                      for name in _os.listdir(self.path)
+                      if name.endswith('.data'))
+
+    def _open_active(self, segment):
+        name = self._name(segment)
+        self._active = segment
+        self._active_hints = []
+        self._writer = _os.open(
+            name, _os.O_WRONLY | _os.O_CREAT | _os.O_APPEND, 0o644)
+        self._readers[segment] = _os.open(name, _os.O_RDONLY)
+        self._sizes[segment] = _os.fstat(self._writer).st_size
+        self._dead[segment] = 0
+
+    def _load(self, segment):
+        """ add a closed segment to the index, from its hint if it has one """
+        try:
+            with open(self._name(segment, '.hint'), 'rb') as hint_file:
+                hints = list(self._read_hints(hint_file.read()))
+        except (IOError, OSError, _struct.error):
+            hints = self._scan(segment)
+            if not hints:
+                _os.remove(self._name(segment))
+                return
+            self._write_hints(segment, hints)
+        self._readers[segment] = _os.open(self._name(segment), _os.O_RDONLY)
+        self._sizes[segment] = _os.fstat(self._readers[segment]).st_size
+        self._dead[segment] = 0
+        for key, timesig, expires, offset, length in hints:
+            if length == _LOG_TOMBSTONE:
+                self._index_put(key, None)
+                self._dead[segment] += self._record_size(key, 0)
+            else:
+                self._index_put(key, _LogPointer(segment, offset, length,
+                                                 timesig, expires))
+
+    def _scan(self, segment):
+        """
+        the hints of the records of a segment without a hint file.  A
+        record cut short by a crash ends the segment and is truncated.
+        """
+        with open(self._name(segment), 'r+b') as segment_file:
+            data = segment_file.read()
+            hints = []
+            offset = 0
+            while offset + _LOG_HEADER.size <= len(data):
+                crc, timesig, expires, key_length, length = \
+                    _LOG_HEADER.unpack_from(data, offset)
+                start = offset + _LOG_HEADER.size
+                end = start + key_length + (
+                    0 if length == _LOG_TOMBSTONE else length)
+                if end > len(data) or crc != _zlib.crc32(
+                        data[offset + 4:end]) & 0xffffffff:
+                    break
+                key = data[start:start + key_length].decode('utf-8')
+                hints.append((key, timesig, expires, start + key_length,
+                              length))
+                offset = end
+            if offset < len(data):
+                segment_file.truncate(offset)
+        return hints
+
+    @staticmethod
+    def _read_hints(data):
+        offset = 0
+        while offset < len(data):
+            timesig, expires, value_offset, key_length, length = \
+                _LOG_HINT.unpack_from(data, offset)
+            offset += _LOG_HINT.size
+            yield (data[offset:offset + key_length].decode('utf-8'),
+                   timesig, expires, value_offset, length)
+            offset += key_length
+
+    def _write_hints(self, segment, hints):
+        parts = []
+        for key, timesig, expires, offset, length in hints:
+            key = key.encode('utf-8')
+            parts.append(_LOG_HINT.pack(timesig, expires, offset, len(key),
+                                        length))
+            parts.append(key)
+        name = self._name(segment, '.hint')
+        fd, temp_name = _tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        with _os.fdopen(fd, 'wb') as hint_file:
+            hint_file.write(b''.join(parts))
+        _os.replace(temp_name, name)
+
+    @staticmethod
+    def _record_size(key, length):
+        return _LOG_HEADER.size + len(key.encode('utf-8')) + length
+
+    @staticmethod
+    def _record(key, timesig, expires, data):
+        key = key.encode('utf-8')
+        length = _LOG_TOMBSTONE if data is None else len(data)
+        rest = _LOG_HEADER.pack(0, timesig, expires, len(key), length)[4:] + \
+            key + (data or b'')
+        return _struct.pack('<I', _zlib.crc32(rest) & 0xffffffff) + rest
+
+    def _index_put(self, key, pointer):
+        """ point key at a new record, or forget it for pointer None """
+        old = self._index.pop(key, None)
+        if old is not None:
+            self._dead[old.segment] += self._record_size(key, old.length)
+        if pointer is not None:
+            self._index[key] = pointer
+
+    def _append(self, records):
+        """
+        write (key, timesig, expires, data) records to the active segment,
+        data None for deletions.  Called with the lock held.
+        """
+        offset = self._sizes[self._active]
+        parts = []
+        for key, timesig, expires, data in records:
+            record = self._record(key, timesig, expires, data)
+            value_offset = offset + len(record) - len(data or b'')
+            if data is None:
+                self._index_put(key, None)
+                self._dead[self._active] += len(record)
+                self._active_hints.append(
+                    (key, timesig, expires, value_offset, _LOG_TOMBSTONE))
+            else:
+                self._index_put(key, _LogPointer(
+                    self._active, value_offset, len(data), timesig, expires))
+                self._active_hints.append(
+                    (key, timesig, expires, value_offset, len(data)))
+            parts.append(record)
+            offset += len(record)
+        view = memoryview(b''.join(parts))
+        while view:
+            view = view[_os.write(self._writer, view):]
+        if self.sync:
+            _os.fsync(self._writer)
+        self._sizes[self._active] = offset
+        if offset >= self.segment_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """ close the active segment and start the next one """
+        _os.close(self._writer)
+        self._write_hints(self._active, self._active_hints)
+        self._open_active(self._active + 1)
+        closed = [segment for segment in self._sizes
+                  if segment != self._active]
+        total = sum(self._sizes[segment] for segment in closed)
+        dead = sum(self._dead[segment] for segment in closed)
+        if total and float(dead) / total > self.compact_ratio and (
+                self._compaction is None or
+                not self._compaction.is_alive()):
+            self._compaction = _threading.Thread(target=self._compact_safely)
+            self._compaction.daemon = True
+            self._compaction.start()
+
+    def _compact_safely(self):
+        try:
+            self.compact()
+        except Exception:
+            _log_error(_traceback.format_exc())
+
+    def _encode(self, value):
+        if self.serializer is None:
+            return _pickle.dumps(value.data, _pickle.HIGHEST_PROTOCOL)
+        return self.serializer.dumps(value.data)
+
+    def _decode(self, data):
+        if self.serializer is None:
+            return _loads(data)
+        return self.serializer.loads(data)
+
+    def get(self, key, default=None):
+        key = _short_key(key)
+        with self._lock:
+            pointer = self._index.get(key)
+            if pointer is None or (
+                    pointer.expires and pointer.expires <= _time.time()):
+                return default
+            data = _os.pread(self._readers[pointer.segment], pointer.length,
+                             pointer.offset)
+        return _retval(pointer.timesig, self._decode(data))
+
+    def get_many(self, keys):
+        found = dict()
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, values, ttl=None):
+        expires = 0.0 if ttl is None else _time.time() + ttl
+        records = [(_short_key(key), value.timesig, expires,
+                    self._encode(value)) for key, value in values.items()]
+        with self._lock:
+            self._append(records)
+
+    def __delitem__(self, key):
+        key = _short_key(key)
+        with self._lock:
+            if key not in self._index:
+                raise KeyError(key)
+            self._append([(key, _time.time(), 0.0, None)])
+
+    def compact(self):
+        """
+        rewrite the closed segments, keeping only the latest unexpired
+        record of each key.  Returns how many bytes were reclaimed.
+        """
+        with self._compact_lock:
+            with self._lock:
+                segments = sorted(segment for segment in self._sizes
+                                  if segment != self._active)
+                closed = set(segments)
+                now = _time.time()
+                live = []
+                expired = []
+                for key, pointer in self._index.items():
+                    if pointer.segment not in closed:
+                        continue
+                    if pointer.expires and pointer.expires <= now:
+                        expired.append((key, pointer))
+                    else:
+                        live.append((key, pointer))
+                live.sort(key=lambda item: (item[1].segment, item[1].offset))
+                before = sum(self._sizes[segment] for segment in segments)
+            if not segments:
+                return 0
+
+            # the live records are copied into new segments taking the ids
+            # of the first old ones, so records keep their order
+            outputs = []
+            moved = []
+            output = None
+            for key, pointer in live:
+                if output is None or (output[2] >= self.segment_bytes and
+                                      len(outputs) < len(segments)):
+                    if output is not None:
+                        output[1].close()
+                    fd, temp_name = _tempfile.mkstemp(
+                        dir=self.path, prefix='.tmp-')
+                    output = [temp_name, _os.fdopen(fd, 'wb'), 0, []]
+                    outputs.append(output)
+                segment = segments[len(outputs) - 1]
+                data = _os.pread(self._readers[pointer.segment],
+                                 pointer.length, pointer.offset)
+                record = self._record(key, pointer.timesig, pointer.expires,
+                                      data)
+                output[1].write(record)
+                value_offset = output[2] + len(record) - len(data)
+                output[3].append((key, pointer.timesig, pointer.expires,
+                                  value_offset, len(data)))
+                moved.append((key, pointer, _LogPointer(
+                    segment, value_offset, len(data), pointer.timesig,
+                    pointer.expires)))
+                output[2] += len(record)
+            if output is not None:
+                output[1].close()
+
+            with self._lock:
+                for i, segment in enumerate(segments):
+                    _os.close(self._readers.pop(segment))
+                    del self._sizes[segment]
+                    del self._dead[segment]
+                    # without its hint a segment is scanned at startup, the
+                    # hint mustn't describe the old data
+                    try:
+                        _os.remove(self._name(segment, '.hint'))
+                    except OSError:
+                        pass
+                    if i >= len(outputs):
+                        _os.remove(self._name(segment))
+                        continue
+                    temp_name, _, size, hints = outputs[i]
+                    _os.replace(temp_name, self._name(segment))
+                    self._write_hints(segment, hints)
+                    self._readers[segment] = _os.open(
+                        self._name(segment), _os.O_RDONLY)
+                    self._sizes[segment] = size
+                    self._dead[segment] = 0
+                for key, old, new in moved:
+                    if self._index.get(key) == old:
+                        self._index[key] = new
+                    else:
+                        # overwritten or deleted while compacting
+                        self._dead[new.segment] += self._record_size(
+                            key, new.length)
+                for key, pointer in expired:
+                    if self._index.get(key) == pointer:
+                        del self._index[key]
+                after = sum(self._sizes[segment] for segment in segments
+                            if segment in self._sizes)
+        return before - after
+
+    def _entries(self, prefix=None, sizes=False):
+        """
+        yield an _entry_info for every entry whose key starts with prefix.
+        Reads aren't tracked, entries count as accessed when written.
+        """
+        if _hashed_prefix(prefix):
+            return
+        with self._lock:
+            items = list(self._index.items())
+        for key, pointer in items:
+            if prefix is None or key.startswith(prefix):
+                yield _entry_info(key, pointer.timesig, pointer.timesig, 0,
+                                  pointer.length)
+
+    def _remove(self, handle):
+        try:
+            del self[handle]
+        except KeyError:
+            pass
+
+    def flush(self):
+        """ make the writes so far durable """
+        with self._lock:
+            _os.fsync(self._writer)
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.join()
+        with self._lock:
+            _os.close(self._writer)
+            # the active segment is closed too, with a hint for next time
+            if self._sizes[self._active]:
+                self._write_hints(self._active, self._active_hints)
+            else:
+                _os.remove(self._name(self._active))
+            for reader in self._readers.values():
+                _os.close(reader)
+            self._readers = dict()
+            # releases the directory's lock
+            _os.close(self._lock_file)
+
+
+_DIGEST_SUFFIX = _re.compile(r'-(?:[0-9a-f]{40})?$')
+
+
+def _key_function(key):
+    """
+    the function_key part of a key (or a _key_prefix) made with
+    digest_arguments or pickle_arguments
+    """
+    match = _DIGEST_SUFFIX.search(key)
+    if match is not None:
+        return key[:match.start()]
+    return key.partition('(')[0]
+
+
+def sweep(db, max_age, prefix=None):
+    """
+    delete the entries of a backend which were written more than max_age
+    seconds ago and whose keys start with prefix.  Returns how many entries
+    were deleted.
+    """
+    if hasattr(db, '_sweep'):
+        return db._sweep(max_age, prefix)
+    now = _time.time()
+    removed = 0
+    for entry in list(db._entries(prefix)):
+        if now - entry.written >= max_age:
+            db._remove(entry.handle)
+            removed += 1
+    return removed
+
+
+def evict(db, max_entries=None, max_bytes=None, policy=LRU, prefix=None):
+    """
+    delete least recently (LRU) or least frequently (LFU) used entries whose
+    keys start with prefix until at most max_entries entries taking at most
+    max_bytes remain.  Returns how many entries were deleted.
+    """
+    entries = list(db._entries(prefix, sizes=max_bytes is not None))
+    if policy == LFU:
+        entries.sort(key=lambda entry: (entry.hits, entry.accessed))
+    elif policy == LRU:
+        entries.sort(key=lambda entry: entry.accessed)
+    else:
+        raise ValueError('unknown eviction policy %r' % (policy,))
+
+    count = len(entries)
+    total = sum(entry.size for entry in entries)
+    removed = 0
+    for entry in entries:
+        if (max_entries is None or count <= max_entries) and \
+                (max_bytes is None or total <= max_bytes):
+            break
+        db._remove(entry.handle)
+        count -= 1
+        total -= entry.size
+        removed += 1
+    return removed
+
+
+def _key_prefix(function):
+    """
+    the prefix shared by every key of function, or None if the key builder
+    doesn't allow telling the keys of different functions apart.
+    """
+    if function._key_builder is digest_arguments:
+        return function._function_key(function) + '-'
+    if function._key_builder is pickle_arguments:
+        # a pickled tuple always starts with the MARK opcode
+        return function._function_key(function) + '('
+    return None
+
+
+def _drop_old_versions(db, function):
+    """
+    delete the entries of earlier versions of a function keyed by
+    function_fingerprint(_deep).  Returns how many entries were deleted.
+    """
+    current = function._function_key(function)
+    old = _re.compile(_re.escape(current.rpartition('.')[0]) +
+                      r'\.[0-9a-f]{16}$')
+    removed = 0
+    # the versions' keys share no prefix every backend can list
+    for entry in list(db._entries()):
+        version = _key_function(_os.path.basename(entry.handle))
+        if version != current and old.match(version):
+            db._remove(entry.handle)
+            removed += 1
+    return removed
+
+
+def _maintain(function):
+    """
+    drop the expired entries of function and enforce its size bounds.  The
+    first run also drops the entries of earlier versions of the function.
+    """
+    try:
+        db = function._db
+        if function._old_versions:
+            _drop_old_versions(db, function)
+            function._old_versions = False
+        prefix = _key_prefix(function)
+        if prefix is None:
+            return
+        if function._seconds_of_validity is not None:
+            sweep(db, _retention(function), prefix)
+        if function._max_entries is not None or \
+                function._max_bytes is not None:
+            evict(db, function._max_entries, function._max_bytes,
+                  function._eviction, prefix)
+        if hasattr(db, 'collect'):
+            db.collect()
+    except Exception:
+        _log_error(_traceback.format_exc())
+
+
+class _Sweeper(object):
+
+    """
+    amortizes cache maintenance: once every `every` writes, _maintain runs
+    in a background thread, unless the previous run is still going.
+    """
+
+    def __init__(self, every):
+        self.every = every
+        self.writes = 0
+        self.thread = None
+        self.lock = _threading.Lock()
+
+    def wrote(self, function):
+        with self.lock:
+            self.writes += 1
+            if self.writes < self.every or (
+                    self.thread is not None and self.thread.is_alive()):
+                return
+            self.writes = 0
+            self.thread = _threading.Thread(target=_maintain, args=(function,))
+            self.thread.daemon = True
+            self.thread.start()
+
+
+class SkipCache(Exception):
+
+    """
+    Sometimes something goes wrong (e.g. communication with a server times out), and your function wants to return a
+    "fail gracefully" fallback value, but you don't want it cached. The SkipCache exception lets you do just that.
+    instead of doing:
+      return some_fallback_value
+    you do:
+      raise SkipCache,"Server timeout",some_fallback_value
+    The caller of your function will get the value, but it won't get cached.
+    The error text ("Server timeout") will appear in functioncache's log.
+    """
+
+    def __init__(self, message, retval=None):
+        Exception.__init__(self, message)
+        self.retval = retval
+
+
+class _Flight(object):
+
+    """ a computation in progress which other callers can wait on """
+
+    def __init__(self):
+        self.done = _threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _db_get(db, key):
+    """
+    fetch key from a backend, in a single lookup for backends which have a
+    get method.  Returns _MISSING if the key isn't there.
+    """
+    get = getattr(db, 'get', None)
+    if get is not None:
+        return get(key, _MISSING)
+    if key in db:
+        return db[key]
+    return _MISSING
+
+
+def _backend_set(db, key, value, ttl):
+    """
+    store value under key.  Backends with a set method are told how long the
+    value stays valid (None for forever) so they can expire it themselves.
+    """
+    set_ = getattr(db, 'set', None)
+    if set_ is not None:
+        set_(key, value, ttl)
+    else:
+        db[key] = value
+
+
+def _db_get_many(db, keys):
+    """
+    fetch many keys from a backend, in bulk for backends which have a
+    get_many method.  Returns a dict of the keys which were found.
+    """
+    get_many = getattr(db, 'get_many', None)
+    if get_many is not None:
+        return get_many(keys)
+    found = dict()
+    for key in keys:
+        value = _db_get(db, key)
+        if value is not _MISSING:
+            found[key] = value
+    return found
+
+
+def _backend_set_many(db, values, ttl):
+    """ store a dict of values, in bulk for backends with set_many """
+    set_many = getattr(db, 'set_many', None)
+    if set_many is not None:
+        set_many(values, ttl)
+    else:
+        for key, value in values.items():
+            _backend_set(db, key, value, ttl)
+
+
+def _retention(function):
+    """ how long entries of function are kept, stale ones included """
+    if function._seconds_of_validity is None:
+        return None
+    return function._seconds_of_validity + (function._stale_ttl or 0)
+
+
+def _validity(function, data):
+    """ how long an entry holding data stays valid """
+    if type(data) is _Negative:
+        return function._negative_ttl
+    return function._seconds_of_validity
+
+
+def _result(data):
+    """
+    what a call returning the cached data returns: negative results are
+    unwrapped and cached exceptions raised again.
+    """
+    if type(data) is not _Negative:
+        return data
+    if data.raised:
+        # without the traceback of the last caller it was raised to
+        raise data.value.with_traceback(None)
+    return data.value
+
+
+def _lookup(function, key, record=True, stale=False):
+    """
+    return the cached _retval for key if it is still valid (or, if stale is
+    set, within its stale_ttl), else None.  Unless told not to, record the
+    outcome in the function's stats.
+    """
+    start = _timer()
+    rv = _db_get(function._db, key)
+    if record:
+        stats = function._stats
+        stats.record('read_seconds', _timer() - start)
+    if rv is not _MISSING:
+        negative = type(rv.data) is _Negative
+        validity = _validity(function, rv.data)
+        age = _time.time() - rv.timesig
+        if validity is None or age < validity:
+            if record:
+                stats.record('hits')
+                if negative:
+                    stats.record('negative')
+            return rv
+        # negative entries are never served stale
+        if stale and function._stale_ttl and not negative and \
+                age < _retention(function):
+            if record:
+                stats.record('hits')
+                stats.record('stale')
+            return rv
+        if record:
+            stats.record('expired')
+    if record:
+        stats.record('misses')
+    return None
+
+
+def _store(function, key, value):
+    """ cache value (maybe a _Negative) as the result for key """
+    start = _timer()
+    if type(value) is _Negative:
+        ttl = function._negative_ttl
+    else:
+        ttl = _retention(function)
+    _backend_set(function._db, key, _retval(_time.time(), value), ttl)
+    stats = function._stats
+    stats.record('write_seconds', _timer() - start)
+    stats.record('bytes_stored', _approx_size(value))
+    if function._sweeper is not None:
+        function._sweeper.wrote(function)
+
+
+def _copy_backend(backend, deep=True):
+    """
+    a copy of backend sharing no state with it: backends rebuild theirs in
+    _fresh(), and unless deep is False the backends it wraps are copied too
+    """
+    backend = _copy.copy(backend)
+    if hasattr(backend, '_fresh'):
+        backend._fresh()
+    inner = getattr(backend, 'backend', None)
+    if deep and inner is not None:
+        backend.backend = _copy_backend(inner)
+    return backend
+
+
+def _with_serializer(backend, serializer):
+    """ a copy of backend storing its entries, or its wrapped backend's, with
+    serializer """
+    if getattr(backend, 'zero_copy', False):
+        raise ValueError('zero_copy files are always pickled')
+    backend = _copy_backend(backend, deep=False)
+    inner = getattr(backend, 'backend', None)
+    if inner is not None:
+        backend.backend = _with_serializer(inner, serializer)
+    elif hasattr(backend, 'serializer'):
+        backend.serializer = serializer
+    else:
+        raise ValueError('%s keeps values as they are, it takes no serializer'
+                         % type(backend).__name__)
+    return backend
+
+
+def _backend_kind(backend):
+    """
+    the type of a backend, including the types of the backends it wraps.
+    Functions in the same file whose backends are of the same kind share
+    one open backend.
+    """
+    inner = getattr(backend, 'backend', None)
+    if inner is not None:
+        return (type(backend), _backend_kind(inner))
+    kind = type(backend)
+    if getattr(backend, 'zero_copy', False):
+        # hits are read-only views, don't hand them to other functions
+        kind = (kind, 'zero_copy')
+    serializer = getattr(backend, 'serializer', None)
+    if serializer is not None and serializer is not type(backend).serializer:
+        kind = (kind, serializer)
+    return kind
+
+
+# the types of the attributes that are a backend's settings, see _settings
+_SETTING_TYPES = (type(None), bool, int, float, str, bytes, tuple)
+
+
+def _in_module_file(backend):
+    """ whether backend (or the one it wraps) keeps its data in the module's
+    cache file or directory """
+    while getattr(backend, 'backend', None) is not None:
+        backend = backend.backend
+    return hasattr(backend, 'setup_path')
+
+
+def _settings(backend):
+    """ the settings a backend not yet opened was made with, and those of the
+    backends it wraps """
+    settings = tuple(sorted(
+        (name, value) for name, value in vars(backend).items()
+        if not name.startswith('_') and isinstance(value, _SETTING_TYPES)))
+    inner = getattr(backend, 'backend', None)
+    if inner is not None:
+        settings += (_settings(inner),)
+    return settings
+
+
+def _namespace(function, backend, shared):
+    """
+    the key of the backend of function in OPEN_DBS.  Functions of the same
+    module given the same kind of backend share a namespace if it is a class
+    or keeps its data in the module's cache file, which mustn't be opened
+    twice.  Other instances are only shared by the functions they were
+    given to.
+    """
+    namespace = (_inspect.getfile(function), _backend_kind(backend))
+    if not shared and not _in_module_file(backend):
+        namespace += (id(backend),)
+    return namespace
+
+
+def _register(function, backend, shared):
+    """ the namespace of function and its (not yet opened) backend """
+    namespace = _namespace(function, backend, shared)
+    with _OPEN_LOCK:
+        registered = _BACKENDS.get(namespace)
+        if registered is None:
+            if any(db is backend for db in _BACKENDS.values()):
+                # given to functions of another module too, whose files
+                # are elsewhere
+                backend = _copy_backend(backend)
+            _BACKENDS[namespace] = backend
+            _BACKEND_SETTINGS[namespace] = _settings(backend)
+            # weak, so functions defined on the fly can be collected, see
+            # _forget
+            _NAMESPACE_FUNCTIONS[namespace] = _weakref.WeakSet()
+        elif registered is not backend and not shared and \
+                _settings(backend) != _BACKEND_SETTINGS[namespace]:
+            _warnings.warn(
+                '%s: the functions of %s share one %s, the settings of the '
+                'one given to it are ignored' % (
+                    function.__qualname__, namespace[0],
+                    type(backend).__name__), RuntimeWarning, stacklevel=3)
+        _NAMESPACE_FUNCTIONS[namespace].add(function)
+        return namespace, _BACKENDS[namespace]
+
+
+def _forget(namespace, stats):
+    """
+    called when a decorated function is garbage collected: drop its stats,
+    and its namespace, closing the backend, if no function uses it anymore
+    """
+    with _OPEN_LOCK:
+        group = _STATS_REGISTRY.get(namespace, [])
+        if stats in group:
+            group.remove(stats)
+        if not group:
+            _STATS_REGISTRY.pop(namespace, None)
+        functions = _NAMESPACE_FUNCTIONS.get(namespace)
+        if functions is None or list(functions):
+            return
+        del _NAMESPACE_FUNCTIONS[namespace]
+        del _BACKENDS[namespace]
+        del _BACKEND_SETTINGS[namespace]
+        db = OPEN_DBS.pop(namespace, None)
+    if hasattr(db, 'close'):
+        db.close()
+
+
+def _open(function):
+    """ open the backend of function unless it is, return it """
+    namespace = function._namespace
+    if namespace is None:
+        return function._db
+    with _OPEN_LOCK:
+        db = OPEN_DBS.get(namespace)
+        if db is None:
+            db = _BACKENDS[namespace]
+            db.setup(function)
+            OPEN_DBS[namespace] = db
+        if function._track_access:
+            db.track_access = True
+        _point_at(function, db, _async_backend(db)
+                  if _inspect.iscoroutinefunction(function) else None)
+    return db
+
+
+def _point_at(function, db, adb):
+    """
+    point function at db (and adb, its async view), as well as the decorated
+    function, whose attributes were copied from function when decorating
+    """
+    for target in (function, getattr(function, '_decorated', function)):
+        target._db = db
+        if adb is not None:
+            target._adb = adb
+
+
+def _flush(namespace):
+    db = OPEN_DBS.get(namespace)
+    if hasattr(db, 'flush'):
+        db.flush()
+
+
+def _close(namespace):
+    """ close the backend of a namespace, its functions open it when next
+    called """
+    with _OPEN_LOCK:
+        db = OPEN_DBS.pop(namespace, None)
+        if db is None:
+            return
+        for function in _NAMESPACE_FUNCTIONS[namespace]:
+            _point_at(function, _LazyBackend(function), _LazyBackend(
+                function, '_adb')
+                if _inspect.iscoroutinefunction(function) else None)
+        if hasattr(db, 'close'):
+            db.close()
+
+
+class _LazyBackend(object):
+
+    """
+    stands in for a function's backend (or its async view) until first
+    used, which opens the backend and puts it in the function in its place
+    """
+
+    def __init__(self, function, attribute='_db'):
+        self._function = function
+        self._attribute = attribute
+
+    def _open(self):
+        _open(self._function)
+        return getattr(self._function, self._attribute)
+
+    def __getattr__(self, name):
+        return getattr(self._open(), name)
+
+    def __contains__(self, key):
+        return key in self._open()
+
+    def __getitem__(self, key):
+        return self._open()[key]
+
+    def __setitem__(self, key, value):
+        self._open()[key] = value
+
+    def __delitem__(self, key):
+        del self._open()[key]
+
+    def __iter__(self):
+        return iter(self._open())
+
+    def __len__(self):
+        return len(self._open())
+
+
+def _store_negative(function, key, value, raised):
+    """
+    cache an exception of one of the cache_exceptions types, or a result the
+    negative predicate picked out, for negative_ttl seconds. an exception that
+    can't be stored is still the one raised to the caller, not the cache error.
+    """
+    if raised:
+        # stored without the traceback and the frames it holds on to, which
+        # are put back for the caller to re-raise it with
+        tb = value.__traceback__
+        value = value.with_traceback(None)
+    try:
+        _store(function, key, _Negative(value, raised))
+    except Exception:
+        _cache_error(function)
+        if not raised and not function._fail_silently:
+            raise
+    finally:
+        if raised:
+            value.with_traceback(tb)
+
+
+def _compute_and_store(function, key, args, kwargs):
+    try:
+        retval = function(*args, **kwargs)
+    # Log the error, return the value, don't cache it.
+    except SkipCache as e:
+        error_str = _traceback.format_exc()
+        _log_error(error_str)
+        return e.retval
+    except function._cache_exceptions as e:
+        if key is not None:
+            _store_negative(function, key, e, True)
+        raise
+
+    if key is None:
+        # the arguments couldn't be turned into a key, nothing to store
+        return retval
+
+    if function._negative is not None and function._negative(retval):
+        _store_negative(function, key, retval, False)
+        return retval
+
+    # store in cache
+    try:
+        _store(function, key, retval)
+    except:
+        # in any case of failure, don't let functioncache break the
+        # program
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    return retval
+
+
+def _compute_with_lease(function, key, args, kwargs):
+    """
+    backends shared between processes (e.g. FileBackend) may offer
+    acquire_lease/release_lease so only one process computes a missing key
+    while the others wait for its result to appear in the cache.
+    """
+    db = function._db
+    if not hasattr(db, 'acquire_lease'):
+        return _compute_and_store(function, key, args, kwargs)
+
+    deadline = _time.time() + function._lease_seconds
+    while True:
+        token = db.acquire_lease(key, function._lease_seconds)
+        if token is not None:
+            try:
+                # another process may have finished while we were waiting
+                rv = _lookup(function, key, record=False)
+                if rv is not None:
+                    return _result(rv.data)
+                return _compute_and_store(function, key, args, kwargs)
+            finally:
+                db.release_lease(key, token)
+
+        _time.sleep(_LEASE_POLL_SECONDS)
+        rv = _lookup(function, key, record=False)
+        if rv is not None:
+            return _result(rv.data)
+        if _time.time() > deadline:
+            # the lease holder is taking too long, stop waiting for it
+            return _compute_and_store(function, key, args, kwargs)
+
+
+def _single_flight(function, key, args, kwargs):
+    """
+    make sure only one thread computes key, the others wait for its result.
+    """
+    flight_key = (id(function._db), key)
+    with _FLIGHTS_LOCK:
+        flight = _FLIGHTS.get(flight_key)
+        leader = flight is None
+        if leader:
+            flight = _FLIGHTS[flight_key] = _Flight()
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _compute_with_lease(function, key, args, kwargs)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _FLIGHTS_LOCK:
+            del _FLIGHTS[flight_key]
+        flight.done.set()
+
+
+# separates the positional from the keyword arguments in _fast_key
+_KWD_MARK = object()
+
+
+def _fast_key(function, args, kwargs):
+    """
+    the arguments themselves as a key, like functools.lru_cache(typed=True)
+    makes them, or None if they aren't hashable.
+    """
+    key = (function._function_key(function),) + args
+    if kwargs:
+        items = tuple(sorted(kwargs.items()))
+        key += (_KWD_MARK,) + items
+        key += tuple(type(value) for _, value in items)
+    # 1, 1.0 and True are equal, but may give different results
+    key += tuple(map(type, args))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _call_key(function, args, kwargs):
+    start = _timer()
+    if function._ignore_instance:
+        args = args[1:]
+    key = None
+    if function._fast_keys:
+        key = _fast_key(function, args, kwargs)
+    if key is None:
+        key = _args_key(function, args, kwargs,
+                        function_key=function._function_key,
+                        key_builder=function._key_builder)
+    function._stats.record('key_seconds', _timer() - start)
+    return key
+
+
+def _refresh_due(function, rv):
+    """
+    whether the entry rv should be recomputed in the background: it is stale,
+    or will expire within refresh_ahead seconds.
+    """
+    validity = function._seconds_of_validity
+    # negative entries just expire, after negative_ttl
+    if validity is None or type(rv.data) is _Negative:
+        return False
+    age = _time.time() - rv.timesig
+    if age >= validity:
+        return True
+    return function._refresh_ahead is not None and \
+        age >= validity - function._refresh_ahead
+
+
+def _refresh_in_background(function, key, args, kwargs):
+    try:
+        _compute_with_lease(function, key, args, kwargs)
+    except Exception:
+        # the stale entry stays until it expires, the next hit retries
+        _log_error(_traceback.format_exc())
+    finally:
+        with _FLIGHTS_LOCK:
+            _REFRESHING.discard((id(function._db), key))
+
+
+def _refresh(function, key, args, kwargs):
+    """ recompute key in a background thread, unless that's already going """
+    refresh_key = (id(function._db), key)
+    with _FLIGHTS_LOCK:
+        if refresh_key in _REFRESHING:
+            return
+        _REFRESHING.add(refresh_key)
+    function._stats.record('refreshes')
+    thread = _threading.Thread(target=_refresh_in_background,
+                               args=(function, key, args, kwargs))
+    thread.daemon = True
+    thread.start()
+
+
+def function_with_cache(function, *args, **kwargs):
+    key = None
+    rv = None
+    try:
+        key = _call_key(function, args, kwargs)
+
+        rv = _lookup(function, key, stale=True)
+        if rv is not None and _refresh_due(function, rv):
+            _refresh(function, key, args, kwargs)
+    except:
+        # in any case of failure, don't let functioncache break the
+        # program
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    if rv is not None:
+        # outside the try, a cached exception isn't a cache error
+        return _result(rv.data)
+
+    if key is not None and function._single_flight:
+        return _single_flight(function, key, args, kwargs)
+
+    return _compute_and_store(function, key, args, kwargs)
+
+
+def _plain_positional(signature):
+    """
+    (number of parameters, defaults) if the signature only has plain
+    positional-or-keyword parameters, else None
+    """
+    parameters = list(signature.parameters.values())
+    if any(parameter.kind is not parameter.POSITIONAL_OR_KEYWORD
+           for parameter in parameters):
+        return None
+    return len(parameters), tuple(
+        parameter.default for parameter in parameters
+        if parameter.default is not parameter.empty)
+
+
+def _dict_cached(function):
+    """
+    the decorated version of a function with a DictBackend: fresh hits are
+    served without serializing, timing or the backend protocol, everything
+    else goes through function_with_cache.
+
+    It is called with the arguments as given (decorate's wrapper would bind
+    them, which is slow) and normalizes them itself, cheaply in the common
+    case of positional arguments to a plain signature.  Hits are counted
+    without the stats lock, unless there are stats hooks to call.
+    """
+    plain = function._plain_positional
+    if plain is not None:
+        size, defaults = plain
+        required = size - len(defaults)
+    ignore_instance = function._ignore_instance
+    function_key = function._function_key
+    refresh_ahead = function._refresh_ahead or 0
+    stats = function._stats
+    now = _time.time
+
+    def cached(*args, **kwargs):
+        count = len(args)
+        if kwargs or plain is None or not required <= count <= size:
+            args, kwargs = _bind(function, args, kwargs)
+        elif count < size:
+            args += defaults[count - size:]
+
+        if kwargs:
+            key = _fast_key(function, args[1:] if ignore_instance else args,
+                            kwargs)
+        else:
+            # _fast_key without keyword arguments
+            key_args = args[1:] if ignore_instance else args
+            key = (function_key(function),) + key_args + tuple(
+                map(type, key_args))
+        try:
+            entry = function._db.get(key)
+        except TypeError:
+            # unhashable arguments
+            entry = None
+        # negative entries, and ones due for a refresh, take the long way
+        if entry is not None and type(entry.data) is not _Negative:
+            validity = function._seconds_of_validity
+            if validity is None or \
+                    now() - entry.timesig < validity - refresh_ahead:
+                if _STATS_HOOKS:
+                    stats.record('hits')
+                else:
+                    stats.counters['hits'] += 1
+                return entry.data
+        return function_with_cache(function, *args, **kwargs)
+
+    cached = _functools.wraps(function)(cached)
+    # what inspect.getfullargspec, which doesn't follow __wrapped__, reports
+    cached.__signature__ = function._signature
+    return cached
+
+
+class _Skipped(object):
+
+    """ the fallback value of a call which raised SkipCache """
+
+    def __init__(self, retval):
+        self.retval = retval
+
+
+class _Keyless(object):
+
+    """ stands in for the key of a call of a batch which has none """
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _call_for_batch(function, args, kwargs):
+    try:
+        retval = function(*args, **kwargs)
+    except SkipCache as e:
+        _log_error(_traceback.format_exc())
+        return _Skipped(e.retval)
+    except function._cache_exceptions as e:
+        return _Negative(e.with_traceback(None), True)
+    if function._negative is not None and function._negative(retval):
+        return _Negative(retval, False)
+    return retval
+
+
+def _call_by_name(module_name, qualname, args, kwargs):
+    """
+    call a decorated function's undecorated version in a worker process.
+    It's looked up by name because only the decorated function can be
+    pickled by reference.
+    """
+    obj = _importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        obj = getattr(obj, name)
+    return _call_for_batch(getattr(obj, '__wrapped__', obj), args, kwargs)
+
+
+def _submit(executor, function, args, kwargs):
+    if isinstance(executor, _futures.ProcessPoolExecutor):
+        return executor.submit(_call_by_name, function.__module__,
+                               function.__qualname__, args, kwargs)
+    return executor.submit(_call_for_batch, function, args, kwargs)
+
+
+def _bind(function, args, kwargs):
+    """
+    normalize arguments like the decorated function does (it binds them to
+    the signature and fills in defaults), so batches share its keys.
+    """
+    bound = function._signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.args, bound.kwargs
+
+
+def _cache_map(function, calls, executor=None):
+    """
+    the cached results of function for a list of (args, kwargs), in order.
+    Keys are looked up with one get_many, each distinct miss is computed
+    once (in executor if given) and the results are stored with one
+    set_many.
+    """
+    keys = []
+    for args, kwargs in calls:
+        key = None
+        try:
+            key = _call_key(function, args, kwargs)
+        except:
+            _cache_error(function)
+            if not function._fail_silently:
+                raise
+        keys.append(key)
+
+    stats = function._stats
+    found = dict()
+    try:
+        start = _timer()
+        found = _db_get_many(
+            function._db, list(set(key for key in keys if key is not None)))
+        stats.record('read_seconds', _timer() - start)
+    except:
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    now = _time.time()
+    results = [None] * len(calls)
+    # key -> indices of the calls waiting for it.  calls without a key are
+    # computed on their own
+    misses = _collections.OrderedDict()
+    for i, key in enumerate(keys):
+        rv = found.get(key) if key is not None else None
+        if rv is not None:
+            validity = _validity(function, rv.data)
+        if rv is not None and (
+                validity is None or now - rv.timesig < validity):
+            stats.record('hits')
+            if type(rv.data) is _Negative:
+                stats.record('negative')
+            results[i] = rv.data
+            continue
+        if rv is not None:
+            stats.record('expired')
+        stats.record('misses')
+        misses.setdefault(key if key is not None else _Keyless(i),
+                          []).append(i)
+
+    misses = list(misses.items())
+    if executor is not None:
+        futures = [_submit(executor, function, *calls[indices[0]])
+                   for _, indices in misses]
+
+    to_store = dict()
+    negatives = dict()
+    error = None
+    for n, (key, indices) in enumerate(misses):
+        try:
+            if executor is not None:
+                value = futures[n].result()
+            else:
+                value = _call_for_batch(function, *calls[indices[0]])
+        except Exception as e:
+            # keep what was computed so far, then raise
+            error = e
+            if executor is not None:
+                for future in futures[n + 1:]:
+                    future.cancel()
+            break
+
+        if isinstance(value, _Skipped):
+            value = value.retval
+        elif type(value) is _Negative and not isinstance(key, _Keyless):
+            negatives[key] = _retval(_time.time(), value)
+        elif not isinstance(key, _Keyless):
+            to_store[key] = _retval(_time.time(), value)
+        for i in indices:
+            results[i] = value
+
+    for entries, ttl in ((to_store, _retention(function)),
+                         (negatives, function._negative_ttl)):
+        if not entries:
+            continue
+        try:
+            start = _timer()
+            _backend_set_many(function._db, entries, ttl)
+            stats.record('write_seconds', _timer() - start)
+            stats.record('bytes_stored', sum(
+                _approx_size(rv.data) for rv in entries.values()))
+            if function._sweeper is not None:
+                for _ in entries:
+                    function._sweeper.wrote(function)
+        except:
+            _cache_error(function)
+            if not function._fail_silently:
+                raise
+
+    if error is not None:
+        raise error
+    # the first cached exception is raised, as calling one by one would
+    return [_result(data) for data in results]
+
+
+def _function_executor(function):
+    """
+    the executor given to functioncache, creating the pool on first use if
+    it was given as 'thread' or 'process'
+    """
+    with function._submit_lock:
+        executor = function._executor
+        if executor == 'thread':
+            executor = _futures.ThreadPoolExecutor()
+        elif executor == 'process':
+            executor = _futures.ProcessPoolExecutor()
+        function._executor = executor
+    return executor
+
+
+def _store_submitted(function, key, inner, outer):
+    """ called in the parent process when a submitted miss is done """
+    if key is not None:
+        with function._submit_lock:
+            function._submitted.pop(key, None)
+    try:
+        value = inner.result()
+    except BaseException as e:
+        outer.set_exception(e)
+        return
+
+    if isinstance(value, _Skipped):
+        outer.set_result(value.retval)
+        return
+
+    if key is not None:
+        try:
+            # one writer at a time, whichever thread finishes a miss
+            with function._submit_lock:
+                _store(function, key, value)
+        except Exception as e:
+            _cache_error(function)
+            if not function._fail_silently:
+                outer.set_exception(e)
+                return
+    _settle(outer, value)
+
+
+def _settle(future, data):
+    """ complete future with what a call returning the cached data does """
+    try:
+        result = _result(data)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def _submit_cached(function, args, kwargs):
+    """
+    a future of the cached result of function(*args, **kwargs).  Hits are
+    looked up right away and returned as done futures, misses run in the
+    function's executor and are stored by this process when they finish.
+    Submitting a key which is already running returns the same future.
+    """
+    args, kwargs = _bind(function, args, kwargs)
+    key = None
+    try:
+        key = _call_key(function, args, kwargs)
+        rv = _lookup(function, key)
+        if rv is not None:
+            future = _futures.Future()
+            _settle(future, rv.data)
+            return future
+    except:
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    executor = _function_executor(function)
+    outer = _futures.Future()
+    if executor is None:
+        try:
+            outer.set_result(_compute_and_store(function, key, args, kwargs))
+        except Exception as e:
+            outer.set_exception(e)
+        return outer
+
+    with function._submit_lock:
+        if key is not None:
+            running = function._submitted.get(key)
+            if running is not None:
+                return running
+            function._submitted[key] = outer
+    inner = _submit(executor, function, args, kwargs)
+    inner.add_done_callback(
+        lambda inner: _store_submitted(function, key, inner, outer))
+    return outer
+
+
+def _add_batch_api(decorated, function):
+    def cache_map(iterable_of_args, executor=None):
+        """
+        call the function once per tuple of positional arguments, returning
+        the results in order.  Cached results are fetched in bulk and only
+        the misses are computed, in executor (a concurrent.futures thread or
+        process pool, defaulting to the one given to functioncache) if any.
+        """
+        return _cache_map(
+            function, [_bind(function, args, {}) for args in iterable_of_args],
+            executor or _function_executor(function))
+
+    def cache_map_kwargs(iterable_of_kwargs, executor=None):
+        """ cache_map for dicts of keyword arguments """
+        return _cache_map(
+            function,
+            [_bind(function, (), kwargs) for kwargs in iterable_of_kwargs],
+            executor or _function_executor(function))
+
+    def submit(*args, **kwargs):
+        """
+        return a concurrent.futures.Future of the cached result.  Misses run
+        in the executor given to functioncache, or right away without one.
+        """
+        return _submit_cached(function, args, kwargs)
+
+    decorated.cache_map = cache_map
+    decorated.cache_map_kwargs = cache_map_kwargs
+    decorated.submit = submit
+    return decorated
+
+
+def is_class(x):
+    """ handle difference between py2 and py3 """
+    if isinstance(x, type):
+        return True
+
+    if hasattr(_types, 'ClassType'):
+        return isinstance(x, _types.ClassType)
+    else:
+        return False
+
+
+def functioncache(
+        seconds_of_validity=None,
+        fail_silently=True,
+        backend=ShelveBackend,
+        ignore_instance=False,
+        function_key=function_name,
+        single_flight=False,
+        lease_seconds=5 * MINUTE,
+        key_builder=digest_arguments,
+        max_entries=None,
+        max_bytes=None,
+        eviction=LRU,
+        sweep_every=1000,
+        executor=None,
+        serializer=None,
+        stale_ttl=None,
+        refresh_ahead=None,
+        cache_exceptions=(),
+        negative=None,
+        negative_ttl=None):
+    '''
+    functioncache is called and the decorator should be returned.
+
+    function_key allows you to introduce cache invalidation on implementation changes:
+    function_fingerprint keys entries by a digest of the function's bytecode
+    and constants, function_fingerprint_deep also by the module's functions
+    it calls.  Entries of earlier versions are deleted by the first sweep.
+
+    key_builder turns (args, kwargs) into the part of the key after the
+    function_key: digest_arguments (default) or pickle_arguments for the
+    original, much larger keys.
+
+    On backends which can list their entries (ShelveBackend, FileBackend),
+    once every sweep_every writes a background thread deletes this
+    function's entries older than seconds_of_validity and, if max_entries
+    and/or max_bytes are given, evicts its LRU or LFU (eviction) entries
+    beyond those bounds.  Pass sweep_every=None to leave the cache alone.
+
+    executor (a concurrent.futures executor, or 'thread' or 'process' for a
+    pool created on first use) runs the misses of fn.submit(...) and
+    fn.cache_map(...).  Results are written to the cache by the calling
+    process, so backends like ShelveBackend keep a single writer.
+
+    serializer (e.g. Serializer(MARSHAL, compression=ZLIB)) is how the
+    backend turns entries into bytes; by default each backend uses pickle.
+    Entries are readable whichever serializer wrote them.
+
+    stale_ttl lets entries outlive seconds_of_validity by that many seconds:
+    a call finding a stale entry returns it at once while one background
+    thread (or task, for coroutines) recomputes it.  refresh_ahead starts
+    that recomputation for entries hit within refresh_ahead seconds of
+    expiring, so hot entries are replaced before anyone sees them expire.
+
+    cache_exceptions (an exception class or a tuple of them) caches the
+    exceptions of those types the function raises: calls with the same
+    arguments raise them again until they expire.  negative (e.g.
+    lambda result: result is None) picks out "not found" results to cache
+    the same way.  Both are kept for negative_ttl seconds (by default
+    seconds_of_validity), so a lookup which failed is retried sooner than a
+    good result is recomputed, and are never served stale or refreshed.
+
+    single_flight makes concurrent callers missing the same key wait for one
+    of them to compute it instead of all computing it.  Backends with
+    acquire_lease (e.g. FileBackend) extend this across processes; a process
+    waits at most lease_seconds for another one before computing itself.
+
+    backend is a backend class, whose instance the functions of a module
+    share, or an instance, used by the functions of one module it is given
+    to.  Instances keeping their data in the module's cache file (e.g.
+    ShelveBackend()) are shared by the functions of the module like classes,
+    as the file is opened once.  It is opened (its cache file created, its connection made) on the
+    first call, or by fn.cache_open(); fn.cache_flush() and fn.cache_close()
+    flush and close it.  A closed backend is opened again when next used.
+    '''
+    # if a class is passed in, the functions of a module share one instance
+    # of that class as the backend
+    shared_backend = is_class(backend)
+    if shared_backend:
+        backend = backend()
+    if serializer is not None:
+        backend = _with_serializer(backend, serializer)
+    if is_class(cache_exceptions):
+        cache_exceptions = (cache_exceptions,)
+    else:
+        cache_exceptions = tuple(cache_exceptions)
+
+    def functioncache_decorator(function):
+        function._seconds_of_validity = seconds_of_validity
+        function._stale_ttl = stale_ttl
+        function._refresh_ahead = refresh_ahead
+        function._cache_exceptions = cache_exceptions
+        function._negative = negative
+        function._negative_ttl = seconds_of_validity if negative_ttl is None \
+            else negative_ttl
+        function._fail_silently = fail_silently
+        function._ignore_instance = ignore_instance
+        function._function_key = function_key
+        function._key_builder = key_builder
+        function._single_flight = single_flight
+        function._lease_seconds = lease_seconds
+        function._max_entries = max_entries
+        function._max_bytes = max_bytes
+        function._eviction = eviction
+        function._signature = _inspect.signature(function)
+        function._executor = executor
+        function._submitted = dict()
+        function._submit_lock = _threading.Lock()
+        function._stats = CacheStats(
+            '%s.%s' % (function.__module__, function.__qualname__))
+
+        if function_key is function_fingerprint:
+            # once, instead of on every call
+            function_fingerprint(function)
+        function._old_versions = function_key in _FINGERPRINT_KEYS
+
+        function._sweeper = None
+        bounded = max_entries is not None or max_bytes is not None
+        function._track_access = bounded
+        if hasattr(function, '_db'):
+            db = function._db
+            function._namespace = None
+            if bounded:
+                db.track_access = True
+        else:
+            # the backend is set up on first use, see _open
+            function._namespace, db = _register(function, backend,
+                                                 shared_backend)
+            function._db = _LazyBackend(function)
+        _STATS_REGISTRY.setdefault(function._namespace, []).append(
+            function._stats)
+        _weakref.finalize(function, _forget, function._namespace,
+                          function._stats)
+
+        if sweep_every and hasattr(db, '_entries') and (
+                bounded or seconds_of_validity is not None or
+                function._old_versions):
+            function._sweeper = _Sweeper(sweep_every)
+
+        # a key_builder of the user's choice is used on any backend
+        function._fast_keys = isinstance(db, DictBackend) and \
+            key_builder is digest_arguments
+
+        if _inspect.iscoroutinefunction(function):
+            # coroutines are awaited and their results cached, using the
+            # async protocol of the backend
+            function._adb = _async_backend(db) if function._namespace is \
+                None else _LazyBackend(function, '_adb')
+            decorated = decorate(function, function_with_cache_async)
+        else:
+            if function._fast_keys:
+                function._plain_positional = _plain_positional(
+                    function._signature)
+                decorated = _dict_cached(function)
+            else:
+                decorated = decorate(function, function_with_cache)
+            decorated = _add_batch_api(decorated, function)
+        decorated.cache_stats = function._stats.as_dict
+        decorated.cache_open = lambda: _open(function)
+        decorated.cache_flush = lambda: _flush(function._namespace)
+        decorated.cache_close = lambda: _close(function._namespace)
+        function._decorated = decorated
+        return decorated
+
+    if isinstance(seconds_of_validity, _types.FunctionType):
+        # support for when people use '@functioncache.functioncache' instead of
+        # '@functioncache.functioncache()'
+        func = seconds_of_validity
+        seconds_of_validity = None
+        return functioncache_decorator(func)
+
+    return functioncache_decorator
+
+
+def flush_all():
+    """ flush the buffered writes of every open backend """
+    for namespace in list(OPEN_DBS):
+        _flush(namespace)
+
+
+def close_all():
+    """ close every open backend, they open again when next used """
+    for namespace in list(OPEN_DBS):
+        _close(namespace)
+
+
+def dictcache(seconds_of_validity=None, fail_silently=False, maxsize=None):
+    return functioncache(seconds_of_validity, fail_silently,
+                         DictBackend(maxsize))
+
+
+def filecache(seconds_of_validity=None, fail_silently=False):
+    return functioncache(seconds_of_validity, fail_silently, FileBackend)
+
+
+def shelvecache(seconds_of_validity=None, fail_silently=False):
+    return functioncache(seconds_of_validity, fail_silently, ShelveBackend)
+
+
+def sqlitecache(seconds_of_validity=None, fail_silently=False):
+    return functioncache(seconds_of_validity, fail_silently, SqliteBackend)
+
+
+def logcache(seconds_of_validity=None, fail_silently=False):
+    return functioncache(seconds_of_validity, fail_silently, LogBackend)
+
+
+def memcachecache(seconds_of_validity=None, fail_silently=False, mc=None):
+    return functioncache(
+        seconds_of_validity, fail_silently, MemcacheBackend(mc)
+    )
+
+def rediscache(seconds_of_validity=None, fail_silently=False, client=None):
+    return functioncache(
+        seconds_of_validity, fail_silently, RedisBackend(client)
+    )
+
+from functioncache._aio import (
+    AsyncBackend, AsyncFileBackend, AsyncMemcacheBackend, _async_backend,
+    function_with_cache_async)
+from functioncache._archive import (
+    export_cache, import_cache, prewarm, read_archive)
 
 if _os.path.exists(_os.path.expanduser("~/.disable_functioncache")):
     def functioncache(*_, **__):
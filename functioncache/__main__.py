@@ -0,0 +1,291 @@
+"""
+command line maintenance of functioncache's cache directory, e.g. from cron:
+
+    python -m functioncache gc --max-age 604800 --max-bytes 1000000000
+
+gc deletes entries written more than --max-age seconds ago and, per cache
+file, evicts the least recently (or frequently) used entries beyond
+--max-entries / --max-bytes.
+
+migrate moves the entries of FileBackend directories written by versions
+before sharding into their shard directories.
+
+export appends the entries of every cache under --root (or of a redis
+server) to an archive, import loads an archive into the caches under --root
+of another node, and prewarm calls a cached function for the argument lists
+in a file, one JSON list (or {"args": [...], "kwargs": {...}}) per line:
+
+    python -m functioncache export caches.fca
+    python -m functioncache import caches.fca --backend sqlite
+    python -m functioncache prewarm myapp.pages:render calls.jsonl
+
+export skips the caches which keep some of their keys hashed, and then
+exits with status 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import importlib
+import json
+import os
+import sys
+
+import functioncache
+
+# the files dbm may create for a shelve named <name>.cache
+_SHELVE_SUFFIXES = ('.cache', '.cache.db', '.cache.dat', '.cache.dir',
+                    '.cache.bak', '.cache.pag')
+
+
+def _stores(root):
+    """ yield (path, backend) for every cache store found under root """
+    for dirpath, dirnames, filenames in os.walk(root):
+        for dirname in sorted(dirnames):
+            if dirname.endswith('.cached'):
+                backend = functioncache.FileBackend()
+                backend.setup_path(os.path.join(dirpath, dirname))
+                yield backend.dir_name, backend
+            elif dirname.endswith('.cache.log'):
+                backend = functioncache.LogBackend()
+                try:
+                    backend.setup_path(os.path.join(dirpath, dirname))
+                except functioncache.LogLockedError as e:
+                    # a running program owns it, it compacts it itself
+                    print('skipping %s' % e, file=sys.stderr)
+                    continue
+                yield backend.path, backend
+        # FileBackend and LogBackend directories only contain entries
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not dirname.endswith(('.cached', '.cache.log'))]
+
+        shelve_names = set()
+        for filename in sorted(filenames):
+            if filename.endswith('.cache.sqlite'):
+                backend = functioncache.SqliteBackend()
+                backend.setup_path(os.path.join(dirpath, filename))
+                yield backend.path, backend
+                continue
+            for suffix in _SHELVE_SUFFIXES:
+                if filename.endswith(suffix):
+                    shelve_names.add(filename[:-len(suffix)] + '.cache')
+        for shelve_name in sorted(shelve_names):
+            path = os.path.join(dirpath, shelve_name)
+            backend = functioncache.ShelveBackend()
+            backend.setup_path(path)
+            yield path, backend
+
+
+def gc(args):
+    for path, backend in _stores(args.root):
+        removed = 0
+        if args.max_age is not None:
+            removed += functioncache.sweep(backend, args.max_age)
+        if args.max_entries is not None or args.max_bytes is not None:
+            removed += functioncache.evict(
+                backend, args.max_entries, args.max_bytes, args.policy)
+        if hasattr(backend, 'close'):
+            backend.close()
+        if args.verbose:
+            print('%s: removed %d entries' % (path, removed))
+    return 0
+
+
+def migrate(args):
+    for path, backend in _stores(args.root):
+        if not isinstance(backend, functioncache.FileBackend):
+            continue
+        moved = backend.migrate()
+        if args.verbose:
+            print('%s: moved %d entries' % (path, moved))
+    return 0
+
+
+def _namespace(path, root):
+    """ the cache name of a store, relative to root """
+    if path.endswith('.cached'):
+        path = path[:-1]
+    elif path.endswith('.cache.sqlite'):
+        path = path[:-len('.sqlite')]
+    elif path.endswith('.cache.log'):
+        path = path[:-len('.log')]
+    return os.path.relpath(path, root)
+
+
+def _open_store(kind, path):
+    """ a backend of kind for the cache named path """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if kind == 'file':
+        backend = functioncache.FileBackend()
+        backend.setup_path(path + 'd')
+    elif kind == 'sqlite':
+        backend = functioncache.SqliteBackend()
+        backend.setup_path(path + '.sqlite')
+    elif kind == 'log':
+        backend = functioncache.LogBackend()
+        backend.setup_path(path + '.log')
+    else:
+        backend = functioncache.ShelveBackend()
+        backend.setup_path(path)
+    return backend
+
+
+def export(args):
+    if args.redis:
+        stores = [('', functioncache.RedisBackend(url=args.redis))]
+    else:
+        stores = [(_namespace(path, args.root), backend)
+                  for path, backend in _stores(args.root)]
+    status = 0
+    for namespace, backend in stores:
+        try:
+            count = functioncache.export_cache(backend, args.archive,
+                                               namespace)
+        except ValueError as e:
+            # its keys can't be told, the other stores are still exported
+            print('skipping %s: %s' % (namespace or args.redis, e),
+                  file=sys.stderr)
+            status = 1
+            continue
+        finally:
+            if hasattr(backend, 'close'):
+                backend.close()
+        if args.verbose:
+            print('%s: exported %d entries' % (namespace or args.redis, count))
+    return status
+
+
+def import_(args):
+    if args.redis:
+        count = functioncache.import_cache(
+            args.archive, functioncache.RedisBackend(url=args.redis),
+            ttl=args.ttl, max_age=args.max_age)
+        if args.verbose:
+            print('%s: imported %d entries' % (args.redis, count))
+        return 0
+    backends = []
+
+    def open_backend(namespace):
+        backend = _open_store(args.backend,
+                              os.path.join(args.root, namespace))
+        backends.append(backend)
+        return backend
+
+    try:
+        counts = functioncache._archive.import_namespaces(
+            args.archive, open_backend, max_age=args.max_age)
+    finally:
+        for backend in backends:
+            if hasattr(backend, 'close'):
+                backend.close()
+    if args.verbose:
+        for namespace in sorted(counts):
+            print('%s: imported %d entries' % (namespace, counts[namespace]))
+    return 0
+
+
+def _calls(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            call = json.loads(line)
+            yield call if isinstance(call, dict) else tuple(call)
+
+
+def prewarm(args):
+    module_name, _, qualname = args.function.partition(':')
+    function = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        function = getattr(function, name)
+    with open(args.calls) as lines:
+        count = functioncache.prewarm(
+            function, _calls(lines),
+            'process' if args.processes else 'thread')
+    functioncache.close_all()
+    if args.verbose:
+        print('%s: %d calls' % (args.function, count))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m functioncache')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    gc_parser = commands.add_parser(
+        'gc', help='delete expired entries and enforce size bounds')
+    gc_parser.add_argument(
+        '--root', default=functioncache._CACHE_ROOT,
+        help='cache directory (default: %(default)s)')
+    gc_parser.add_argument(
+        '--max-age', type=float,
+        help='delete entries written more than this many seconds ago')
+    gc_parser.add_argument(
+        '--max-entries', type=int, help='entries to keep per cache file')
+    gc_parser.add_argument(
+        '--max-bytes', type=int, help='bytes to keep per cache file')
+    gc_parser.add_argument(
+        '--policy', choices=(functioncache.LRU, functioncache.LFU),
+        default=functioncache.LRU,
+        help='which entries to evict first (default: %(default)s)')
+    gc_parser.add_argument('-v', '--verbose', action='store_true')
+    gc_parser.set_defaults(run=gc)
+
+    migrate_parser = commands.add_parser(
+        'migrate', help='move flat FileBackend entries into shards')
+    migrate_parser.add_argument(
+        '--root', default=functioncache._CACHE_ROOT,
+        help='cache directory (default: %(default)s)')
+    migrate_parser.add_argument('-v', '--verbose', action='store_true')
+    migrate_parser.set_defaults(run=migrate)
+
+    export_parser = commands.add_parser(
+        'export', help='append the cached entries to an archive')
+    export_parser.add_argument('archive')
+    export_parser.add_argument(
+        '--root', default=functioncache._CACHE_ROOT,
+        help='cache directory (default: %(default)s)')
+    export_parser.add_argument(
+        '--redis', metavar='URL', help='export a redis server instead')
+    export_parser.add_argument('-v', '--verbose', action='store_true')
+    export_parser.set_defaults(run=export)
+
+    import_parser = commands.add_parser(
+        'import', help='load the entries of an archive')
+    import_parser.add_argument('archive')
+    import_parser.add_argument(
+        '--root', default=functioncache._CACHE_ROOT,
+        help='cache directory (default: %(default)s)')
+    import_parser.add_argument(
+        '--backend', choices=('shelve', 'file', 'sqlite', 'log'), default='shelve',
+        help='how to store the entries (default: %(default)s)')
+    import_parser.add_argument(
+        '--redis', metavar='URL', help='load into a redis server instead')
+    import_parser.add_argument(
+        '--ttl', type=float, help='expire the entries loaded into redis')
+    import_parser.add_argument(
+        '--max-age', type=float,
+        help='skip entries written more than this many seconds ago')
+    import_parser.add_argument('-v', '--verbose', action='store_true')
+    import_parser.set_defaults(run=import_)
+
+    prewarm_parser = commands.add_parser(
+        'prewarm', help='cache a function for recorded arguments')
+    prewarm_parser.add_argument(
+        'function', help='the cached function, as module:name')
+    prewarm_parser.add_argument(
+        'calls', help='file of argument lists, one JSON list per line')
+    prewarm_parser.add_argument(
+        '--processes', action='store_true',
+        help='compute in processes instead of threads')
+    prewarm_parser.add_argument('-v', '--verbose', action='store_true')
+    prewarm_parser.set_defaults(run=prewarm)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
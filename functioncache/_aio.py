@@ -0,0 +1,340 @@
+"""
+asyncio support: functioncache decorates `async def` functions with
+function_with_cache_async, which awaits the function and caches its result.
+
+Backends used from coroutines speak an async protocol: aget(key, default),
+aset(key, value, ttl=None) and acontains(key).  Blocking backends are wrapped in
+AsyncBackend, which runs their methods in an executor so the event loop
+keeps going while the disk or network is busy.
+"""
+
+import asyncio as _asyncio
+import functools as _functools
+import pickle as _pickle
+import time as _time
+import traceback as _traceback
+
+from functioncache import (
+    DictBackend, FileBackend, MemcacheBackend, SkipCache, _MISSING,
+    _LEASE_POLL_SECONDS, _Negative, _approx_size, _backend_set, _cache_error,
+    _call_key, _db_get, _dump_entry, _load_entry, _log_error, _refresh_due,
+    _result, _retention, _retval, _short_key, _timer, _validity)
+
+# in-progress computations of single_flight coroutine functions
+_ASYNC_FLIGHTS = dict()
+
+# background refreshes of stale entries, see _arefresh
+_ASYNC_REFRESHES = dict()
+
+
+class AsyncBackend(object):
+
+    """
+    run the methods of a blocking backend in an executor (the loop's default
+    one unless given) so they don't block the event loop.
+    """
+
+    def __init__(self, backend, executor=None):
+        if isinstance(backend, type):
+            backend = backend()
+        self.backend = backend
+        self.executor = executor
+
+    def setup(self, function):
+        self.backend.setup(function)
+
+    async def run(self, method, *args):
+        loop = _asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, _functools.partial(method, *args))
+
+    async def aget(self, key, default=None):
+        value = await self.run(_db_get, self.backend, key)
+        return default if value is _MISSING else value
+
+    async def acontains(self, key):
+        return await self.run(self.backend.__contains__, key)
+
+    async def aset(self, key, value, ttl=None):
+        await self.run(_backend_set, self.backend, key, value, ttl)
+
+
+class AsyncFileBackend(AsyncBackend):
+
+    """ FileBackend with its file I/O run in an executor """
+
+    def __init__(self, executor=None):
+        AsyncBackend.__init__(self, FileBackend(), executor)
+
+
+class AsyncMemcacheBackend(AsyncBackend):
+
+    """
+    memcache from coroutines.  Given a non-blocking client (e.g.
+    aiomcache.Client, whose get/set are coroutines taking bytes) it is used
+    directly, otherwise MemcacheBackend(mc) is run in an executor.
+    """
+
+    # None pickles the entries sent to the non-blocking client
+    serializer = None
+
+    def __init__(self, client=None, mc=None, executor=None):
+        AsyncBackend.__init__(self, MemcacheBackend(mc) if client is None
+                              else None, executor)
+        self.client = client
+
+    def setup(self, function):
+        if self.client is None:
+            self.backend.setup(function)
+
+    async def aget(self, key, default=None):
+        if self.client is None:
+            return await AsyncBackend.aget(self, key, default)
+        data = await self.client.get(self._hash_key(key))
+        if data is None:
+            return default
+        return _load_entry(self.serializer, data)
+
+    async def acontains(self, key):
+        return await self.aget(key, _MISSING) is not _MISSING
+
+    async def aset(self, key, value, ttl=None):
+        if self.client is None:
+            return await AsyncBackend.aset(self, key, value, ttl)
+        if self.serializer is None:
+            data = _pickle.dumps(value, _pickle.HIGHEST_PROTOCOL)
+        else:
+            data = _dump_entry(self.serializer, value)
+        if not await self.client.set(self._hash_key(key), data,
+                                     exptime=MemcacheBackend._expiry(ttl)):
+            raise Exception("memcache set failed")
+
+    def _hash_key(self, key):
+        return _short_key(key).encode('ascii')
+
+
+class _MemoryBackend(object):
+
+    """ the async protocol over an in-memory backend, which never blocks """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def aget(self, key, default=None):
+        return self.backend.get(key, default)
+
+    async def acontains(self, key):
+        return key in self.backend
+
+    async def aset(self, key, value, ttl=None):
+        self.backend[key] = value
+
+
+def _async_backend(db):
+    """ the async view of a function's backend """
+    if hasattr(db, 'aget'):
+        return db
+    if isinstance(db, DictBackend):
+        return _MemoryBackend(db)
+    return AsyncBackend(db)
+
+
+async def _alookup(function, key, record=True, stale=False):
+    start = _timer()
+    rv = await function._adb.aget(key, _MISSING)
+    if record:
+        stats = function._stats
+        stats.record('read_seconds', _timer() - start)
+    if rv is not _MISSING:
+        negative = type(rv.data) is _Negative
+        validity = _validity(function, rv.data)
+        age = _time.time() - rv.timesig
+        if validity is None or age < validity:
+            if record:
+                stats.record('hits')
+                if negative:
+                    stats.record('negative')
+            return rv
+        if stale and function._stale_ttl and not negative and \
+                age < _retention(function):
+            if record:
+                stats.record('hits')
+                stats.record('stale')
+            return rv
+        if record:
+            stats.record('expired')
+    if record:
+        stats.record('misses')
+    return None
+
+
+async def _astore(function, key, value):
+    """ the async version of functioncache._store """
+    start = _timer()
+    if type(value) is _Negative:
+        ttl = function._negative_ttl
+    else:
+        ttl = _retention(function)
+    await function._adb.aset(key, _retval(_time.time(), value), ttl)
+    function._stats.record('write_seconds', _timer() - start)
+    function._stats.record('bytes_stored', _approx_size(value))
+    if function._sweeper is not None:
+        function._sweeper.wrote(function)
+
+
+async def _astore_negative(function, key, value, raised):
+    """ the async version of functioncache._store_negative """
+    if raised:
+        tb = value.__traceback__
+        value = value.with_traceback(None)
+    try:
+        await _astore(function, key, _Negative(value, raised))
+    except Exception:
+        _cache_error(function)
+        if not raised and not function._fail_silently:
+            raise
+    finally:
+        if raised:
+            value.with_traceback(tb)
+
+
+async def _acompute_and_store(function, key, args, kwargs):
+    try:
+        retval = await function(*args, **kwargs)
+    # Log the error, return the value, don't cache it.
+    except SkipCache as e:
+        _log_error(_traceback.format_exc())
+        return e.retval
+    except function._cache_exceptions as e:
+        if key is not None:
+            await _astore_negative(function, key, e, True)
+        raise
+
+    if key is None:
+        return retval
+
+    if function._negative is not None and function._negative(retval):
+        await _astore_negative(function, key, retval, False)
+        return retval
+
+    try:
+        await _astore(function, key, retval)
+    except Exception:
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    return retval
+
+
+async def _acompute_with_lease(function, key, args, kwargs):
+    """ the async version of functioncache._compute_with_lease """
+    adb = function._adb
+    db = getattr(adb, 'backend', None)
+    if not hasattr(db, 'acquire_lease'):
+        return await _acompute_and_store(function, key, args, kwargs)
+
+    deadline = _time.time() + function._lease_seconds
+    while True:
+        token = await adb.run(db.acquire_lease, key, function._lease_seconds)
+        if token is not None:
+            try:
+                rv = await _alookup(function, key, record=False)
+                if rv is not None:
+                    return _result(rv.data)
+                return await _acompute_and_store(function, key, args, kwargs)
+            finally:
+                await adb.run(db.release_lease, key, token)
+
+        await _asyncio.sleep(_LEASE_POLL_SECONDS)
+        rv = await _alookup(function, key, record=False)
+        if rv is not None:
+            return _result(rv.data)
+        if _time.time() > deadline:
+            return await _acompute_and_store(function, key, args, kwargs)
+
+
+def _cancelling():
+    """ whether the current task is being cancelled (python 3.11 and later
+    tell, before that a task is taken as not being cancelled) """
+    cancelling = getattr(_asyncio.current_task(), 'cancelling', None)
+    return cancelling is not None and cancelling() > 0
+
+
+async def _asingle_flight(function, key, args, kwargs):
+    """ make sure only one task of this event loop computes key """
+    loop = _asyncio.get_running_loop()
+    flight_key = (id(loop), id(function._db), key)
+    flight = _ASYNC_FLIGHTS.get(flight_key)
+    while flight is not None:
+        try:
+            return await _asyncio.shield(flight)
+        except _asyncio.CancelledError:
+            if not flight.cancelled() or _cancelling():
+                raise
+        # the task computing it was cancelled, not this one: take over
+        flight = _ASYNC_FLIGHTS.get(flight_key)
+
+    flight = _ASYNC_FLIGHTS[flight_key] = loop.create_future()
+    try:
+        result = await _acompute_with_lease(function, key, args, kwargs)
+    except _asyncio.CancelledError:
+        flight.cancel()
+        raise
+    except BaseException as e:
+        flight.set_exception(e)
+        # the waiters get the exception, don't complain it wasn't retrieved
+        flight.exception()
+        raise
+    else:
+        flight.set_result(result)
+        return result
+    finally:
+        del _ASYNC_FLIGHTS[flight_key]
+
+
+async def _arefresh_task(function, key, args, kwargs):
+    try:
+        await _acompute_with_lease(function, key, args, kwargs)
+    except Exception:
+        # the stale entry stays until it expires, the next hit retries
+        _log_error(_traceback.format_exc())
+
+
+def _arefresh(function, key, args, kwargs):
+    """ recompute key in a task of this loop, unless that's already going """
+    loop = _asyncio.get_running_loop()
+    refresh_key = (id(loop), id(function._db), key)
+    if refresh_key in _ASYNC_REFRESHES:
+        return
+    function._stats.record('refreshes')
+    # holding the task also keeps it from being garbage collected
+    task = _ASYNC_REFRESHES[refresh_key] = loop.create_task(
+        _arefresh_task(function, key, args, kwargs))
+    task.add_done_callback(
+        lambda task: _ASYNC_REFRESHES.pop(refresh_key, None))
+
+
+async def function_with_cache_async(function, *args, **kwargs):
+    key = None
+    rv = None
+    try:
+        key = _call_key(function, args, kwargs)
+
+        rv = await _alookup(function, key, stale=True)
+        if rv is not None and _refresh_due(function, rv):
+            _arefresh(function, key, args, kwargs)
+    except Exception:
+        # in any case of failure, don't let functioncache break the
+        # program
+        _cache_error(function)
+        if not function._fail_silently:
+            raise
+
+    if rv is not None:
+        return _result(rv.data)
+
+    if key is not None and function._single_flight:
+        return await _asingle_flight(function, key, args, kwargs)
+
+    return await _acompute_and_store(function, key, args, kwargs)
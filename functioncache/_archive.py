@@ -0,0 +1,266 @@
+"""
+moving caches between nodes: export_cache streams the entries of a backend
+into an archive, import_cache loads an archive into another backend, and
+prewarm fills a cache by calling the function for recorded arguments.
+
+An archive is a gzip file of records.  Each record is a _RECORD header
+followed by the namespace (which cache file the entry came from, relative
+to the cache root), the key and the entry serialized with the default
+Serializer.  Keys which aren't strings (e.g. dictcache's) are pickled, a
+pickle never starts like utf-8 text.  The header holds the entry's timesig, so records can be
+picked without deserializing them.  Every export appends a gzip member, and
+gzip reads concatenated members as one stream, so archives are only ever
+appended to.
+"""
+
+import asyncio as _asyncio
+import concurrent.futures as _futures
+import gzip as _gzip
+import inspect as _inspect
+import os as _os
+import pickle as _pickle
+import re as _re
+import struct as _struct
+import time as _time
+
+from functioncache import (
+    Serializer, _MISSING, _backend_set_many, _bind, _cache_map,
+    _db_get_many, _dump_entry, _load_entry, _retval)
+
+# magic, the timesig of the entry, then the lengths of the namespace, the
+# key and the entry
+_RECORD = _struct.Struct('<4sdIII')
+_RECORD_MAGIC = b'FCA2'
+# the records of older archives, without the timesig
+_OLD_RECORD = _struct.Struct('<4sIII')
+_OLD_RECORD_MAGIC = b'FCA1'
+
+# entries read or written per round trip to the backend
+_BATCH = 1000
+
+
+# the names _short_key gives to keys which aren't safe as names
+_HASHED_KEY = _re.compile(r'^[0-9a-f]{128}$')
+
+
+def _keys(db, prefix=None):
+    """ the keys of every entry of a backend whose key starts with prefix """
+    if hasattr(db, '_keys'):
+        keys = list(db._keys(prefix))
+    elif hasattr(db, '_entries'):
+        # the handles of file, sqlite, log and S3 entries end with the name
+        # of the entry
+        keys = [_os.path.basename(entry.handle)
+                for entry in db._entries(prefix)]
+    else:
+        raise ValueError("%s can't list its keys, export from the backend "
+                         "which filled it" % type(db).__name__)
+    hashed = sum(1 for key in keys
+                 if isinstance(key, str) and _HASHED_KEY.match(key))
+    if hashed:
+        raise ValueError(
+            "%d entries of %s are named after a hash of their key, they "
+            "can't be exported" % (hashed, type(db).__name__))
+    return keys
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_cache(db, path, namespace='', prefix=None):
+    """
+    append every entry of db whose key starts with prefix to the archive at
+    path, as entries of namespace.  Returns how many entries were written.
+    """
+    serializer = Serializer()
+    count = 0
+    with _gzip.open(path, 'ab') as archive:
+        for keys in _batches(_keys(db, prefix), _BATCH):
+            found = _db_get_many(db, keys)
+            for key in keys:
+                value = found.get(key, _MISSING)
+                # gone since it was listed
+                if value is _MISSING:
+                    continue
+                if isinstance(value.data, memoryview):
+                    # bytes read from a zero_copy file, a view of its mmap
+                    value = _retval(value.timesig, value.data.tobytes())
+                data = _dump_entry(serializer, value)
+                archive.write(_record(namespace, key, value.timesig, data))
+                count += 1
+    return count
+
+
+def _record(namespace, key, timesig, data):
+    namespace = namespace.encode('utf-8')
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    else:
+        key = _pickle.dumps(key, _pickle.HIGHEST_PROTOCOL)
+    return b''.join((_RECORD.pack(_RECORD_MAGIC, timesig, len(namespace),
+                                  len(key), len(data)),
+                     namespace, key, data))
+
+
+def _read_exactly(archive, size, path):
+    data = archive.read(size)
+    if len(data) < size:
+        raise ValueError('%s: truncated record' % path)
+    return data
+
+
+def _raw_records(path):
+    """
+    yield (namespace, key, timesig, data) for every record of an archive,
+    leaving the entry serialized.  timesig is None in old archives.
+    """
+    with _gzip.open(path, 'rb') as archive:
+        while True:
+            magic = archive.read(4)
+            if not magic:
+                return
+            if magic == _RECORD_MAGIC:
+                _, timesig, namespace_len, key_len, data_len = _RECORD.unpack(
+                    magic + _read_exactly(archive, _RECORD.size - 4, path))
+            elif magic == _OLD_RECORD_MAGIC:
+                timesig = None
+                _, namespace_len, key_len, data_len = _OLD_RECORD.unpack(
+                    magic + _read_exactly(archive, _OLD_RECORD.size - 4, path))
+            elif len(magic) < 4:
+                raise ValueError('%s: truncated record' % path)
+            else:
+                raise ValueError('%s is not a functioncache archive' % path)
+            body = _read_exactly(archive, namespace_len + key_len + data_len,
+                                 path)
+            key_end = namespace_len + key_len
+            key = body[namespace_len:key_end]
+            key = _pickle.loads(key) if key.startswith(b'\x80') else \
+                key.decode('utf-8')
+            yield (body[:namespace_len].decode('utf-8'), key, timesig,
+                   body[key_end:])
+
+
+def read_archive(path):
+    """ yield (namespace, key, entry) for every record of an archive """
+    for namespace, key, _, data in _raw_records(path):
+        yield namespace, key, _load_entry(None, data)
+
+
+def namespaces(path):
+    """ the namespaces of the entries in an archive """
+    return sorted(set(namespace for namespace, _, _, _ in _raw_records(path)))
+
+
+def import_namespaces(path, open_backend, ttl=None, max_age=None):
+    """
+    store the entries of the archive at path, in one pass, in batches, in
+    the backend open_backend(namespace) returns for their namespace (called
+    once per namespace, None skips its entries).  max_age skips entries
+    written more than that many seconds ago and ttl is passed to backends
+    which expire entries.  Only entries which are stored are deserialized.
+    Later records of a key win.  Returns {namespace: entries stored}.
+    """
+    now = _time.time()
+    backends = dict()
+    batches = dict()
+    counts = dict()
+    for namespace, key, timesig, data in _raw_records(path):
+        if namespace not in backends:
+            backends[namespace] = open_backend(namespace)
+            batches[namespace] = dict()
+            counts[namespace] = 0
+        if backends[namespace] is None or (
+                timesig is not None and max_age is not None and
+                now - timesig >= max_age):
+            continue
+        value = _load_entry(None, data)
+        if max_age is not None and now - value.timesig >= max_age:
+            continue
+        batch = batches[namespace]
+        batch[key] = value
+        if len(batch) == _BATCH:
+            _backend_set_many(backends[namespace], batch, ttl)
+            counts[namespace] += len(batch)
+            batches[namespace] = dict()
+    for namespace, batch in batches.items():
+        if batch:
+            _backend_set_many(backends[namespace], batch, ttl)
+            counts[namespace] += len(batch)
+    return dict((namespace, count) for namespace, count in counts.items()
+                if backends[namespace] is not None)
+
+
+def import_cache(path, db, namespace=None, ttl=None, max_age=None):
+    """
+    store the entries of the archive at path in db, in batches.  namespace
+    picks the entries of one namespace, max_age skips entries written more
+    than that many seconds ago and ttl is passed to backends which expire
+    entries.  Later records of a key win.  Returns how many entries were
+    stored.
+    """
+    counts = import_namespaces(
+        path, lambda record_namespace: db if namespace is None or
+        record_namespace == namespace else None, ttl, max_age)
+    return sum(counts.values())
+
+
+def _call_arguments(call):
+    """ the positional and keyword arguments of a recorded call """
+    if isinstance(call, dict):
+        return tuple(call.get('args', ())), call.get('kwargs', {})
+    return tuple(call), {}
+
+
+async def _aprewarm(function, calls):
+    """ prewarm for coroutine functions, a batch of calls at a time """
+    count = 0
+    for batch in _batches(calls, _BATCH):
+        results = await _asyncio.gather(*(
+            function(*args, **kwargs)
+            for args, kwargs in map(_call_arguments, batch)),
+            return_exceptions=True)
+        # like _cache_map, the other results are kept
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        count += len(batch)
+    return count
+
+
+def prewarm(function, calls, executor='thread'):
+    """
+    cache the results of a decorated function for recorded calls, each a
+    tuple of positional arguments or a dict with 'args' and/or 'kwargs'.
+    Misses are computed in executor: a concurrent.futures executor, 'thread'
+    or 'process' for a pool kept until the calls are done, or None to
+    compute them one after the other.  Coroutine functions are awaited
+    instead, concurrently, on an event loop of their own.  Returns how many
+    calls were made.
+    """
+    if _inspect.iscoroutinefunction(function.__wrapped__):
+        return _asyncio.run(_aprewarm(function, calls))
+    function = function.__wrapped__
+    pool = None
+    if executor == 'thread':
+        executor = pool = _futures.ThreadPoolExecutor()
+    elif executor == 'process':
+        executor = pool = _futures.ProcessPoolExecutor()
+    count = 0
+    try:
+        for batch in _batches(calls, _BATCH):
+            bound = [_bind(function, *_call_arguments(call))
+                     for call in batch]
+            _cache_map(function, bound, executor)
+            count += len(batch)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return count
@@ -5,10 +5,26 @@ import unittest
 import imp
 import time
 import random
+import shutil
+import traceback as _traceback
 import os
 
 import functioncache
 import tempfile
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    boto3 = None
+
+Point = collections.namedtuple('Point', 'x y')
 
 _CACHE_ROOT = "/tmp/.functioncache"
 
@@ -29,7 +45,6 @@ def erase_all_cache_files():
         if fname.endswith(shelve_suffixes) and os.path.exists(fpath):
             os.remove(fpath)
 
-    import shutil
     shutil.rmtree(_CACHE_ROOT, ignore_errors=True)
 
 
@@ -240,6 +255,2770 @@ class TestFunctioncache(unittest.TestCase):
         assert spec.defaults == (None,)
 
 
+class TestKeyBuilders(unittest.TestCase):
+
+    def test_digest_is_stable_and_compact(self):
+        args = ('a' * 10000, list(range(1000)), {'x': (1, 2.5, None)})
+        first = functioncache.digest_arguments(args, {'flag': True})
+        second = functioncache.digest_arguments(args, {'flag': True})
+        self.assertEqual(first, second)
+        self.assertEqual(len(first), 41)
+
+    def test_digest_distinguishes_types(self):
+        keys = set(
+            functioncache.digest_arguments((value,), {})
+            for value in [1, 1.0, '1', b'1', (1,), [1], True, None,
+                          set([1]), frozenset([1]), {1: 1}])
+        self.assertEqual(len(keys), 11)
+
+    def test_digest_ignores_ordering(self):
+        digest = functioncache.digest_arguments
+        self.assertEqual(digest((), {'a': 1, 'b': 2}),
+                         digest((), {'b': 2, 'a': 1}))
+        self.assertEqual(digest(({'x': 1, 2: 'y'},), {}),
+                         digest(({2: 'y', 'x': 1},), {}))
+        self.assertEqual(digest((set(['a', 3, None]),), {}),
+                         digest((set([None, 3, 'a']),), {}))
+        self.assertNotEqual(digest((1, 2), {}), digest((2, 1), {}))
+
+    def test_digest_falls_back_to_pickle(self):
+        import decimal
+        digest = functioncache.digest_arguments
+        self.assertNotEqual(digest(((1, 2),), {}), digest((Point(1, 2),), {}))
+        self.assertEqual(digest((decimal.Decimal('1.5'),), {}),
+                         digest((decimal.Decimal('1.5'),), {}))
+        self.assertRaises(functioncache.PicklingError,
+                          digest, (lambda: None,), {})
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def test_digest_unbuffered_arrays(self):
+        digest = functioncache.digest_arguments
+        dates = numpy.array(['2020-01-01', '2020-01-02'], dtype='datetime64[D]')
+        later = dates + numpy.timedelta64(1, 'D')
+        self.assertEqual(digest((dates,), {}), digest((dates.copy(),), {}))
+        self.assertNotEqual(digest((dates,), {}), digest((later,), {}))
+        self.assertNotEqual(digest((later - dates,), {}),
+                            digest((later - later,), {}))
+        self.assertNotEqual(digest((numpy.zeros(0),), {}),
+                            digest((numpy.zeros((0, 2)),), {}))
+
+    def test_pickle_arguments_builder(self):
+        @functioncache.functioncache(
+            backend=functioncache.DictBackend(),
+            key_builder=functioncache.pickle_arguments)
+        def legacy(x):
+            return x
+
+        self.assertEqual(legacy(3), 3)
+        key = functioncache._args_key(
+            legacy, (3,), {}, key_builder=functioncache.pickle_arguments)
+        self.assertTrue(key.startswith('legacy('))
+        self.assertIn(key, legacy._db)
+
+
+class CountingBackend(functioncache.DictBackend):
+
+    """ a DictBackend which counts the lookups which reach it """
+
+    def __init__(self):
+        functioncache.DictBackend.__init__(self)
+        self.reads = 0
+
+    def get(self, key, default=None):
+        self.reads += 1
+        return functioncache.DictBackend.get(self, key, default)
+
+
+class TestTieredBackend(unittest.TestCase):
+
+    def test_hits_are_served_from_memory(self):
+        inner = CountingBackend()
+        tiered = functioncache.TieredBackend(inner)
+
+        @functioncache.functioncache(60, backend=tiered)
+        def double(x):
+            return x * 2
+
+        for _ in range(5):
+            self.assertEqual(double(21), 42)
+        # only the first lookup (a miss) reached the inner backend
+        self.assertEqual(inner.reads, 1)
+
+        stats = tiered.stats()
+        self.assertEqual(stats['memory']['hits'], 4)
+        self.assertEqual(stats['memory']['misses'], 1)
+        self.assertEqual(stats['backend']['misses'], 1)
+        self.assertAlmostEqual(stats['memory']['hit_ratio'], 0.8)
+
+    def test_promotes_backend_hits(self):
+        inner = CountingBackend()
+        tiered = functioncache.TieredBackend(inner)
+        inner['k'] = functioncache._retval(time.time(), 'v')
+        self.assertEqual(tiered['k'].data, 'v')
+        self.assertEqual(tiered['k'].data, 'v')
+        self.assertEqual(inner.reads, 1)
+        self.assertEqual(tiered.stats()['backend']['hits'], 1)
+
+    def test_entry_bound(self):
+        inner = CountingBackend()
+        tiered = functioncache.TieredBackend(inner, max_entries=2)
+        for key in 'abc':
+            tiered[key] = functioncache._retval(time.time(), key)
+        self.assertEqual(tiered.stats()['memory']['entries'], 2)
+        # 'a' was evicted from memory but is still in the backend
+        self.assertEqual(tiered['a'].data, 'a')
+        self.assertEqual(inner.reads, 1)
+
+    def test_byte_bound(self):
+        tiered = functioncache.TieredBackend(
+            functioncache.DictBackend(), max_entries=None, max_bytes=100,
+            sizeof=lambda value: len(value.data))
+        tiered['small'] = functioncache._retval(time.time(), 'x' * 60)
+        tiered['large'] = functioncache._retval(time.time(), 'x' * 200)
+        tiered['other'] = functioncache._retval(time.time(), 'x' * 60)
+        stats = tiered.stats()['memory']
+        self.assertEqual((stats['entries'], stats['bytes']), (1, 60))
+        self.assertEqual(tiered['large'].data, 'x' * 200)
+
+    def test_ttl(self):
+        inner = CountingBackend()
+        tiered = functioncache.TieredBackend(inner, ttl=0.05)
+        tiered['k'] = functioncache._retval(time.time(), 'v')
+        tiered['k']
+        self.assertEqual(inner.reads, 0)
+        time.sleep(0.06)
+        tiered['k']
+        self.assertEqual(inner.reads, 1)
+
+    def test_sweep(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        tiered = functioncache.TieredBackend(functioncache.ShelveBackend())
+        tiered.backend.setup_path(os.path.join(root, 'module.py.cache'))
+        self.addCleanup(tiered.backend.close)
+        tiered['old-'] = functioncache._retval(time.time() - 100, 'old')
+        tiered['new-'] = functioncache._retval(time.time(), 'new')
+        self.assertEqual(functioncache.sweep(tiered, 50), 1)
+        self.assertEqual(
+            [os.path.basename(entry.handle) for entry in tiered._entries()],
+            ['new-'])
+
+
+class RecordingBackend(functioncache.DictBackend):
+
+    """ a DictBackend which records its lifecycle """
+
+    def __init__(self):
+        functioncache.DictBackend.__init__(self)
+        self.events = []
+
+    def record(self, *event):
+        # copies of the backend don't share their record
+        self.events = self.events + [event]
+
+    def setup(self, function):
+        self.record('setup', function.__name__)
+
+    def flush(self):
+        self.record('flush')
+
+    def close(self):
+        self.record('close')
+
+
+def _define_elsewhere(name, backend):
+    """ a cached function defined in another module file """
+    namespace = {'functioncache': functioncache, 'backend': backend}
+    source = ('@functioncache.functioncache(60, backend=backend)\n'
+              'def %s(x):\n'
+              '    return x\n' % name)
+    exec(compile(source, '/elsewhere/%s.py' % name, 'exec'), namespace)
+    return namespace[name]
+
+
+class TestBackendLifecycle(unittest.TestCase):
+
+    def test_opened_on_first_call(self):
+        backend = RecordingBackend()
+
+        @functioncache.functioncache(60, backend=backend)
+        def opened_lazily(x):
+            return x
+
+        self.assertEqual(backend.events, [])
+        self.assertEqual(opened_lazily(1), 1)
+        self.assertEqual(backend.events, [('setup', 'opened_lazily')])
+        self.assertIs(opened_lazily._db, backend)
+        opened_lazily(2)
+        self.assertEqual(len(backend.events), 1)
+
+    def test_instances_are_not_shared(self):
+        first, second = RecordingBackend(), RecordingBackend()
+
+        @functioncache.functioncache(60, backend=first)
+        def uses_first(x):
+            return x
+
+        @functioncache.functioncache(60, backend=second)
+        def uses_second(x):
+            return x
+
+        uses_first(1)
+        uses_second(1)
+        self.assertIs(uses_first._db, first)
+        self.assertIs(uses_second._db, second)
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+
+    def test_class_is_shared_by_module(self):
+
+        @functioncache.functioncache(60, backend=RecordingBackend)
+        def shares_class(x):
+            return x
+
+        @functioncache.functioncache(60, backend=RecordingBackend)
+        def shares_class_too(x):
+            return x
+
+        elsewhere = _define_elsewhere('shares_class', RecordingBackend)
+        shares_class(1)
+        shares_class_too(1)
+        elsewhere(1)
+        self.assertIs(shares_class._db, shares_class_too._db)
+        self.assertIsNot(shares_class._db, elsewhere._db)
+        self.assertEqual(shares_class._db.events, [('setup', 'shares_class')])
+
+    def test_instance_given_to_two_modules(self):
+        backend = RecordingBackend()
+
+        @functioncache.functioncache(60, backend=backend)
+        def here(x):
+            return x
+
+        elsewhere = _define_elsewhere('there', backend)
+        here(1)
+        elsewhere(1)
+        # each module sets up its own copy, neither is set up twice
+        self.assertIs(here._db, backend)
+        self.assertIsNot(elsewhere._db, backend)
+        self.assertEqual(backend.events, [('setup', 'here')])
+        self.assertEqual(elsewhere._db.events, [('setup', 'there')])
+
+    def test_wrapped_instance_given_to_two_modules(self):
+        backend = functioncache.TieredBackend(functioncache.FileBackend())
+        functions = []
+        for module in ('a', 'b'):
+            namespace = {'functioncache': functioncache, 'backend': backend}
+            source = ('@functioncache.functioncache(60, backend=backend)\n'
+                      'def f(x):\n'
+                      '    return (%r, x)\n' % module)
+            exec(compile(source, '/modules/%s.py' % module, 'exec'),
+                 namespace)
+            functions.append(namespace['f'])
+        in_a, in_b = functions
+        self.assertEqual(in_a(2), ('a', 2))
+        self.assertEqual(in_b(2), ('b', 2))
+        self.assertIsNot(in_a._db.backend, in_b._db.backend)
+        self.assertNotEqual(in_a._db.backend.dir_name,
+                            in_b._db.backend.dir_name)
+
+    def module_of(self, backends):
+        """ functions f0, f1, ... of a new module file, each cached with the
+        backend made by the next of backends """
+        namespace = {'functioncache': functioncache, 'backends': backends}
+        source = ''.join(
+            '@functioncache.functioncache(60, backend=backends[%d]())\n'
+            'def f%d(x):\n'
+            '    return (%d, x)\n' % (i, i, i) for i in range(len(backends)))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(shutil.rmtree, functioncache._CACHE_ROOT + directory,
+                        True)
+        path = os.path.join(directory, 'module.py')
+        exec(compile(source, path, 'exec'), namespace)
+        functions = [namespace['f%d' % i] for i in range(len(backends))]
+        self.addCleanup(functions[0].cache_close)
+        return functions
+
+    def test_file_instances_shared_by_module(self):
+        for backend in (functioncache.ShelveBackend, functioncache.LogBackend,
+                        functioncache.FileBackend):
+            first, second = self.module_of([backend, backend])
+            for _ in range(2):
+                self.assertEqual([first(1), second(1)], [(0, 1), (1, 1)])
+            self.assertIs(first._db, second._db)
+            first.cache_close()
+            # neither function's entries were overwritten by the other
+            self.assertEqual([first(1), second(1)], [(0, 1), (1, 1)])
+            self.assertEqual(first.cache_stats()['hits'], 2)
+            self.assertEqual(second.cache_stats()['hits'], 2)
+
+    def test_other_settings_warned_about(self):
+        import warnings
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            first, second = self.module_of([
+                functioncache.ShelveBackend,
+                lambda: functioncache.ShelveBackend(flush_every=1)])
+        self.assertEqual([w.category for w in caught], [RuntimeWarning])
+        self.assertIn('f1', str(caught[0].message))
+        self.assertIs(first.cache_open(), second.cache_open())
+
+    def test_settings_filled_in_when_opened(self):
+        import warnings
+        tiered = lambda: functioncache.TieredBackend(
+            functioncache.FileBackend())
+        first, = self.module_of([tiered])
+        first(1)
+        # setup set the tier's ttl, a later instance made alike still matches
+        namespace = {'functioncache': functioncache, 'backend': tiered()}
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            exec(compile('@functioncache.functioncache(60, backend=backend)\n'
+                         'def later(x):\n'
+                         '    return x\n', inspect.getfile(first.__wrapped__),
+                         'exec'),
+                 namespace)
+        self.assertEqual(namespace['later'](2), 2)
+        self.assertIs(namespace['later']._db, first._db)
+
+    def test_functions_defined_on_the_fly_are_forgotten(self):
+        import gc
+
+        def handler(x):
+            @functioncache.dictcache()
+            def helper(y):
+                return y * 2
+            return helper(x)
+
+        gc.collect()
+        before = (len(functioncache._BACKENDS), len(functioncache.OPEN_DBS),
+                  len(functioncache._STATS_REGISTRY))
+        for x in range(20):
+            self.assertEqual(handler(x), x * 2)
+        gc.collect()
+        self.assertEqual((len(functioncache._BACKENDS),
+                          len(functioncache.OPEN_DBS),
+                          len(functioncache._STATS_REGISTRY)), before)
+
+    def test_flush_and_close(self):
+        backend = RecordingBackend()
+
+        @functioncache.functioncache(60, backend=backend)
+        def closed(x):
+            return x
+
+        closed.cache_open()
+        closed.cache_flush()
+        closed.cache_close()
+        self.assertEqual(backend.events,
+                         [('setup', 'closed'), ('flush',), ('close',)])
+        # closing again does nothing, the next call opens it again
+        closed.cache_close()
+        closed(1)
+        self.assertEqual(backend.events[-1], ('setup', 'closed'))
+        self.assertIs(closed._db, backend)
+        functioncache.close_all()
+        self.assertEqual(backend.events[-1], ('close',))
+
+
+class TempDirMixin(object):
+
+    """
+    a temporary directory, self.root, for each test.  backend() sets up a
+    BACKEND at self.path, a FILENAME in it.
+    """
+
+    BACKEND = functioncache.FileBackend
+    FILENAME = 'module.py.cached'
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.path = os.path.join(self.root, self.FILENAME)
+
+    def backend(self, **kwargs):
+        backend = self.BACKEND(**kwargs)
+        backend.setup_path(self.path)
+        return backend
+
+
+class TestEviction(TempDirMixin, unittest.TestCase):
+
+    def file_backend(self):
+        backend = functioncache.FileBackend()
+        backend.setup_path(os.path.join(self.root, 'module.py.cached'))
+        return backend
+
+    def shelve_backend(self):
+        backend = functioncache.ShelveBackend()
+        backend.setup_path(os.path.join(self.root, 'module.py.cache'))
+        return backend
+
+    def check_sweep(self, backend):
+        now = time.time()
+        backend['f-old'] = functioncache._retval(now - 100, 1)
+        backend['f-new'] = functioncache._retval(now, 2)
+        backend['g-old'] = functioncache._retval(now - 100, 3)
+        if isinstance(backend, functioncache.FileBackend):
+            # FileBackend goes by the time the file was written
+            for key in ('f-old', 'g-old'):
+                os.utime(backend._get_filename(key), (now - 100, now - 100))
+
+        self.assertEqual(functioncache.sweep(backend, 50, prefix='f-'), 1)
+        self.assertNotIn('f-old', backend)
+        self.assertIn('f-new', backend)
+        self.assertIn('g-old', backend)
+        self.assertEqual(functioncache.sweep(backend, 50), 1)
+        self.assertNotIn('g-old', backend)
+
+    def test_sweep_files(self):
+        self.check_sweep(self.file_backend())
+
+    def test_sweep_shelve(self):
+        backend = self.shelve_backend()
+        self.check_sweep(backend)
+        backend.close()
+
+    def test_evict_lru(self):
+        backend = self.shelve_backend()
+        backend.track_access = True
+        for key in 'abcd':
+            backend[key] = functioncache._retval(time.time(), key)
+        backend.get('a')
+        self.assertEqual(functioncache.evict(backend, max_entries=2), 2)
+        self.assertEqual(sorted(backend.shelve.keys()), ['a', 'd'])
+        backend.close()
+
+    def test_evict_lfu_by_bytes(self):
+        backend = self.file_backend()
+        backend.track_access = True
+        for key in 'abc':
+            backend[key] = functioncache._retval(time.time(), 'x' * 1000)
+        for _ in range(3):
+            backend.get('a')
+        backend.get('c')
+        removed = functioncache.evict(
+            backend, max_bytes=2500, policy=functioncache.LFU)
+        self.assertEqual(removed, 1)
+        self.assertNotIn('b', backend)
+
+    def test_background_sweeper(self):
+        backend = self.file_backend()
+        backend['ticking-stale'] = functioncache._retval(time.time() - 100, 0)
+        old = time.time() - 100
+        os.utime(backend._get_filename('ticking-stale'), (old, old))
+
+        def ticking(x):
+            return x
+
+        ticking._db = backend
+        ticking = functioncache.functioncache(
+            50, function_key=lambda fn: 'ticking', sweep_every=2)(ticking)
+        ticking(1)
+        self.assertIn('ticking-stale', backend)
+        ticking(2)
+        ticking._sweeper.thread.join()
+        self.assertNotIn('ticking-stale', backend)
+        self.assertEqual(len(list(backend._entries())), 2)
+
+    def test_gc_command(self):
+        from functioncache.__main__ import main
+        backend = self.file_backend()
+        backend['stale'] = functioncache._retval(time.time(), 0)
+        old = time.time() - 1000
+        os.utime(backend._get_filename('stale'), (old, old))
+        backend['fresh'] = functioncache._retval(time.time(), 0)
+        shelf = self.shelve_backend()
+        shelf['stale'] = functioncache._retval(time.time() - 1000, 0)
+        shelf.close()
+
+        self.assertEqual(main(['gc', '--root', self.root, '--max-age', '500']), 0)
+        self.assertNotIn('stale', backend)
+        self.assertIn('fresh', backend)
+        shelf = self.shelve_backend()
+        self.assertNotIn('stale', shelf)
+        shelf.close()
+
+
+class TestFileLayout(TempDirMixin, unittest.TestCase):
+
+    def test_sharded(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, 'one')
+        filename = backend._get_filename('f-1')
+        shards = os.path.relpath(filename, self.path).split(os.sep)
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(shards[-1], 'f-1')
+        self.assertTrue(all(len(shard) == 2 for shard in shards[:2]))
+        self.assertEqual(backend['f-1'], (1.0, 'one'))
+        self.assertEqual([entry.handle for entry in backend._entries()],
+                         [filename])
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+
+    def test_no_temporary_files_left(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, 'one')
+        backend['f-1'] = functioncache._retval(2.0, 'two')
+        with self.assertRaises(TypeError):
+            backend['f-2'] = functioncache._retval(1.0, lambda: None)
+        self.assertEqual(backend['f-1'], (2.0, 'two'))
+        self.assertNotIn('f-2', backend)
+        self.assertEqual(
+            [name for name in os.listdir(self.path) if name.startswith('.')],
+            [])
+
+    def write_flat(self):
+        flat = self.backend(shard_depth=0)
+        flat['f-1'] = functioncache._retval(1.0, 'one')
+        flat['f-2'] = functioncache._retval(2.0, 'two')
+        self.assertEqual(sorted(os.listdir(self.path)), ['f-1', 'f-2'])
+
+    def test_reads_flat_layout(self):
+        self.write_flat()
+        backend = self.backend()
+        self.assertIn('f-1', backend)
+        self.assertEqual(backend['f-2'], (2.0, 'two'))
+        backend['f-2'] = functioncache._retval(3.0, 'three')
+        self.assertEqual(backend['f-2'], (3.0, 'three'))
+        self.assertEqual(len(list(backend._entries())), 3)
+
+    def test_migrate(self):
+        self.write_flat()
+        backend = self.backend()
+        backend['f-2'] = functioncache._retval(3.0, 'three')
+        self.assertEqual(backend.migrate(), 1)
+        self.assertEqual(list(backend._flat_entries()), [])
+        self.assertFalse(backend._flat)
+        self.assertEqual(backend['f-1'], (1.0, 'one'))
+        self.assertEqual(backend['f-2'], (3.0, 'three'))
+
+    def test_migrate_command(self):
+        from functioncache.__main__ import main
+        self.write_flat()
+        self.assertEqual(main(['migrate', '--root', self.root]), 0)
+        backend = self.backend()
+        self.assertFalse(backend._flat)
+        self.assertEqual(backend['f-1'], (1.0, 'one'))
+
+
+class TestDedup(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.files = TempDirMixin.backend(self)
+        self.backend = functioncache.DedupBackend(self.files, min_size=100)
+
+    def blobs(self):
+        return sorted(os.path.basename(entry.handle)
+                      for entry in self.files._entries('blob-'))
+
+    def test_identical_values_share_a_blob(self):
+        page = 'x' * 1000
+        self.backend['f-a'] = functioncache._retval(time.time(), page)
+        self.backend['f-b'] = functioncache._retval(time.time(), page)
+        self.assertEqual(len(self.blobs()), 1)
+        self.assertEqual(self.backend['f-a'].data, page)
+        found = self.backend.get_many(['f-a', 'f-b', 'f-c'])
+        self.assertEqual(sorted(found), ['f-a', 'f-b'])
+        # the pointers are small, the page is on disk once
+        sizes = dict((os.path.basename(entry.handle), entry.size)
+                     for entry in self.files._entries(sizes=True))
+        self.assertLess(sizes['f-a'], 200)
+        self.assertGreater(sizes[self.blobs()[0]], 1000)
+
+    def test_small_values_are_inline(self):
+        self.backend['f-a'] = functioncache._retval(time.time(), 'small')
+        self.assertEqual(self.blobs(), [])
+        self.assertEqual(self.files['f-a'].data, 'small')
+
+    def test_last_reference_frees_the_blob(self):
+        page = 'x' * 1000
+        self.backend['f-a'] = functioncache._retval(time.time(), page)
+        self.backend['f-b'] = functioncache._retval(time.time(), page)
+        del self.backend['f-a']
+        self.assertEqual(self.backend.collect(), 0)
+        self.assertEqual(len(self.blobs()), 1)
+        # overwriting f-b drops the last reference to page
+        self.backend['f-b'] = functioncache._retval(time.time(), 'y' * 1000)
+        self.assertEqual(self.backend.collect(), 1)
+        self.assertEqual(len(self.blobs()), 1)
+        self.assertEqual(self.backend['f-b'].data, 'y' * 1000)
+        self.assertNotIn('f-a', self.backend)
+
+    def test_references_are_entries_of_their_own(self):
+        page = 'x' * 1000
+        written = []
+
+        class Files(functioncache.FileBackend):
+            def __setitem__(self, key, value):
+                written.append(key)
+                functioncache.FileBackend.__setitem__(self, key, value)
+
+        self.files = Files()
+        self.files.setup_path(os.path.join(self.root, 'counted.py.cached'))
+        self.backend = functioncache.DedupBackend(self.files, min_size=100)
+        for i in range(50):
+            self.backend['f-%d' % i] = functioncache._retval(time.time(), page)
+        refs = [entry for entry in self.files._entries(sizes=True)
+                if os.path.basename(entry.handle).startswith('refs-')]
+        self.assertEqual(len(refs), 50)
+        # none of them holds the other keys
+        self.assertLess(max(entry.size for entry in refs), 200)
+        # the blob once, then a reference and a pointer per key
+        self.assertEqual(len(written), 101)
+        self.assertEqual(self.backend.collect(), 0)
+        for i in range(49):
+            del self.backend['f-%d' % i]
+        self.assertEqual(self.backend.collect(), 0)
+        self.assertEqual(self.backend['f-49'].data, page)
+
+    def test_old_reference_sets(self):
+        page = 'x' * 1000
+        self.backend['f-a'] = functioncache._retval(time.time(), page)
+        (blob,) = self.blobs()
+        digest = blob[len('blob-'):]
+        for entry in list(self.files._entries('refs-')):
+            self.files._remove(entry.handle)
+        # the single entry earlier versions kept all references in
+        self.files['refs-' + digest] = functioncache._retval(
+            time.time(), frozenset(['f-a', 'f-gone']))
+        self.assertEqual(self.backend.collect(), 0)
+        del self.files['f-a']
+        self.assertEqual(self.backend.collect(), 1)
+        self.assertEqual(self.blobs(), [])
+
+    def test_collect_after_eviction(self):
+        for key in ('f-a', 'f-b', 'f-c'):
+            self.backend[key] = functioncache._retval(time.time(), key * 500)
+        self.backend['f-d'] = functioncache._retval(time.time(), 'f-c' * 500)
+        # blobs aren't entries of their own, only keys are evicted
+        self.assertEqual(len(list(self.backend._entries())), 4)
+        functioncache.evict(self.backend, max_entries=1, prefix='f-')
+        self.assertEqual(len(self.blobs()), 3)
+        self.assertEqual(self.backend.collect(), 2)
+        self.assertEqual(len(self.blobs()), 1)
+        (key,) = [entry.handle for entry in self.backend._entries()]
+        self.assertIn(os.path.basename(key), ('f-c', 'f-d'))
+
+    def test_missing_blob_is_a_miss(self):
+        self.backend['f-a'] = functioncache._retval(time.time(), 'x' * 1000)
+        for entry in list(self.files._entries('blob-')):
+            self.files._remove(entry.handle)
+        self.assertIsNone(self.backend.get('f-a'))
+        self.assertEqual(self.backend.get_many(['f-a']), {})
+
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DedupBackend(
+            functioncache.DictBackend(), min_size=10))
+        def fetch_deduplicated(url):
+            calls.append(url)
+            return 'page' * 100
+
+        for url in ('a', 'b', 'a'):
+            self.assertEqual(fetch_deduplicated(url), 'page' * 100)
+        self.assertEqual(calls, ['a', 'b'])
+        blobs = [key for key in fetch_deduplicated._db.backend
+                 if key.startswith('blob-')]
+        self.assertEqual(len(blobs), 1)
+
+
+class TestLogBackend(TempDirMixin, unittest.TestCase):
+
+    BACKEND = functioncache.LogBackend
+    FILENAME = 'module.py.cache.log'
+
+    def files(self, suffix):
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(suffix))
+
+    def test_roundtrip(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, {'a': 1})
+        backend.set_many({'f-2': functioncache._retval(2.0, 'two'),
+                          'f-3': functioncache._retval(3.0, 'three')})
+        self.assertEqual(backend['f-1'], (1.0, {'a': 1}))
+        self.assertEqual(backend.get_many(['f-2', 'f-4']),
+                         {'f-2': (2.0, 'two')})
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+        self.assertRaises(KeyError, backend.__delitem__, 'f-1')
+        backend.close()
+
+        backend = self.backend()
+        self.assertNotIn('f-1', backend)
+        self.assertEqual(backend['f-3'].data, 'three')
+        backend.close()
+
+    def test_expiry(self):
+        backend = self.backend()
+        backend.set('f-1', functioncache._retval(time.time(), 'x'), 0.05)
+        backend['f-2'] = functioncache._retval(time.time(), 'y')
+        time.sleep(0.1)
+        self.assertNotIn('f-1', backend)
+        self.assertIn('f-2', backend)
+        backend.close()
+
+    def test_rotation_and_hints(self):
+        backend = self.backend(segment_bytes=500, compact_ratio=1.0)
+        for i in range(100):
+            backend['f-%d' % i] = functioncache._retval(1.0, i)
+        del backend['f-7']
+        segments = len(self.files('.data'))
+        self.assertGreater(segments, 5)
+        # every closed segment has its hint
+        self.assertEqual(len(self.files('.hint')), segments - 1)
+        backend.close()
+
+        backend = self.backend(segment_bytes=500)
+        self.assertEqual(len(list(backend._entries())), 99)
+        self.assertEqual(backend['f-42'].data, 42)
+        self.assertNotIn('f-7', backend)
+        backend.close()
+
+    def test_recovers_without_hints(self):
+        backend = self.backend()
+        for i in range(10):
+            backend['f-%d' % i] = functioncache._retval(1.0, i)
+        backend.flush()
+        # the process died: no hint, and half a record at the end.  Its
+        # lock went with it
+        os.close(backend._lock_file)
+        name, = self.files('.data')
+        with open(os.path.join(self.path, name), 'ab') as segment:
+            segment.write(b'\x00' * 10)
+
+        recovered = self.backend()
+        self.assertEqual(len(list(recovered._entries())), 10)
+        self.assertEqual(recovered['f-9'].data, 9)
+        recovered['f-10'] = functioncache._retval(1.0, 10)
+        recovered.close()
+
+        recovered = self.backend()
+        self.assertEqual(recovered['f-10'].data, 10)
+        recovered.close()
+
+    def test_one_backend_per_directory(self):
+        from functioncache.__main__ import main
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, 1)
+        self.assertRaises(functioncache.LogLockedError, self.backend)
+        # gc leaves directories in use alone
+        self.assertEqual(main(['gc', '--root', self.root, '--max-age', '1']),
+                         0)
+        self.assertEqual(backend['f-1'].data, 1)
+        backend.close()
+        reopened = self.backend()
+        self.assertEqual(reopened['f-1'].data, 1)
+        reopened.close()
+
+    def test_compaction(self):
+        backend = self.backend(segment_bytes=1000, compact_ratio=1.0)
+        for version in range(10):
+            for i in range(20):
+                backend['f-%d' % i] = functioncache._retval(
+                    1.0, (version, 'x' * 20))
+        backend.set('f-expiring', functioncache._retval(1.0, 'x'), 0.01)
+        for i in range(50):
+            backend['g-%d' % i] = functioncache._retval(1.0, i)
+        time.sleep(0.02)
+        size = sum(os.path.getsize(os.path.join(self.path, name))
+                   for name in self.files('.data'))
+        self.assertGreater(backend.compact(), size / 2)
+        self.assertEqual(backend['f-3'].data, (9, 'x' * 20))
+        self.assertNotIn('f-expiring', backend)
+        backend.close()
+
+        backend = self.backend()
+        self.assertEqual(backend['f-19'].data, (9, 'x' * 20))
+        self.assertEqual(len(list(backend._entries())), 70)
+        backend.close()
+
+    def test_background_compaction(self):
+        backend = self.backend(segment_bytes=1000, compact_ratio=0.5)
+        for version in range(20):
+            for i in range(10):
+                backend['f-%d' % i] = functioncache._retval(1.0, version)
+        backend._compaction.join()
+        size = sum(os.path.getsize(os.path.join(self.path, name))
+                   for name in self.files('.data'))
+        self.assertLess(size, 3000)
+        self.assertEqual(backend['f-5'].data, 19)
+        backend.close()
+
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.logcache(60)
+        def logged_square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(logged_square(3), 9)
+        self.assertEqual(logged_square(3), 9)
+        self.assertEqual(calls, [3])
+        logged_square.cache_close()
+
+
+class TestShelveWriteBuffer(TempDirMixin, unittest.TestCase):
+
+    BACKEND = functioncache.ShelveBackend
+    FILENAME = 'module.py.cache'
+
+    def on_disk(self, backend):
+        return sorted(backend.shelve.keys())
+
+    def test_flush_every(self):
+        backend = self.backend(flush_every=3, flush_interval=None)
+        backend['a'] = functioncache._retval(time.time(), 1)
+        backend['b'] = functioncache._retval(time.time(), 2)
+        # buffered entries are visible before they are written
+        self.assertEqual(backend['a'].data, 1)
+        self.assertIn('b', backend)
+        self.assertEqual(self.on_disk(backend), [])
+        backend['c'] = functioncache._retval(time.time(), 3)
+        self.assertEqual(self.on_disk(backend), ['a', 'b', 'c'])
+        backend.close()
+
+    def test_flush_interval(self):
+        backend = self.backend(flush_every=100, flush_interval=0.05)
+        backend['a'] = functioncache._retval(time.time(), 1)
+        time.sleep(0.2)
+        self.assertEqual(self.on_disk(backend), ['a'])
+        backend.close()
+
+    def test_unbuffered(self):
+        backend = self.backend(flush_every=1)
+        backend['a'] = functioncache._retval(time.time(), 1)
+        self.assertEqual(self.on_disk(backend), ['a'])
+        backend.close()
+
+    def test_close_flushes(self):
+        backend = self.backend(flush_interval=None)
+        backend['a'] = functioncache._retval(time.time(), 1)
+        del backend['a']
+        backend['b'] = functioncache._retval(time.time(), 2)
+        backend.close()
+        self.assertEqual(sorted(self.backend().shelve.keys()), ['b'])
+
+    def test_survives_sigterm(self):
+        import signal
+        import subprocess
+        import sys
+        script = (
+            'import os, signal, time, functioncache\n'
+            'backend = functioncache.ShelveBackend(flush_interval=None)\n'
+            'backend.setup_path(%r)\n'
+            'backend["a"] = functioncache._retval(time.time(), 1)\n'
+            'os.kill(os.getpid(), signal.SIGTERM)\n'
+            'time.sleep(10)\n' % self.path)
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ,
+                   PYTHONPATH=os.path.dirname(here))
+        process = subprocess.Popen([sys.executable, '-c', script], env=env)
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+        backend = self.backend()
+        self.assertEqual(backend['a'].data, 1)
+        backend.close()
+
+    def test_first_call_from_a_thread_survives_sigterm(self):
+        import signal
+        import subprocess
+        import sys
+        script = (
+            'import os, signal, threading, time, functioncache\n'
+            'functioncache._CACHE_ROOT = %r\n'
+            '@functioncache.functioncache(\n'
+            '    backend=functioncache.ShelveBackend(flush_interval=None))\n'
+            'def f(x):\n'
+            '    return x\n'
+            'worker = threading.Thread(target=f, args=(1,))\n'
+            'worker.start()\n'
+            'worker.join()\n'
+            'os.kill(os.getpid(), signal.SIGTERM)\n'
+            'time.sleep(10)\n' % self.root)
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ,
+                   PYTHONPATH=os.path.dirname(here))
+        process = subprocess.Popen([sys.executable, '-c', script], env=env,
+                                   cwd=self.root)
+        self.assertEqual(process.wait(), -signal.SIGTERM)
+        backend = functioncache.ShelveBackend()
+        # the cache of code run with -c is named after '<string>'
+        backend.setup_path(self.root + os.path.join(self.root,
+                                                    '_lt_string_gt_.cache'))
+        self.assertEqual(len(list(backend.shelve.keys())), 1)
+        backend.close()
+
+
+def _write_sqlite_entries(path, offset):
+    backend = functioncache.SqliteBackend()
+    backend.setup_path(path)
+    for i in range(50):
+        backend['f-%d' % (offset + i)] = functioncache._retval(time.time(), i)
+    backend.close()
+
+
+class TestSqliteBackend(TempDirMixin, unittest.TestCase):
+
+    BACKEND = functioncache.SqliteBackend
+    FILENAME = 'module.py.cache.sqlite'
+
+    def backend(self, **kwargs):
+        backend = TempDirMixin.backend(self, **kwargs)
+        self.addCleanup(backend.close)
+        return backend
+
+    def test_roundtrip(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(123.0, {'a': [1, 2]})
+        self.assertIn('f-1', backend)
+        self.assertNotIn('f-2', backend)
+        self.assertEqual(backend['f-1'], (123.0, {'a': [1, 2]}))
+        self.assertIs(backend.get('f-2'), None)
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+
+    def test_decorated(self):
+        calls = []
+
+        def squared(x):
+            calls.append(x)
+            return x * x
+
+        squared._db = self.backend()
+        squared = functioncache.functioncache(60)(squared)
+        self.assertEqual([squared(4), squared(4)], [16, 16])
+        self.assertEqual(calls, [4])
+
+    def test_writes_hold_no_lock(self):
+        writer = self.backend()
+        # raises "database is locked" rather than wait for the lock
+        other = self.backend(timeout=0)
+        writer['f-1'] = functioncache._retval(time.time(), 1)
+        self.assertIn('f-1', other)
+        other.set_many({'f-2': functioncache._retval(time.time(), 2),
+                        'f-3': functioncache._retval(time.time(), 3)})
+        self.assertEqual(sorted(writer.get_many(['f-2', 'f-3'])),
+                         ['f-2', 'f-3'])
+
+    def test_expire_and_sweep(self):
+        backend = self.backend()
+        now = time.time()
+
+        def key(name, i):
+            return '%s-%040x' % (name, i)
+
+        backend.set(key('f', 1), functioncache._retval(now - 100, 1), 10)
+        backend.set(key('f', 2), functioncache._retval(now, 2), 10)
+        backend.set(key('g', 3), functioncache._retval(now - 100, 3), None)
+        backend.set(key('f', 4), functioncache._retval(now - 100, 4), None)
+        self.assertEqual(backend.expire(), 1)
+        self.assertNotIn(key('f', 1), backend)
+        self.assertEqual(functioncache.sweep(backend, 50, prefix='f-'), 1)
+        self.assertEqual(
+            sorted(entry.handle for entry in backend._entries()),
+            [key('f', 2), key('g', 3)])
+
+    def test_concurrent_processes(self):
+        import multiprocessing
+        processes = [
+            multiprocessing.Process(
+                target=_write_sqlite_entries, args=(self.path, i * 1000))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        self.assertEqual(len(list(self.backend()._entries())), 200)
+
+
+@functioncache.functioncache(60, backend=functioncache.DictBackend())
+def cpu_bound(x, power=2):
+    return x ** power
+
+
+@functioncache.functioncache(
+    60, backend=functioncache.DictBackend(), executor='process')
+def cpu_bound_pooled(x):
+    return sum(i * i for i in range(x))
+
+
+class FakeMemcacheClient(object):
+
+    """
+    stands in for memcache.Client, counting round trips.  Clients given the
+    same data dict behave like connections to the same server.
+    """
+
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+        self.expiry = {}
+        self.round_trips = 0
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.round_trips += 1
+        self.data[key] = value
+        self.expiry[key] = time
+        return True
+
+    def delete(self, key):
+        self.round_trips += 1
+        return self.data.pop(key, None) is not None
+
+    def get_multi(self, keys):
+        self.round_trips += 1
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def set_multi(self, mapping, time=0):
+        self.round_trips += 1
+        self.data.update(mapping)
+        self.expiry.update((key, time) for key in mapping)
+        return []
+
+
+def cached_keys(function):
+    """ the keys of function in its (possibly shared) DictBackend """
+    return [key for key in function._db
+            if (key[0] == function.__name__ if isinstance(key, tuple)
+                else key.startswith(function.__name__ + '-'))]
+
+
+class TestMemcacheBackend(unittest.TestCase):
+
+    def backend(self, servers=('a:11211', 'b:11211', 'c:11211'), **kwargs):
+        self.servers = dict((server, {}) for server in servers)
+        self.clients = []
+
+        def connect(server):
+            client = FakeMemcacheClient(self.servers[server])
+            self.clients.append(client)
+            return client
+
+        return functioncache.MemcacheBackend(
+            servers=servers, client_factory=connect, **kwargs)
+
+    def round_trips(self):
+        return sum(client.round_trips for client in self.clients)
+
+    def test_one_get_per_lookup(self):
+        backend = self.backend()
+        self.assertIs(functioncache._db_get(backend, 'f-1'),
+                      functioncache._MISSING)
+        self.assertEqual(self.round_trips(), 1)
+        backend['f-1'] = functioncache._retval(1.0, 'x')
+        self.assertEqual(functioncache._db_get(backend, 'f-1'), (1.0, 'x'))
+        self.assertEqual(self.round_trips(), 3)
+
+    def test_consistent_hashing(self):
+        backend = self.backend()
+        keys = ['f-%040x' % i for i in range(300)]
+        backend.set_many(dict(
+            (key, functioncache._retval(1.0, key)) for key in keys))
+        # one set_multi per server
+        self.assertEqual(self.round_trips(), 3)
+        sizes = [len(data) for data in self.servers.values()]
+        self.assertEqual(sum(sizes), 300)
+        self.assertGreater(min(sizes), 50)
+
+        found = backend.get_many(keys + ['f-missing'])
+        self.assertEqual(sorted(found), keys)
+        self.assertEqual(self.round_trips(), 6)
+
+        placed = dict((key, backend._server(key)) for key in keys)
+        bigger = self.backend(('a:11211', 'b:11211', 'c:11211', 'd:11211'))
+        moved = [key for key in keys if bigger._server(key) != placed[key]]
+        self.assertTrue(all(bigger._server(key) == 'd:11211' for key in moved))
+        self.assertLess(len(moved), 150)
+
+    def test_expiry(self):
+        backend = self.backend(servers=('a:11211',))
+        value = functioncache._retval(1.0, 'x')
+        backend.set('f-1', value, 0.5)
+        backend.set('f-2', value, None)
+        backend.set_many({'f-3': value}, 60 * functioncache.DAY)
+        expiry = self.clients[0].expiry
+        self.assertEqual(expiry['f-1'], 1)
+        self.assertEqual(expiry['f-2'], 0)
+        # memcache reads long expiries as timestamps
+        self.assertAlmostEqual(expiry['f-3'], time.time() + 60 * 86400,
+                               delta=5)
+
+    def test_delete(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, 'x')
+        self.assertIn('f-1', backend)
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+        self.assertRaises(KeyError, backend.__getitem__, 'f-1')
+
+    def test_client_pool(self):
+        import threading
+        backend = self.backend(servers=('a:11211',), pool_size=2)
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_get(original):
+            def get(key):
+                with lock:
+                    in_use.append(key)
+                    peak.append(len(in_use))
+                time.sleep(0.01)
+                with lock:
+                    in_use.remove(key)
+                return original(key)
+            return get
+
+        factory = backend._pools['a:11211'].create
+
+        def patched():
+            client = factory()
+            client.get = slow_get(client.get)
+            return client
+
+        backend._pools['a:11211'].create = patched
+        threads = [threading.Thread(target=backend.get, args=('f-%d' % i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.clients), 2)
+        self.assertEqual(max(peak), 2)
+
+
+class FakeRedis(object):
+
+    """ stands in for redis.Redis, counting round trips """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.round_trips = 0
+
+    def _live(self, name):
+        if name in self.expires and self.expires[name] <= time.time():
+            del self.data[name]
+            del self.expires[name]
+        return name in self.data
+
+    def get(self, name):
+        self.round_trips += 1
+        return self.data[name] if self._live(name) else None
+
+    def exists(self, name):
+        self.round_trips += 1
+        return int(self._live(name))
+
+    def set(self, name, value, px=None, nx=False):
+        self.round_trips += 1
+        if nx and self._live(name):
+            return None
+        if isinstance(value, str):
+            value = value.encode()
+        self.data[name] = value
+        self.expires.pop(name, None)
+        if px is not None:
+            self.expires[name] = time.time() + px / 1000.0
+        return True
+
+    def delete(self, name):
+        self.round_trips += 1
+        if not self._live(name):
+            return 0
+        del self.data[name]
+        self.expires.pop(name, None)
+        return 1
+
+    def mget(self, names):
+        self.round_trips += 1
+        return [self.data[name] if self._live(name) else None
+                for name in names]
+
+    def mset(self, mapping):
+        self.round_trips += 1
+        for name, value in mapping.items():
+            self.data[name] = value
+            self.expires.pop(name, None)
+        return True
+
+    def eval(self, script, numkeys, *keys_and_args):
+        # only RedisBackend's compare-and-delete script is understood
+        self.round_trips += 1
+        name, token = keys_and_args
+        if self._live(name) and self.data[name] == token.encode():
+            del self.data[name]
+            self.expires.pop(name, None)
+            return 1
+        return 0
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+    def scan_iter(self, match='*', count=None):
+        import fnmatch
+        self.round_trips += 1
+        return [name for name in list(self.data)
+                if self._live(name) and fnmatch.fnmatchcase(name, match)]
+
+
+class FakeRedisPipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.calls.append(
+            (method, args, kwargs))
+
+    def execute(self):
+        results = [method(*args, **kwargs)
+                   for method, args, kwargs in self.calls]
+        self.redis.round_trips -= len(self.calls) - 1
+        self.calls = []
+        return results
+
+
+class TestRedisBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.backend = functioncache.RedisBackend(self.redis)
+
+    def test_roundtrip(self):
+        backend = self.backend
+        backend.set('f-1', functioncache._retval(1.0, {'a': 1}), 60)
+        self.assertEqual(backend['f-1'], (1.0, {'a': 1}))
+        self.assertIn('f-1', backend)
+        self.assertEqual(list(self.redis.data), ['functioncache:f-1'])
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+        self.assertIs(backend.get('f-1'), None)
+        self.assertRaises(KeyError, backend.__delitem__, 'f-1')
+
+    def test_server_side_expiry(self):
+        self.backend.set('f-1', functioncache._retval(1.0, 'x'), 0.05)
+        self.backend['f-2'] = functioncache._retval(1.0, 'y')
+        self.assertNotIn('functioncache:f-2', self.redis.expires)
+        time.sleep(0.1)
+        self.assertNotIn('f-1', self.backend)
+        self.assertIn('f-2', self.backend)
+
+    def test_batches_are_one_round_trip(self):
+        values = dict(('f-%d' % i, functioncache._retval(1.0, i))
+                      for i in range(2500))
+        self.backend.set_many(values, 60)
+        self.assertEqual(self.redis.round_trips, 1)
+        self.backend.set_many(values)
+        self.assertEqual(self.redis.round_trips, 2)
+        found = self.backend.get_many(list(values) + ['f-missing'])
+        self.assertEqual(found, values)
+        self.assertEqual(self.redis.round_trips, 3)
+
+    def test_lease(self):
+        backend = self.backend
+        token = backend.acquire_lease('f-1', 60)
+        self.assertIsNotNone(token)
+        self.assertIsNone(backend.acquire_lease('f-1', 60))
+        backend.release_lease('f-1', 'not-the-holder')
+        self.assertIsNone(backend.acquire_lease('f-1', 60))
+        backend.release_lease('f-1', token)
+        self.assertIsNotNone(backend.acquire_lease('f-1', 60))
+
+    def test_abandoned_lease_expires(self):
+        self.assertIsNotNone(self.backend.acquire_lease('f-1', 0.05))
+        time.sleep(0.1)
+        self.assertIsNotNone(self.backend.acquire_lease('f-1', 60))
+
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.rediscache(60, client=self.redis)
+        def cube_redis(x):
+            calls.append(x)
+            return x ** 3
+
+        self.assertEqual(cube_redis(2), 8)
+        self.assertEqual(cube_redis(2), 8)
+        self.assertEqual(calls, [2])
+        name, = self.redis.expires
+        self.assertAlmostEqual(self.redis.expires[name], time.time() + 60,
+                               delta=5)
+
+
+@unittest.skipUnless(boto3, 'needs boto3 and moto')
+class TestS3Backend(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='cache')
+        self.calls = []
+        self.client.meta.events.register(
+            'before-call.s3.*',
+            lambda model, **_: self.calls.append(model.name))
+        self.backend = self.make_backend()
+
+    def tearDown(self):
+        self.backend.close()
+        self.mock.stop()
+
+    def make_backend(self, **kwargs):
+        backend = functioncache.S3Backend('cache', client=self.client,
+                                          **kwargs)
+        backend.setup(cpu_bound)
+        return backend
+
+    def test_roundtrip(self):
+        backend = self.backend
+        backend.set('f-1', functioncache._retval(1.0, {'a': 1}), None)
+        del self.calls[:]
+        self.assertEqual(backend['f-1'], (1.0, {'a': 1}))
+        self.assertEqual(self.calls, ['GetObject'])
+        del self.calls[:]
+        self.assertIn('f-1', backend)
+        self.assertEqual(self.calls, ['HeadObject'])
+        del backend['f-1']
+        self.assertNotIn('f-1', backend)
+        self.assertIs(backend.get('f-1'), None)
+
+    def test_miss_is_one_request(self):
+        self.assertIs(self.backend.get('f-missing'), None)
+        self.assertEqual(self.calls, ['GetObject'])
+
+    def test_expiry_in_metadata(self):
+        self.backend.set('f-1', functioncache._retval(time.time(), 'x'), 0.05)
+        self.backend['f-2'] = functioncache._retval(time.time(), 'y')
+        head = self.client.head_object(
+            Bucket='cache', Key=self.backend._name('f-1'))
+        self.assertIn('timesig', head['Metadata'])
+        time.sleep(0.1)
+        self.assertNotIn('f-1', self.backend)
+        self.assertIsNone(self.backend.get('f-1'))
+        self.assertEqual(self.backend['f-2'].data, 'y')
+
+    def test_large_values_in_parts(self):
+        # S3 parts, but the last, are at least 5MB
+        backend = self.make_backend(multipart_threshold=5 * 1024 * 1024,
+                                    part_size=5 * 1024 * 1024)
+        value = os.urandom(12 * 1024 * 1024)
+        backend['f-1'] = functioncache._retval(1.0, value)
+        self.assertIn('UploadPart', self.calls)
+        del self.calls[:]
+        self.assertEqual(backend['f-1'].data, value)
+        self.assertEqual(self.calls, ['GetObject'] * 3)
+
+    def test_batches_and_entries(self):
+        values = dict(('f-%d' % i, functioncache._retval(1.0, i))
+                      for i in range(20))
+        self.backend.set_many(values, 60)
+        found = self.backend.get_many(list(values) + ['f-missing'])
+        self.assertEqual(found, values)
+        self.assertEqual(len(list(self.backend._entries('f-'))), 20)
+        self.assertEqual(functioncache.evict(self.backend, max_entries=5), 15)
+        self.assertEqual(len(list(self.backend._entries())), 5)
+
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.S3Backend('cache', client=self.client))
+        def cube_s3(x):
+            calls.append(x)
+            return x ** 3
+
+        self.assertEqual(cube_s3(2), 8)
+        self.assertEqual(cube_s3(2), 8)
+        self.assertEqual(calls, [2])
+
+
+class TestS3PoolBackend(unittest.TestCase):
+
+    class Pool(object):
+
+        def __init__(self):
+            self.objects = dict()
+
+        def list(self, data_set, key):
+            return [key] if (data_set, key) in self.objects else []
+
+        def get_contents_as_string(self, data_set, key):
+            return self.objects[(data_set, key)]
+
+        def set_contents_from_string(self, data_set, key, value):
+            self.objects[(data_set, key)] = value
+
+    def test_old_constructor(self):
+        pool = self.Pool()
+        with self.assertWarns(DeprecationWarning):
+            backend = functioncache.S3Backend(pool)
+        calls = []
+
+        @functioncache.functioncache(60, backend=backend)
+        def square_pool(x):
+            calls.append(x)
+            return x ** 2
+
+        self.assertEqual(square_pool(3), 9)
+        self.assertEqual(square_pool(3), 9)
+        self.assertEqual(calls, [3])
+        self.assertEqual(len(pool.objects), 1)
+
+
+class TestArchive(TempDirMixin, unittest.TestCase):
+
+    FILENAME = 'caches.fca'
+
+    def setUp(self):
+        TempDirMixin.setUp(self)
+        self.archive = self.path
+
+    def file_backend(self, name='module.py.cached'):
+        backend = functioncache.FileBackend()
+        backend.setup_path(os.path.join(self.root, name))
+        return backend
+
+    def test_roundtrip_between_backends(self):
+        files = self.file_backend()
+        now = time.time()
+        for i in range(5):
+            files['f-%d' % i] = functioncache._retval(now, {'i': i})
+        self.assertEqual(functioncache.export_cache(files, self.archive), 5)
+
+        target = functioncache.SqliteBackend()
+        target.setup_path(os.path.join(self.root, 'target.sqlite'))
+        self.assertEqual(functioncache.import_cache(self.archive, target), 5)
+        self.assertEqual(target['f-3'], (now, {'i': 3}))
+        target.close()
+
+    def test_archives_are_appended_to(self):
+        source = functioncache.DictBackend()
+        source['f-1'] = functioncache._retval(1.0, 'old')
+        functioncache.export_cache(source, self.archive, 'first')
+        source['f-1'] = functioncache._retval(2.0, 'new')
+        source['f-2'] = functioncache._retval(2.0, 'other')
+        functioncache.export_cache(source, self.archive, 'second')
+
+        records = list(functioncache.read_archive(self.archive))
+        self.assertEqual([(namespace, key) for namespace, key, _ in records],
+                         [('first', 'f-1'), ('second', 'f-1'),
+                          ('second', 'f-2')])
+        target = functioncache.DictBackend()
+        functioncache.import_cache(self.archive, target)
+        self.assertEqual(target['f-1'].data, 'new')
+        target = functioncache.DictBackend()
+        functioncache.import_cache(self.archive, target, namespace='first')
+        self.assertEqual(list(target), ['f-1'])
+        self.assertEqual(target['f-1'].data, 'old')
+
+    def test_dictcache_keys(self):
+
+        @functioncache.dictcache(60)
+        def doubled(x):
+            return 2 * x
+
+        doubled(1)
+        doubled('a')
+        self.assertEqual(
+            functioncache.export_cache(doubled._db, self.archive), 2)
+        target = functioncache.DictBackend()
+        functioncache.import_cache(self.archive, target)
+        self.assertEqual(sorted(target.keys(), key=repr),
+                         sorted(doubled._db.keys(), key=repr))
+
+    def test_real_keys(self):
+        shelf = functioncache.ShelveBackend()
+        shelf.setup_path(os.path.join(self.root, 'module.py.cache'))
+        shelf['f(a/b)'] = functioncache._retval(1.0, 'x')
+        self.assertEqual(functioncache.export_cache(shelf, self.archive), 1)
+        shelf.close()
+        self.assertEqual(list(functioncache.read_archive(self.archive)),
+                         [('', 'f(a/b)', (1.0, 'x'))])
+
+        # files are named after a hash of such keys
+        files = self.file_backend()
+        files['f-1'] = functioncache._retval(1.0, 'y')
+        files['f(a/b)'] = functioncache._retval(1.0, 'x')
+        self.assertRaises(ValueError, functioncache.export_cache, files,
+                          self.archive)
+        self.assertEqual(len(list(functioncache.read_archive(self.archive))),
+                         1)
+
+    def test_zero_copy(self):
+        files = functioncache.FileBackend(zero_copy=True)
+        files.setup_path(os.path.join(self.root, 'module.py.cached'))
+        files['f-1'] = functioncache._retval(1.0, b'x' * 5000)
+        self.assertIsInstance(files['f-1'].data, memoryview)
+        self.assertEqual(functioncache.export_cache(files, self.archive), 1)
+        target = functioncache.DictBackend()
+        functioncache.import_cache(self.archive, target)
+        self.assertEqual(target['f-1'], (1.0, b'x' * 5000))
+        self.assertRaises(functioncache.PicklingError,
+                          functioncache.Serializer().dumps, memoryview(b'x'))
+
+    def test_max_age(self):
+        source = functioncache.DictBackend()
+        source['f-old'] = functioncache._retval(time.time() - 100, 1)
+        source['f-new'] = functioncache._retval(time.time(), 2)
+        functioncache.export_cache(source, self.archive)
+        target = functioncache.DictBackend()
+        self.assertEqual(
+            functioncache.import_cache(self.archive, target, max_age=50), 1)
+        self.assertEqual(list(target), ['f-new'])
+
+    def test_import_namespaces_in_one_pass(self):
+        from functioncache import _archive
+        source = functioncache.DictBackend()
+        for namespace in ('a', 'b', 'c'):
+            source['f-1'] = functioncache._retval(time.time(), namespace)
+            functioncache.export_cache(source, self.archive, namespace)
+        del source['f-1']
+        source['f-2'] = functioncache._retval(time.time() - 100, 'c')
+        functioncache.export_cache(source, self.archive, 'c')
+
+        targets = {'a': functioncache.DictBackend(), 'b': None,
+                   'c': functioncache.DictBackend()}
+        opened = []
+        loaded = []
+        load_entry = _archive._load_entry
+        _archive._load_entry = lambda serializer, data: loaded.append(
+            data) or load_entry(serializer, data)
+        try:
+            counts = _archive.import_namespaces(
+                self.archive, lambda namespace: opened.append(namespace) or
+                targets[namespace], max_age=50)
+        finally:
+            _archive._load_entry = load_entry
+        self.assertEqual(counts, {'a': 1, 'c': 1})
+        self.assertEqual(opened, ['a', 'b', 'c'])
+        # b's entry and c's old one were never deserialized
+        self.assertEqual(len(loaded), 2)
+        self.assertEqual(targets['c']['f-1'].data, 'c')
+        self.assertNotIn('f-2', targets['c'])
+
+    def test_old_archives(self):
+        import gzip
+        from functioncache import _archive
+        data = functioncache._dump_entry(functioncache.Serializer(),
+                                         functioncache._retval(1.0, 'x'))
+        with gzip.open(self.archive, 'wb') as archive:
+            archive.write(_archive._OLD_RECORD.pack(
+                b'FCA1', 1, 3, len(data)) + b'af-1' + data)
+        self.assertEqual(list(functioncache.read_archive(self.archive)),
+                         [('a', 'f-1', (1.0, 'x'))])
+
+    def test_redis_and_memcache(self):
+        redis = FakeRedis()
+        source = functioncache.RedisBackend(redis)
+        source.set('f-1', functioncache._retval(1.0, 'x'), None)
+        source.acquire_lease('f-1', 60)
+        self.assertEqual(functioncache.export_cache(source, self.archive), 1)
+        # memcache can be loaded, but can't list its keys
+        memcache = functioncache.MemcacheBackend(FakeMemcacheClient())
+        functioncache.import_cache(self.archive, memcache, ttl=60)
+        self.assertEqual(memcache['f-1'].data, 'x')
+        self.assertRaises(ValueError, functioncache.export_cache, memcache,
+                          self.archive)
+
+    def test_prewarm(self):
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def warmed(x, y=1):
+            calls.append((x, y))
+            return x * y
+
+        count = functioncache.prewarm(
+            warmed, [(1,), (2, 3), {'args': [4], 'kwargs': {'y': 5}}, (1,)])
+        self.assertEqual(count, 4)
+        self.assertEqual(sorted(calls), [(1, 1), (2, 3), (4, 5)])
+        self.assertEqual((warmed(1), warmed(2, 3), warmed(4, y=5)),
+                         (1, 6, 20))
+        self.assertEqual(len(calls), 3)
+
+    def test_prewarm_coroutines(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        async def warmed(x, y=1):
+            calls.append((x, y))
+            return x * y
+
+        self.assertEqual(functioncache.prewarm(
+            warmed, [(1,), {'args': [2], 'kwargs': {'y': 3}}]), 2)
+        self.assertEqual(sorted(calls), [(1, 1), (2, 3)])
+
+        async def main():
+            return [await warmed(1), await warmed(2, y=3)]
+
+        self.assertEqual(asyncio.run(main()), [1, 6])
+        self.assertEqual(len(calls), 2)
+
+    def test_command_line(self):
+        from functioncache.__main__ import main
+        old = os.path.join(self.root, 'old')
+        new = os.path.join(self.root, 'new')
+        files = self.file_backend(os.path.join('old', 'app', 'views.py.cached'))
+        files['f-1'] = functioncache._retval(time.time(), 'page')
+        self.assertEqual(main(['export', self.archive, '--root', old]), 0)
+        self.assertEqual(main(['import', self.archive, '--root', new,
+                               '--backend', 'sqlite']), 0)
+        target = functioncache.SqliteBackend()
+        target.setup_path(os.path.join(new, 'app', 'views.py.cache.sqlite'))
+        self.assertEqual(target['f-1'].data, 'page')
+        target.close()
+
+        # a cache with hashed keys is skipped, the others are exported
+        hashed = self.file_backend(os.path.join('old', 'app', 'api.py.cached'))
+        hashed['f(1)'] = functioncache._retval(time.time(), 'json')
+        os.remove(self.archive)
+        self.assertEqual(main(['export', self.archive, '--root', old]), 1)
+        self.assertEqual(
+            [key for _, key, _ in functioncache.read_archive(self.archive)],
+            ['f-1'])
+
+
+class TestCacheMap(unittest.TestCase):
+
+    def test_order_and_misses(self):
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def add(x, y=10):
+            calls.append((x, y))
+            return x + y
+
+        self.assertEqual(add(1), 11)
+        results = add.cache_map([(3,), (1,), (2, 5), (3,)])
+        self.assertEqual(results, [13, 11, 7, 13])
+        # 1 was cached and 3 was only computed once
+        self.assertEqual(calls, [(1, 10), (3, 10), (2, 5)])
+        # the batch shares its keys with normal calls
+        self.assertEqual(add(2, y=5), 7)
+        self.assertEqual(len(calls), 3)
+
+    def test_kwargs(self):
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def scale(x, factor=1):
+            calls.append(x)
+            return x * factor
+
+        results = scale.cache_map_kwargs([{'x': 2, 'factor': 3}, {'x': 4}])
+        self.assertEqual(results, [6, 4])
+        self.assertEqual(scale(2, 3), 6)
+        self.assertEqual(scale(4), 4)
+        self.assertEqual(calls, [2, 4])
+
+    def test_skipcache_not_stored(self):
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def shaky(x):
+            if x < 0:
+                raise functioncache.SkipCache('negative', 0)
+            return x
+
+        self.assertEqual(shaky.cache_map([(-1,), (1,)]), [0, 1])
+        self.assertEqual(len(cached_keys(shaky)), 1)
+
+    def test_error_keeps_computed_results(self):
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def picky(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+
+        self.assertRaises(ValueError, picky.cache_map, [(1,), (2,), (3,)])
+        self.assertEqual(len(cached_keys(picky)), 1)
+
+    def test_thread_pool(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def slow(x):
+            time.sleep(0.05)
+            return -x
+
+        with ThreadPoolExecutor(8) as executor:
+            start = time.time()
+            results = slow.cache_map([(i,) for i in range(8)], executor)
+        self.assertEqual(results, [-i for i in range(8)])
+        self.assertLess(time.time() - start, 0.3)
+
+    def test_process_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(2) as executor:
+            results = cpu_bound.cache_map([(i,) for i in range(6)], executor)
+        self.assertEqual(results, [i * i for i in range(6)])
+        # written by this process
+        self.assertEqual(cpu_bound.cache_map([(5,)]), [25])
+        self.assertEqual(len(cached_keys(cpu_bound)), 6)
+
+    def test_memcache_multi_get(self):
+        client = FakeMemcacheClient()
+
+        @functioncache.functioncache(
+            60, backend=functioncache.MemcacheBackend(client))
+        def negate(x):
+            return -x
+
+        negate.cache_map([(i,) for i in range(100)])
+        self.assertEqual(client.round_trips, 2)
+        self.assertEqual(negate.cache_map([(i,) for i in range(100)]),
+                         [-i for i in range(100)])
+        self.assertEqual(client.round_trips, 3)
+
+    def test_sqlite_bulk(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        backend = functioncache.SqliteBackend()
+        backend.setup_path(os.path.join(root, 'bulk.cache.sqlite'))
+
+        def triple(x):
+            return 3 * x
+
+        triple._db = backend
+        triple = functioncache.functioncache(60)(triple)
+        inputs = [(i,) for i in range(1200)]
+        self.assertEqual(triple.cache_map(inputs), [3 * i for i in range(1200)])
+        self.assertEqual(len(backend.get_many(
+            [functioncache._args_key(triple, args, {}) for args in inputs])),
+            1200)
+        backend.close()
+
+
+class TestSubmit(unittest.TestCase):
+
+    def test_hits_are_done_futures(self):
+        from concurrent.futures import ThreadPoolExecutor
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(),
+            executor=ThreadPoolExecutor(2))
+        def ident(x):
+            calls.append(x)
+            return x
+
+        self.assertEqual(ident.submit(1).result(), 1)
+        hit = ident.submit(1)
+        self.assertTrue(hit.done())
+        self.assertEqual(hit.result(), 1)
+        self.assertEqual(calls, [1])
+
+    def test_running_misses_are_shared(self):
+        from concurrent.futures import ThreadPoolExecutor
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(),
+            executor=ThreadPoolExecutor(4))
+        def slow_ident(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return x
+
+        futures = [slow_ident.submit(7) for _ in range(4)]
+        self.assertEqual([future.result() for future in futures], [7] * 4)
+        self.assertEqual(calls, [7])
+        self.assertEqual(slow_ident(7), 7)
+        self.assertEqual(calls, [7])
+
+    def test_exceptions(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(),
+            executor=ThreadPoolExecutor(1))
+        def fails(x):
+            raise KeyError(x)
+
+        self.assertRaises(KeyError, fails.submit(1).result)
+        self.assertEqual(cached_keys(fails), [])
+
+    def test_without_executor(self):
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        def plain(x):
+            return x + 1
+
+        future = plain.submit(1)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), 2)
+
+    def test_process_pool(self):
+        futures = [cpu_bound_pooled.submit(n) for n in (10, 20, 10)]
+        expected = [sum(i * i for i in range(n)) for n in (10, 20, 10)]
+        self.assertEqual([future.result() for future in futures], expected)
+        self.assertEqual(len(cached_keys(cpu_bound_pooled)), 2)
+        self.assertEqual(cpu_bound_pooled.cache_map([(10,), (30,)]),
+                         [expected[0], sum(i * i for i in range(30))])
+        cpu_bound_pooled.__wrapped__._executor.shutdown()
+
+
+class TestStats(unittest.TestCase):
+
+    def test_counters(self):
+        @functioncache.functioncache(0.05, backend=functioncache.DictBackend())
+        def counted(x):
+            return 'x' * x
+
+        counted(100)
+        counted(100)
+        counted(100)
+        time.sleep(0.06)
+        counted(100)
+
+        stats = counted.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+        self.assertGreaterEqual(stats['bytes_stored'], 200)
+        # hits on a DictBackend's fast path aren't timed
+        self.assertEqual(stats['key_seconds']['count'], 2)
+        self.assertEqual(stats['read_seconds']['count'], 2)
+        self.assertEqual(stats['write_seconds']['count'], 2)
+        self.assertEqual(
+            sum(count for _, count in stats['write_seconds']['buckets']), 2)
+
+    def test_errors(self):
+        def unkeyable(x):
+            return 1
+
+        unkeyable = functioncache.functioncache(
+            backend=functioncache.DictBackend())(unkeyable)
+        temp = functioncache._log_error
+        functioncache._log_error = lambda error_str: None
+        try:
+            # neither hashable nor picklable
+            unkeyable({'callback': lambda: None})
+        finally:
+            functioncache._log_error = temp
+        self.assertEqual(unkeyable.cache_stats()['errors'], 1)
+
+    def test_hooks_and_registry(self):
+        events = []
+
+        def hook(event, name, value):
+            events.append((event, name))
+
+        functioncache.add_stats_hook(hook)
+        try:
+            @functioncache.functioncache(backend=functioncache.DictBackend())
+            def hooked(x):
+                return x
+
+            hooked(1)
+            hooked(1)
+        finally:
+            functioncache.remove_stats_hook(hook)
+        hooked(1)
+
+        name = __name__ + '.TestStats.test_hooks_and_registry.<locals>.hooked'
+        self.assertEqual(
+            [event for event, event_name in events
+             if event_name == name and event in ('hits', 'misses')],
+            ['misses', 'hits'])
+        registry = functioncache.cache_stats()
+        groups = [group for group in registry.values() if name in group]
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0][name]['hits'], 2)
+
+    def test_batches(self):
+        @functioncache.functioncache(backend=functioncache.DictBackend())
+        def batched(x):
+            return x
+
+        batched.cache_map([(1,), (2,)])
+        batched.cache_map([(1,), (3,)])
+        stats = batched.cache_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_misses_compute_once(self):
+        import threading
+        calls = []
+        start = threading.Event()
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(), single_flight=True)
+        def slow_square(x):
+            calls.append(x)
+            time.sleep(0.2)
+            return x * x
+
+        results = []
+
+        def worker():
+            start.wait()
+            results.append(slow_square(7))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [49] * 8)
+        self.assertEqual(calls, [7])
+
+    def test_waiters_see_leader_exception(self):
+        import threading
+        start = threading.Event()
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(), single_flight=True)
+        def broken(x):
+            time.sleep(0.1)
+            raise ValueError(x)
+
+        errors = []
+
+        def worker():
+            start.wait()
+            try:
+                broken(1)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(functioncache._FLIGHTS, {})
+
+    def test_file_lease(self):
+        def leased():
+            pass
+
+        first = functioncache.FileBackend()
+        first.setup(leased)
+        second = functioncache.FileBackend()
+        second.setup(leased)
+
+        token = first.acquire_lease('key', 60)
+        self.assertIsNotNone(token)
+        self.assertIsNone(second.acquire_lease('key', 60))
+
+        first.release_lease('key', token)
+        token = second.acquire_lease('key', 60)
+        self.assertIsNotNone(token)
+        second.release_lease('key', token)
+
+    def test_file_lease_expires(self):
+        def abandoned():
+            pass
+
+        backend = functioncache.FileBackend()
+        backend.setup(abandoned)
+        self.assertIsNotNone(backend.acquire_lease('key', 60))
+        # a lease older than its lifetime is broken by the next caller
+        self.assertIsNone(backend.acquire_lease('key', 0))
+        token = backend.acquire_lease('key', 60)
+        self.assertIsNotNone(token)
+        backend.release_lease('key', token)
+
+
+class FakeAsyncMemcache(object):
+
+    """ stands in for aiomcache.Client """
+
+    def __init__(self):
+        self.data = {}
+        self.exptimes = {}
+
+    async def get(self, key):
+        assert isinstance(key, bytes)
+        return self.data.get(key)
+
+    async def set(self, key, value, exptime=0):
+        self.data[key] = value
+        self.exptimes[key] = exptime
+        return True
+
+
+class TestAsync(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.run(coroutine)
+
+    def test_caches_awaited_result(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        async def fetch(x):
+            calls.append(x)
+            await asyncio.sleep(0)
+            return x * 3
+
+        self.assertTrue(inspect.iscoroutinefunction(fetch))
+
+        async def main():
+            return [await fetch(2), await fetch(2), await fetch(3)]
+
+        self.assertEqual(self.run_async(main()), [6, 6, 9])
+        self.assertEqual(calls, [2, 3])
+
+    def test_file_backend_off_loop(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.AsyncFileBackend)
+        async def fetch_file(x):
+            calls.append(x)
+            return {'x': x}
+
+        async def main():
+            return [await fetch_file(1), await fetch_file(1)]
+
+        self.assertEqual(self.run_async(main()), [{'x': 1}, {'x': 1}])
+        self.assertEqual(calls, [1])
+        self.assertIsInstance(fetch_file._adb, functioncache.AsyncFileBackend)
+
+    def test_native_memcache_client(self):
+        client = FakeAsyncMemcache()
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.AsyncMemcacheBackend(client))
+        async def fetch_mc(x):
+            calls.append(x)
+            return x + 1
+
+        async def main():
+            return [await fetch_mc(1), await fetch_mc(1)]
+
+        self.assertEqual(self.run_async(main()), [2, 2])
+        self.assertEqual(calls, [1])
+        self.assertEqual(len(client.data), 1)
+        self.assertEqual(list(client.exptimes.values()), [60])
+
+    def test_single_flight_tasks(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(), single_flight=True)
+        async def crawl(url):
+            calls.append(url)
+            await asyncio.sleep(0.05)
+            return url.upper()
+
+        async def main():
+            return await asyncio.gather(*[crawl('a') for _ in range(10)])
+
+        self.assertEqual(self.run_async(main()), ['A'] * 10)
+        self.assertEqual(calls, ['a'])
+
+    def test_single_flight_leader_cancelled(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=functioncache.DictBackend(), single_flight=True)
+        async def crawl(url):
+            calls.append(url)
+            await asyncio.sleep(0.05)
+            return url.upper()
+
+        async def main():
+            leader = asyncio.ensure_future(crawl('a'))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(crawl('a')) for _ in range(4)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            followers[-1].cancel()
+            await asyncio.sleep(0)
+            # one of the others computes it for the rest
+            results = await asyncio.gather(*followers[:-1])
+            return leader.cancelled(), followers[-1].cancelled(), results
+
+        self.assertEqual(self.run_async(main()), (True, True, ['A'] * 3))
+        self.assertEqual(calls, ['a', 'a'])
+
+    def test_skipcache(self):
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend())
+        async def flaky(x):
+            calls.append(x)
+            raise functioncache.SkipCache('down', 'fallback')
+
+        async def main():
+            return [await flaky(1), await flaky(1)]
+
+        self.assertEqual(self.run_async(main()), ['fallback', 'fallback'])
+        self.assertEqual(calls, [1, 1])
+
+
+class TestZeroCopy(TempDirMixin, unittest.TestCase):
+
+    def backend(self, zero_copy=True):
+        return TempDirMixin.backend(self, zero_copy=zero_copy)
+
+    def test_bytes_are_mapped(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(123.0, b'x' * 100000)
+        rv = backend['f-1']
+        self.assertEqual(rv.timesig, 123.0)
+        self.assertIsInstance(rv.data, memoryview)
+        self.assertTrue(rv.data.readonly)
+        self.assertEqual(rv.data.tobytes(), b'x' * 100000)
+
+    def test_values_without_buffers(self):
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(123.0, {'a': 1})
+        self.assertEqual(backend['f-1'], (123.0, {'a': 1}))
+        with open(backend._get_filename('f-1'), 'rb') as f:
+            self.assertEqual(f.read(len(functioncache._MMAP_MAGIC)),
+                             functioncache._MMAP_MAGIC)
+        self.assertEqual(os.listdir(os.path.dirname(
+            backend._get_filename('f-1'))), ['f-1'])
+
+    def test_reads_either_format(self):
+        self.backend(False)['f-1'] = functioncache._retval(1.0, b'legacy')
+        self.backend()['f-2'] = functioncache._retval(2.0, b'mapped')
+        backend = self.backend(False)
+        self.assertEqual(backend['f-1'].data, b'legacy')
+        self.assertEqual(bytes(backend['f-2'].data), b'mapped')
+        self.assertEqual(bytes(self.backend()['f-1'].data), b'legacy')
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def test_numpy_arrays(self):
+        arrays = {'a': numpy.arange(100000, dtype='float64'),
+                  'b': numpy.ones((3, 5), dtype='int8')}
+        backend = self.backend()
+        backend['f-1'] = functioncache._retval(1.0, arrays)
+        data = backend['f-1'].data
+        for name, array in arrays.items():
+            numpy.testing.assert_array_equal(data[name], array)
+            self.assertEqual(data[name].dtype, array.dtype)
+            self.assertFalse(data[name].flags.writeable)
+            self.assertFalse(data[name].flags.owndata)
+            self.assertEqual(data[name].ctypes.data % 64, 0)
+
+    @unittest.skipUnless(numpy, 'needs numpy')
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.functioncache(
+            backend=functioncache.FileBackend(zero_copy=True))
+        def matrix(n):
+            calls.append(n)
+            return numpy.eye(n)
+
+        numpy.testing.assert_array_equal(matrix(50), numpy.eye(50))
+        result = matrix(50)
+        numpy.testing.assert_array_equal(result, numpy.eye(50))
+        self.assertFalse(result.flags.writeable)
+        self.assertEqual(calls, [50])
+
+
+class TestSerializers(TempDirMixin, unittest.TestCase):
+
+    def test_roundtrips(self):
+        value = {'a': [1, 2.5, None], 'b': b'x' * 5000, 'c': (u'text',)}
+        for codec in (functioncache.PICKLE, functioncache.MARSHAL):
+            for compression in (None, functioncache.ZLIB):
+                serializer = functioncache.Serializer(codec, compression)
+                data = serializer.dumps(value)
+                self.assertEqual(functioncache.Serializer().loads(data), value)
+                if compression:
+                    self.assertLess(len(data), 1000)
+
+    def test_threshold(self):
+        serializer = functioncache.Serializer(
+            compression=functioncache.ZLIB, threshold=100)
+        small, large = serializer.dumps(b'x' * 10), serializer.dumps(b'x' * 1000)
+        self.assertEqual(small[4], 0)
+        self.assertNotEqual(large[4], 0)
+
+    def test_marshal_rejects_objects(self):
+        serializer = functioncache.Serializer(functioncache.MARSHAL)
+        with self.assertRaises(functioncache.PicklingError):
+            serializer.dumps(Point(1, 2).__class__)
+
+    def test_reads_plain_pickles(self):
+        import pickle
+        data = pickle.dumps(functioncache._retval(1.0, [1, 2]))
+        self.assertEqual(functioncache.Serializer().loads(data), (1.0, [1, 2]))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, functioncache.Serializer, 'json')
+        self.assertRaises(ValueError, functioncache.Serializer,
+                          compression='brotli')
+
+    def check_backend(self, backend, setup):
+        serializer = functioncache.Serializer(
+            functioncache.MARSHAL, functioncache.ZLIB, threshold=10)
+        compressed = functioncache._with_serializer(backend, serializer)
+        self.assertIsNot(compressed, backend)
+        self.assertIs(backend.serializer, type(backend).serializer)
+        setup(backend)
+        value = functioncache._retval(123.0, {'text': 'y' * 1000})
+        backend['f-old'] = value
+        if hasattr(backend, 'close'):
+            backend.close()
+        setup(compressed)
+        compressed['f-new'] = value
+        self.assertEqual(compressed['f-new'], value)
+        self.assertEqual(compressed['f-old'], value)
+        return compressed
+
+    def test_file_backend(self):
+        path = os.path.join(self.root, 'module.py.cached')
+        backend = self.check_backend(
+            functioncache.FileBackend(), lambda b: b.setup_path(path))
+        with open(backend._get_filename('f-new'), 'rb') as f:
+            self.assertLess(len(f.read()), 100)
+
+    def test_shelve_backend(self):
+        path = os.path.join(self.root, 'module.py.cache')
+        backend = self.check_backend(
+            functioncache.ShelveBackend(), lambda b: b.setup_path(path))
+        backend.close()
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.root, 'module.py.cache.sqlite')
+        backend = self.check_backend(
+            functioncache.SqliteBackend(), lambda b: b.setup_path(path))
+        backend.close()
+
+    def test_memcache_backend(self):
+        client = FakeMemcacheClient()
+        self.check_backend(functioncache.MemcacheBackend(client),
+                           lambda b: None)
+        self.assertIsInstance(client.data['f-new'], bytes)
+        self.assertIsInstance(client.data['f-old'], tuple)
+
+    def test_decorated(self):
+        calls = []
+
+        @functioncache.functioncache(
+            backend=functioncache.TieredBackend(functioncache.FileBackend()),
+            serializer=functioncache.Serializer(compression=functioncache.ZLIB))
+        def compressible(n):
+            calls.append(n)
+            return 'z' * n
+
+        self.assertEqual(compressible(10000), 'z' * 10000)
+        compressible.__wrapped__._db._memory.clear()
+        self.assertEqual(compressible(10000), 'z' * 10000)
+        self.assertEqual(calls, [10000])
+        self.assertIsNot(compressible.__wrapped__._db.backend.serializer, None)
+
+    def test_no_serializer(self):
+        with self.assertRaises(ValueError):
+            functioncache.functioncache(
+                backend=functioncache.DictBackend(),
+                serializer=functioncache.Serializer())
+        with self.assertRaises(ValueError):
+            functioncache.functioncache(
+                backend=functioncache.FileBackend(zero_copy=True),
+                serializer=functioncache.Serializer())
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    def wait_for_refreshes(self):
+        deadline = time.time() + 5
+        while functioncache._REFRESHING and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(functioncache._REFRESHING)
+
+    def versioned(self, **kwargs):
+        calls = []
+
+        @functioncache.functioncache(
+            backend=functioncache.DictBackend(), **kwargs)
+        def version(x):
+            calls.append(x)
+            return len(calls)
+
+        # the DictBackend is shared with the other tests' version functions
+        for key in cached_keys(version):
+            del version._db[key]
+        return version, calls
+
+    def test_stale_served_while_refreshing(self):
+        version, calls = self.versioned(seconds_of_validity=0.1, stale_ttl=60)
+        self.assertEqual(version(1), 1)
+        time.sleep(0.15)
+        self.assertEqual(version(1), 1)
+        self.wait_for_refreshes()
+        self.assertEqual(version(1), 2)
+        self.assertEqual(calls, [1, 1])
+        stats = version.cache_stats()
+        self.assertEqual(stats['stale'], 1)
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_batches_kept_for_stale_ttl(self):
+        ttls = []
+
+        class TtlBackend(functioncache.DictBackend):
+            def set(self, key, value, ttl=None):
+                ttls.append(ttl)
+                self[key] = value
+
+        @functioncache.functioncache(1, backend=TtlBackend(), stale_ttl=30)
+        def batched(x):
+            return x
+
+        batched(1)
+        batched.cache_map([(2,)])
+        self.assertEqual(ttls, [31, 31])
+
+    def test_past_stale_ttl(self):
+        version, calls = self.versioned(seconds_of_validity=0.05,
+                                        stale_ttl=0.05)
+        version(1)
+        time.sleep(0.15)
+        self.assertEqual(version(1), 2)
+        self.assertEqual(version.cache_stats()['refreshes'], 0)
+
+    def test_refresh_ahead(self):
+        version, calls = self.versioned(seconds_of_validity=60,
+                                        refresh_ahead=59.95)
+        version(1)
+        self.assertEqual(version(1), 1)
+        self.assertEqual(version.cache_stats()['refreshes'], 0)
+        time.sleep(0.1)
+        self.assertEqual(version(1), 1)
+        self.wait_for_refreshes()
+        self.assertEqual(version(1), 2)
+
+    def test_one_refresh_per_key(self):
+        import threading
+        release = threading.Event()
+        calls = []
+
+        @functioncache.functioncache(0.05, backend=functioncache.DictBackend(),
+                                     stale_ttl=60)
+        def slow_refresh(x):
+            calls.append(x)
+            if len(calls) > 1:
+                release.wait(5)
+            return len(calls)
+
+        slow_refresh(1)
+        time.sleep(0.1)
+        self.assertEqual([slow_refresh(1) for _ in range(5)], [1] * 5)
+        release.set()
+        self.wait_for_refreshes()
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(slow_refresh.cache_stats()['refreshes'], 1)
+
+    def test_failed_refresh_keeps_stale_entry(self):
+        calls = []
+
+        @functioncache.functioncache(0.05, backend=functioncache.DictBackend(),
+                                     stale_ttl=60)
+        def flaky_refresh(x):
+            calls.append(x)
+            if len(calls) > 1:
+                raise ValueError('down')
+            return 'ok'
+
+        flaky_refresh(1)
+        time.sleep(0.1)
+        self.assertEqual(flaky_refresh(1), 'ok')
+        self.wait_for_refreshes()
+        self.assertEqual(flaky_refresh(1), 'ok')
+
+    def test_coroutine(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(0.05, backend=functioncache.DictBackend(),
+                                     stale_ttl=60)
+        async def fetch_stale(x):
+            calls.append(x)
+            await asyncio.sleep(0)
+            return len(calls)
+
+        async def main():
+            first = await fetch_stale(1)
+            await asyncio.sleep(0.1)
+            stale = await fetch_stale(1)
+            while functioncache._aio._ASYNC_REFRESHES:
+                await asyncio.sleep(0.01)
+            return [first, stale, await fetch_stale(1)]
+
+        self.assertEqual(asyncio.run(main()), [1, 1, 2])
+
+
+class NotFound(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    """ can't be rebuilt from its args """
+
+    def __init__(self, url, *, status):
+        Exception.__init__(self, url)
+        self.status = status
+
+
+class BrokenBackend(functioncache.FileBackend):
+
+    def set(self, key, value, ttl=None):
+        raise IOError('disk full')
+
+
+class TestNegativeCaching(unittest.TestCase):
+
+    def lookup(self, backend=None, **kwargs):
+        calls = []
+
+        @functioncache.functioncache(
+            60, backend=backend or functioncache.DictBackend(), **kwargs)
+        def lookup(x):
+            calls.append(x)
+            if x < 0:
+                raise NotFound(x)
+            if x == 0:
+                raise ValueError(x)
+            return x if x < 10 else None
+
+        return lookup, calls
+
+    def test_cached_exception_raised_again(self):
+        lookup, calls = self.lookup(cache_exceptions=NotFound)
+        for _ in range(3):
+            with self.assertRaises(NotFound) as raised:
+                lookup(-1)
+            self.assertEqual(raised.exception.args, (-1,))
+        self.assertEqual(calls, [-1])
+        self.assertEqual(lookup(1), 1)
+        stats = lookup.cache_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['negative'], 2)
+
+    def test_other_exceptions_not_cached(self):
+        lookup, calls = self.lookup(cache_exceptions=(NotFound,))
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                lookup(0)
+        self.assertEqual(calls, [0, 0])
+
+    def test_negative_ttl(self):
+        lookup, calls = self.lookup(cache_exceptions=(NotFound,),
+                                    negative=lambda result: result is None,
+                                    negative_ttl=0.05)
+        self.assertIsNone(lookup(10))
+        self.assertIsNone(lookup(10))
+        with self.assertRaises(NotFound):
+            lookup(-1)
+        self.assertEqual(lookup(1), 1)
+        self.assertEqual(calls, [10, -1, 1])
+        time.sleep(0.1)
+        self.assertIsNone(lookup(10))
+        with self.assertRaises(NotFound):
+            lookup(-1)
+        # good results live for seconds_of_validity
+        self.assertEqual(lookup(1), 1)
+        self.assertEqual(calls, [10, -1, 1, 10, -1])
+
+    def test_negative_never_stale(self):
+        lookup, calls = self.lookup(negative=lambda result: result is None,
+                                    negative_ttl=0.05, stale_ttl=60)
+        lookup(10)
+        time.sleep(0.1)
+        lookup(10)
+        self.assertEqual(calls, [10, 10])
+        self.assertEqual(lookup.cache_stats()['stale'], 0)
+
+    def test_pickled(self):
+        lookup, calls = self.lookup(functioncache.FileBackend(),
+                                    cache_exceptions=(NotFound,))
+        for _ in range(2):
+            with self.assertRaises(NotFound):
+                lookup(-2)
+        self.assertEqual(calls, [-2])
+
+    def test_cache_map(self):
+        lookup, calls = self.lookup(cache_exceptions=(NotFound,),
+                                    negative=lambda result: result is None)
+        self.assertEqual(lookup.cache_map([(1,), (10,)]), [1, None])
+        with self.assertRaises(NotFound):
+            lookup.cache_map([(2,), (-3,)])
+        # the exception was stored along with the batch's other results
+        with self.assertRaises(NotFound):
+            lookup(-3)
+        self.assertEqual(lookup(2), 2)
+        self.assertIsNone(lookup(10))
+        self.assertEqual(calls, [1, 10, 2, -3])
+        with self.assertRaises(NotFound):
+            lookup.submit(-3).result()
+        self.assertEqual(calls, [1, 10, 2, -3])
+
+    def fetch(self, backend):
+        calls = []
+
+        @functioncache.functioncache(60, backend=backend,
+                                     cache_exceptions=(HTTPError,),
+                                     fail_silently=False)
+        def fetch(url):
+            calls.append(url)
+            raise HTTPError(url, status=404)
+
+        return fetch, calls
+
+    def test_unusual_constructor(self):
+        fetch, calls = self.fetch(functioncache.DictBackend())
+        for _ in range(2):
+            with self.assertRaises(HTTPError) as raised:
+                fetch('/a')
+            self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(calls, ['/a'])
+
+    def test_unusual_constructor_pickled(self):
+        fetch, calls = self.fetch(functioncache.FileBackend())
+        for _ in range(2):
+            with self.assertRaises(HTTPError) as raised:
+                fetch('/b')
+            self.assertEqual(raised.exception.args, ('/b',))
+            self.assertEqual(raised.exception.status, 404)
+        self.assertEqual(calls, ['/b'])
+
+    def test_store_fails(self):
+        fetch, calls = self.fetch(BrokenBackend())
+        for _ in range(2):
+            try:
+                fetch('/a')
+            except HTTPError as e:
+                # raised with the traceback of the call that failed
+                frames = _traceback.extract_tb(e.__traceback__)
+                self.assertEqual(frames[-1].name, 'fetch')
+            else:
+                self.fail('HTTPError not raised')
+        self.assertEqual(calls, ['/a', '/a'])
+        self.assertEqual(fetch.cache_stats()['errors'], 2)
+
+    def test_async_unusual_constructor(self):
+        import asyncio
+        for backend, expected in ((functioncache.DictBackend(), ['/a']),
+                                  (BrokenBackend(), ['/a', '/a'])):
+            calls = []
+
+            @functioncache.functioncache(60, backend=backend,
+                                         cache_exceptions=(HTTPError,),
+                                         fail_silently=False)
+            async def fetch(url):
+                calls.append(url)
+                raise HTTPError(url, status=404)
+
+            async def main():
+                for _ in range(2):
+                    with self.assertRaises(HTTPError):
+                        await fetch('/a')
+
+            asyncio.run(main())
+            self.assertEqual(calls, expected)
+
+    def test_async(self):
+        import asyncio
+        calls = []
+
+        @functioncache.functioncache(60, backend=functioncache.DictBackend(),
+                                     cache_exceptions=(NotFound,))
+        async def fetch(x):
+            calls.append(x)
+            raise NotFound(x)
+
+        async def main():
+            for _ in range(2):
+                with self.assertRaises(NotFound):
+                    await fetch(1)
+
+        asyncio.run(main())
+        self.assertEqual(calls, [1])
+
+
+def _define_version(source, function_key=functioncache.function_fingerprint,
+                    **kwargs):
+    """ the last function defined by source, cached with function_key """
+    namespace = {'functioncache': functioncache,
+                 'function_key': function_key, 'kwargs': kwargs}
+    exec(compile(source, '/versions/module.py', 'exec'), namespace)
+    return namespace['version']
+
+
+class TestFingerprint(unittest.TestCase):
+
+    HELPER = 'def helper(x):\n    return x + %d\n'
+    CACHED = ('@functioncache.functioncache(function_key=function_key,'
+              ' **kwargs)\n'
+              'def version(x):\n'
+              '    return helper(x) * %d\n')
+
+    def source(self, add=1, scale=2):
+        return self.HELPER % add + self.CACHED % scale
+
+    def test_code_changes_key(self):
+        backend = functioncache.DictBackend()
+        key = functioncache.function_fingerprint
+        first = _define_version(self.source(), backend=backend)
+        self.assertEqual(first(1), 4)
+        again = _define_version(self.source(), backend=backend)
+        self.assertEqual(key(again.__wrapped__), key(first.__wrapped__))
+        changed = _define_version(self.source(scale=3), backend=backend)
+        self.assertNotEqual(key(changed.__wrapped__), key(first.__wrapped__))
+        self.assertEqual(changed(1), 6)
+        # a callee's change isn't seen without following calls
+        callee = _define_version(self.source(add=2), backend=backend)
+        self.assertEqual(key(callee.__wrapped__), key(first.__wrapped__))
+
+    def test_deep_follows_calls(self):
+        key = functioncache.function_fingerprint_deep
+        first = _define_version(self.source(), key,
+                                backend=functioncache.DictBackend())
+        changed = _define_version(self.source(add=2), key,
+                                  backend=functioncache.DictBackend())
+        self.assertNotEqual(key(first.__wrapped__),
+                            key(changed.__wrapped__))
+        self.assertEqual(changed(1), 6)
+
+    def test_computed_at_decoration(self):
+        version = _define_version(self.source(),
+                                  backend=functioncache.DictBackend())
+        self.assertIn('_fingerprint_key', version.__wrapped__.__dict__)
+
+    def test_old_versions_swept(self):
+        backend = functioncache.FileBackend()
+        first = _define_version(self.source(), backend=backend)
+        for x in range(3):
+            first(x)
+        old_key = functioncache.function_fingerprint(first.__wrapped__)
+        self.assertEqual(len(list(backend._entries(old_key + '-'))), 3)
+        current = _define_version(self.source(scale=3), backend=backend,
+                                  sweep_every=1)
+        current(1)
+        sweeper = current.__wrapped__._sweeper
+        sweeper.thread.join()
+        self.assertFalse(list(backend._entries(old_key + '-')))
+        self.assertEqual(current(1), 6)
+        self.assertEqual(current.cache_stats()['hits'], 1)
+
+
+class TestDictFastPath(unittest.TestCase):
+
+    def test_keys_are_arguments(self):
+        calls = []
+
+        @functioncache.dictcache(maxsize=10)
+        def scaled(x, factor=2):
+            calls.append(x)
+            return x * factor
+
+        self.assertEqual([scaled(3), scaled(3, 2), scaled(x=3),
+                          scaled(3, factor=2)], [6] * 4)
+        self.assertEqual(calls, [3])
+        key, = cached_keys(scaled.__wrapped__)
+        self.assertEqual(key[:3], ('scaled', 3, 2))
+        entry = scaled.__wrapped__._db[key]
+        self.assertIsInstance(entry, functioncache._Entry)
+        self.assertEqual(entry.data, 6)
+        self.assertEqual(scaled.cache_map([(3,)]), [6])
+        self.assertEqual(calls, [3])
+
+    def test_typed(self):
+        @functioncache.dictcache
+        def kind(x):
+            return type(x).__name__
+
+        self.assertEqual([kind(1), kind(True), kind(1.0)],
+                         ['int', 'bool', 'float'])
+
+    def test_unhashable_arguments(self):
+        calls = []
+
+        @functioncache.dictcache
+        def total(values):
+            calls.append(values)
+            return sum(values)
+
+        self.assertEqual(total([1, 2]), 3)
+        self.assertEqual(total([1, 2]), 3)
+        self.assertEqual(len(calls), 1)
+        key, = cached_keys(total.__wrapped__)
+        self.assertIsInstance(key, str)
+
+    def test_maxsize(self):
+        backend = functioncache.DictBackend(maxsize=2)
+        for key in 'abc':
+            backend[key] = functioncache._retval(1.0, key)
+            backend.get('a')
+        self.assertEqual(list(backend), ['c', 'a'])
+
+    def test_expiry(self):
+        calls = []
+
+        @functioncache.dictcache(0.05)
+        def ticket(x):
+            calls.append(x)
+            return len(calls)
+
+        self.assertEqual(ticket(1), 1)
+        self.assertEqual(ticket(1), 1)
+        time.sleep(0.06)
+        self.assertEqual(ticket(1), 2)
+
+    def test_ignore_instance(self):
+        class Service(object):
+
+            def __init__(self, name):
+                self.name = name
+
+            @functioncache.functioncache(backend=functioncache.DictBackend(),
+                                         ignore_instance=True)
+            def greet(self, who):
+                return '%s greets %s' % (self.name, who)
+
+        self.assertEqual(Service('a').greet('x'), 'a greets x')
+        self.assertEqual(Service('b').greet('x'), 'a greets x')
+        self.assertEqual(Service('b').greet(who='y'), 'b greets y')
+
+    def test_bad_arguments(self):
+        @functioncache.dictcache
+        def pair(x, y):
+            return x, y
+
+        self.assertRaises(TypeError, pair, 1)
+        self.assertRaises(TypeError, pair, 1, 2, 3)
+        self.assertRaises(TypeError, pair, 1, z=2)
+
+    def test_entry_is_a_retval(self):
+        entry = functioncache._Entry(1.0, 'x')
+        self.assertEqual(entry, (1.0, 'x'))
+        timesig, data = entry
+        self.assertEqual(functioncache._retval(*entry).data, 'x')
+
+
 class NotInnerClass:
 
     def __init__(self):
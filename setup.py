@@ -9,8 +9,13 @@ VERSION = '0.98'
 SETUP_DICT = dict(
     name='functioncache',
     packages=['functioncache'],
-    install_requires=['portalocker', 'decorator'],
-    test_requires=['portalocker', 'decorator'],
+    python_requires='>=3.8',
+    install_requires=['decorator>=5'],
+    test_requires=['decorator>=5'],
+    extras_require={
+        's3': ['boto3'],
+        'test': ['pytest', 'boto3', 'moto>=5', 'numpy'],
+    },
     version=VERSION,
     author='zdwiel',
     author_email='zdwiel@gmail.com',
@@ -21,8 +26,8 @@ SETUP_DICT = dict(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Utilities',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ]